@@ -4,10 +4,13 @@ int clint_fd,epoll_fd,str_len,send_len,total_len,recv_len,pipe_fd[2];//pipe_fd[0
 char username[512];
 char password[512];
 ClientBuffer client_recv_buffer;  // 接收缓冲区
+Inflater inflater;  // 服务器压缩流对应的解压流，整个连接期间复用
 
 struct epoll_event event,events[EVENTS_NUM];
 pthread_t t_id,hb_tid;
 bool heartbeat_started=false;  // 标志心跳线程是否已启动
+atomic<int> proto_version(1);  // 服务器回复 hello|1|2 后改用 v2 二进制帧
+atomic<uint32_t> next_request_id(1);
 
 int set_unblocking(int fd){
     int flag=fcntl(fd,F_GETFL);
@@ -28,11 +31,6 @@ void sign_in(){
 void sign_in_resp(const char*code,const char*msg){
     if (strcmp(code, "1") == 0) {
         printf("登录成功\n");
-        // 登录成功后启动心跳线程
-        if(!heartbeat_started){
-            pthread_create(&hb_tid,NULL,heartbeat_thread,&clint_fd);
-            heartbeat_started=true;
-        }
         puts("输入3查询在线用户");
         puts("输入4单播通信");
         puts("输入5多播通信");
@@ -73,13 +71,25 @@ void show_online_user(){
     send_message(msg,strlen(msg));
 }
 void show_online_user_resp(const char*code,const char*msg){
-    if(strcmp(code,"1")==0){
-        printf("当前在线用户:\n");
-        puts(msg);
+    // 在线用户较多时分多帧返回：2表示后面还有帧，1表示最后一帧，3表示本页结束但还有更多用户
+    static bool printing=false;
+    if(strcmp(code,"1")==0||strcmp(code,"2")==0||strcmp(code,"3")==0){
+        if(!printing){
+            printf("当前在线用户:\n");
+            printing=true;
+        }
+        if(msg[0])puts(msg);
+        if(strcmp(code,"2")==0){
+            return;
+        }
+        if(strcmp(code,"3")==0){
+            printf("（在线用户较多，仅显示部分）\n");
+        }
     }
     else{
         printf("请重试\n");
     }
+    printing=false;
     cur_state=state_menu;
 }
 void single_chat(){
@@ -91,13 +101,25 @@ void single_chat(){
     }
 }
 void show_history(char* code,char*msg){
-    if(strcmp(code,"1")==0){
-        puts("发送者  接收者  时间     类型    内容");
-        puts(msg);
+    // 分帧返回：2表示后面还有帧，1表示最后一帧，3表示本页结束但还有更早的记录
+    static bool printing=false;
+    if(strcmp(code,"1")==0||strcmp(code,"2")==0||strcmp(code,"3")==0){
+        if(!printing){
+            puts("编号  发送者  接收者  时间     类型    内容");
+            printing=true;
+        }
+        if(msg[0])puts(msg);
+        if(strcmp(code,"2")==0){
+            return;
+        }
+        if(strcmp(code,"3")==0){
+            puts("（还有更早的记录，可发送 show_history|<最后一条的编号> 继续查看）");
+        }
     }
     else{
         puts("请重试");
     }
+    printing=false;
     cur_state=state_menu;
 }
 void*handle_stdin(void*argv){//副线程处理用户输入数据，并通过管道发送给主线程
@@ -112,12 +134,10 @@ void*handle_stdin(void*argv){//副线程处理用户输入数据，并通过管
     return NULL;
 }
 bool recv_message(){
-    // 接收新数据并填充缓冲区
-    int bytes_read;
-    char temp_buf[BUF_SIZE];
-    
+    // 直接接收到缓冲区的空闲部分，每收一次就解析出其中的完整帧，腾出空间继续接收
     while(1){
-        bytes_read = recv(clint_fd, temp_buf, BUF_SIZE, 0);
+        int bytes_read = recv(clint_fd, client_recv_buffer.buffer + client_recv_buffer.pos,
+                              PROTOCOL_MAX_TOTAL_SIZE - client_recv_buffer.pos, 0);
         if(bytes_read == -1){
             if(errno == EAGAIN || errno == EWOULDBLOCK){
                 break;  // 无数据可读
@@ -130,59 +150,89 @@ bool recv_message(){
         else if(bytes_read == 0){
             return false;  // 连接关闭
         }
-        else{
-            // 将新数据追加到缓冲区
-            if(client_recv_buffer.pos + bytes_read <= PROTOCOL_MAX_TOTAL_SIZE){
-                memcpy(client_recv_buffer.buffer + client_recv_buffer.pos, temp_buf, bytes_read);
-                client_recv_buffer.pos += bytes_read;
-            }
-            else{
-                perror("Buffer overflow");
-                return false;
-            }
-        }
+        client_recv_buffer.pos += bytes_read;
+        extract_messages();
     }
     
-    // 从缓冲区中提取完整的消息
+    return true;
+}
+void extract_messages(){
+    // 从缓冲区中提取完整的消息，续帧拼接到 partial 中
     string message;
+    int offset = 0;
     while(true){
-        int consumed = extractMessage(client_recv_buffer.buffer, client_recv_buffer.pos, message);
+        const char*body;
+        size_t body_len;
+        bool more, compressed;
+        int consumed = extractFrame(client_recv_buffer.buffer + offset, client_recv_buffer.pos - offset, body, body_len, more,
+                                    &compressed);
         if(consumed == -1){
             // 消息不完整，等待更多数据
             break;
         }
         else if(consumed == -2){
-            // 消息长度无效，清理缓冲区的前4个字节并重新尝试
+            // 消息长度无效，跳过1个字节尝试重新同步
             printf("Warning: Invalid message detected, cleaning buffer\n");
-            if(client_recv_buffer.pos > 1){
-                // 移除第一个字节，尝试重新同步
-                memmove(client_recv_buffer.buffer, client_recv_buffer.buffer + 1, client_recv_buffer.pos - 1);
-                client_recv_buffer.pos -= 1;
+            offset += 1;
+            continue;
+        }
+        offset += consumed;
+        if(more||!client_recv_buffer.partial.empty()||client_recv_buffer.partial_overflow){
+            client_recv_buffer.partial_compressed |= compressed;
+            if(client_recv_buffer.partial.size() + body_len > PROTOCOL_MAX_ASSEMBLED_SIZE){
+                // 超出拼接上限，丢弃这条消息剩余的分片
+                client_recv_buffer.partial.clear();
+                client_recv_buffer.partial_overflow = true;
             }
-            else{
-                // 缓冲区太小，清空它
-                client_recv_buffer.pos = 0;
-                break;
+            else if(!client_recv_buffer.partial_overflow){
+                client_recv_buffer.partial.append(body, body_len);
+            }
+            if(more){
+                continue;
+            }
+            bool dropped = client_recv_buffer.partial_overflow;
+            compressed = client_recv_buffer.partial_compressed;
+            client_recv_buffer.partial_overflow = false;
+            client_recv_buffer.partial_compressed = false;
+            message.swap(client_recv_buffer.partial);
+            client_recv_buffer.partial.clear();
+            if(dropped){
+                printf("Warning: Oversized message dropped\n");
+                continue;
             }
         }
-        else if(consumed == 0){
-            // 缓冲区为空
-            break;
+        else{
+            message.assign(body, body_len);
+        }
+        if(compressed){
+            // 压缩消息：解压流在消息之间保留上下文，必须按到达顺序逐条解压
+            string plain;
+            if(!inflater.decompress(message.data(), message.size(), plain, PROTOCOL_MAX_ASSEMBLED_SIZE)){
+                printf("Warning: Failed to decompress message\n");
+                continue;
+            }
+            message.swap(plain);
+        }
+        // 成功提取一个完整消息
+        if(isFrameV2(message.data(),message.size())){
+            handle_server_frame_v2(message);
         }
         else{
-            // 成功提取一个完整消息
             handle_server_message(message.c_str());
-            
-            // 从缓冲区中移除已处理的数据
-            memmove(client_recv_buffer.buffer, client_recv_buffer.buffer + consumed, 
-                   client_recv_buffer.pos - consumed);
-            client_recv_buffer.pos -= consumed;
         }
     }
-    
-    return true;
+    // 从缓冲区中移除已处理的数据
+    memmove(client_recv_buffer.buffer, client_recv_buffer.buffer + offset, client_recv_buffer.pos - offset);
+    client_recv_buffer.pos -= offset;
 }
 bool send_message(const char buf[],int len){
+    if(proto_version==PROTOCOL_V2){
+        // 协商了v2：文本命令转换成二进制帧，带上递增的请求id
+        string frame;
+        if(textToFrameV2(frame,buf,len,next_request_id++,false)){
+            return sendEncoded(clint_fd,frame);
+        }
+    }
     // 使用协议编码消息
     cout<<"编码后消息："<<encodeMessage(string(buf,len))<<endl;
     return sendMessage(clint_fd, string(buf, len));
@@ -368,15 +418,33 @@ void broadcast_chat_resp(char*code,char*msg){
     }
 }
 void handle_server_message(const char*msg){//eg:sign_up|0|注册成功
-    char tmp[BUF_SIZE];
-    strcpy(tmp,msg);
-    char*type=strtok(tmp,"|");
+    string tmp(msg);  // 续帧拼接的消息可能超过 BUF_SIZE
+    char*type=strtok(&tmp[0],"|");
     char*code=strtok(NULL,"|");
     char*text=strtok(NULL,"|");
     if(!type||!code)return ;
     if(!text)text=(char*)"";
-    // puts(type);
-    if(strcmp(type,"sign_up")==0){
+    dispatch_server_message(type,code,text);
+}
+void handle_server_frame_v2(const string&body){
+    // v2 响应的字段为 [状态码, 数据]，数据中的'|'不再被截断
+    FrameV2 frame;
+    if(!decodeFrameV2(body.data(),body.size(),frame)||frame.field_count<1){
+        printf("Warning: Invalid v2 frame\n");
+        return;
+    }
+    const char*type=frame.opcode==OP_QUIT?"bye":opcodeName(frame.opcode);
+    string code=frame.fields[0].str();
+    string text=frame.field_count>1?frame.fields[1].str():string();
+    dispatch_server_message(type,&code[0],&text[0]);
+}
+void dispatch_server_message(const char*type,char*code,char*text){
+    if(strcmp(type,"hello")==0){
+        if(strcmp(code,"1")==0&&atoi(text)>=PROTOCOL_V2){
+            proto_version=PROTOCOL_V2;
+        }
+    }
+    else if(strcmp(type,"sign_up")==0){
         sign_up_resp(code,text);
     }
     else if(strcmp(type,"sign_in")==0){
@@ -388,9 +456,16 @@ void handle_server_message(const char*msg){//eg:sign_up|0|注册成功
     else if(strcmp(type,"show_online_user")==0){
         show_online_user_resp(code,text);
     }
-    else if(strcmp(type,"chat_unread")==0){   //接收未读消息
-        puts("收到未读消息\n来自   发送时间   内容");
-        puts(text);
+    else if(strcmp(type,"chat_unread")==0){   //接收未读消息，分批推送：2表示后面还有，1表示推送完毕
+        static bool receiving=false;
+        if(!receiving){
+            puts("收到未读消息\n来自   发送时间   内容");
+            receiving=true;
+        }
+        if(text[0])puts(text);
+        if(strcmp(code,"2")!=0){
+            receiving=false;
+        }
     }
     else if(strcmp(type,"show_history")==0){
         show_history(code,text);
@@ -405,7 +480,8 @@ void handle_server_message(const char*msg){//eg:sign_up|0|注册成功
         if(strcmp(code,"1")==0){
             // printf("[DEBUG] 心跳成功\n");  // 可选：不输出以减少刷屏
         }
-        else{
+        else if(strcmp(text,"未登录")!=0){
+            // 未登录时心跳只用于保活连接，服务器回复"未登录"属于正常情况
             printf("心跳检测失败: %s\n",text);
         }
     }
@@ -479,8 +555,7 @@ void finish(){
     close(pipe_fd[1]);
 }
 //用于心跳检测
-void*heartbeat_thread(void*arg){
-    int sockfd=*(int*)arg;
+void*heartbeat_thread(void*/*arg*/){
     const char*msg="heartbeat";
     while(1){
         sleep(15);  // 每15秒发送一次心跳，保活连接（小于30秒超时）
@@ -516,7 +591,11 @@ int main(int argc,char*argv[]){
         finish();
         exit(1);
     }
-    // 不再在这里创建心跳线程，而是在登录成功后创建
+    // 连接建立后即启动心跳线程：服务器会断开长时间没有任何数据的连接（包括未登录的连接）
+    if(!heartbeat_started){
+        pthread_create(&hb_tid,NULL,heartbeat_thread,&clint_fd);
+        heartbeat_started=true;
+    }
     bool running=true;
     while(running){
         int event_num=epoll_wait(epoll_fd,events,EVENTS_NUM,-1);
@@ -543,6 +622,9 @@ int main(int argc,char*argv[]){
                     event.events=EPOLLIN|EPOLLET;
                     epoll_ctl(epoll_fd,EPOLL_CTL_MOD,clint_fd,&event);
                     puts("已连接到epoll服务器");
+                    // 协商v2协议和压缩，旧服务器不回复时继续使用v1文本
+                    const char*hello="hello|2|deflate";
+                    send_message(hello,strlen(hello));
                     cur_state=state_menu;//修改状态
                     puts("输入1登录");
                     puts("输入2注册");
@@ -11,7 +11,9 @@
 #include<unistd.h>
 #include<pthread.h>
 #include<stdlib.h>
+#include<atomic>
 #include"../server/Protocol.h"
+#include"../server/Compression.h"
 
 #define IP "127.0.0.1"
 #define PORT 8080
@@ -22,8 +24,11 @@
 struct ClientBuffer {
     char buffer[PROTOCOL_MAX_TOTAL_SIZE];
     int pos;  // 当前缓冲区中的数据长度
+    string partial;         // 正在拼接的续帧消息
+    bool partial_overflow;  // 超出拼接上限，正在丢弃剩余分片
+    bool partial_compressed;  // 正在拼接的消息经过压缩
     
-    ClientBuffer() : pos(0) {
+    ClientBuffer() : pos(0), partial_overflow(false), partial_compressed(false) {
         memset(buffer, 0, sizeof(buffer));
     }
 };
@@ -54,7 +59,10 @@ void show_online_user();
 void single_chat();
 void multi_chat();
 bool recv_message();
+void extract_messages();//从接收缓冲区中解析完整消息（含续帧拼接）
 bool send_message(const char buf[],int len);
 bool handle_pipe_input();
 void handle_server_message(const char*msg);
+void handle_server_frame_v2(const string&body);
+void dispatch_server_message(const char*type,char*code,char*text);
 void*heartbeat_thread(void*arg);
\ No newline at end of file
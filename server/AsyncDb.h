@@ -0,0 +1,459 @@
+#pragma once
+/**
+ * @file AsyncDb.h
+ * @brief 异步数据库执行阶段 - 少量I/O线程复用多条连接，查询完成后回调
+ *
+ * 调用方 submit() 一条带 ? 占位符的语句和完成回调后立即返回，不占用工作线程
+ * 等待网络往返。每个I/O线程持有 conns_per_thread 条连接，用 MySQL 8.0.16+ 的
+ * 非阻塞接口（mysql_real_query_nonblocking / mysql_store_result_nonblocking）
+ * 同时推进多条查询，用 epoll 等待各连接的套接字可读，因此少量线程就能让
+ * 大量查询同时在途。同时在途的语句数等于连接总数（线程数 × 每线程连接数），
+ * 默认 2 × 16 = 32；两者都可在 start() 时指定（服务器启动参数），要达到数百条
+ * 还需相应调大 MySQL 的 max_connections（默认151，与连接池、写线程共用）。
+ *
+ * 客户端库不支持非阻塞接口时（旧版本 libmysqlclient、MariaDB Connector/C），
+ * 退化为每个I/O线程一条连接的阻塞执行，接口和回调语义不变。
+ *
+ * 每条语句从提交到完成的时间按语句模板记入直方图 chatroom_async_db_us，
+ * 在途语句数导出为采样值 chatroom_async_db_in_flight。stop() 时仍在排队或在途的语句
+ * 以失败结果回调，调用方总能收到一次回调。提交时线程上的追踪（Trace）
+ * 随请求保存，完成时记一次数据库调用，回调在该追踪的作用域内执行。
+ *
+ * 回调在I/O线程中执行，只能做轻量工作（如 en_resp 投递响应、再次 submit），
+ * 不能阻塞，否则会拖住同一线程上的其它查询。
+ */
+
+#include <deque>
+#include <vector>
+#include <string>
+#include <unordered_map>
+#include <atomic>
+#include <functional>
+#include <pthread.h>
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
+#include <sys/time.h>
+#include <unistd.h>
+#include <errno.h>
+#include "MyDb.h"
+
+using namespace std;
+
+#if defined(LIBMYSQL_VERSION_ID) && LIBMYSQL_VERSION_ID >= 80016 && !defined(MARIADB_BASE_VERSION) && !defined(MARIADB_PACKAGE_VERSION_ID)
+#define ASYNC_DB_NONBLOCKING 1
+#else
+#define ASYNC_DB_NONBLOCKING 0
+#endif
+
+#define ASYNC_DB_THREADS 2              // I/O线程数
+#define ASYNC_DB_CONNS_PER_THREAD 16    // 非阻塞模式下每个I/O线程复用的连接数
+#define ASYNC_DB_POLL_MS 10             // 有查询在途时 epoll_wait 的超时（兜底推进写阻塞的查询）
+
+// 一条语句的执行结果
+struct DbResult {
+    bool ok;
+    vector<DbRow> rows;
+    ull affected_rows;
+};
+typedef function<void(DbResult&)> DbCallback;
+
+class AsyncDb {
+private:
+    struct Request {
+        string sql;
+        vector<DbParam> params;
+        DbCallback cb;
+        long long submit_us;
+        shared_ptr<Trace> trace;  // 提交时所在消息的追踪（未采样为空）
+    };
+    enum SlotStage { SLOT_IDLE, SLOT_QUERY, SLOT_STORE };
+    struct Slot {
+        MyDb* db;
+        int fd;            // 已注册到epoll的套接字，-1表示未注册
+        SlotStage stage;
+        Request req;
+        string text;       // 格式化后的语句
+    };
+    struct Worker {
+        AsyncDb* owner;
+        pthread_t tid;
+        int epoll_fd;
+        int event_fd;      // 有新请求或需要退出时唤醒（非阻塞模式）
+        pthread_mutex_t mutex;
+        pthread_cond_t cond;  // 有新请求或需要退出时唤醒（阻塞模式）
+        deque<Request> queue;
+        vector<Slot> slots;
+        unordered_map<string, Histogram*> stmt_hist;  // 只由本I/O线程访问，免去每次完成都锁注册表
+    };
+    vector<Worker*> workers;
+    atomic<unsigned int> next_worker;
+    atomic<bool> stopping;
+    string host, user, pwd, db_name;
+    int port;
+
+    atomic<unsigned long long> submitted;
+    atomic<unsigned long long> failed;
+    atomic<unsigned long long> latency_us_total;
+    atomic<int> in_flight;        // 已提交未完成（含排队）的语句数
+    atomic<int> max_in_flight;
+
+    static long long nowUs() {
+        struct timeval tv;
+        gettimeofday(&tv, nullptr);
+        return tv.tv_sec * 1000000LL + tv.tv_usec;
+    }
+
+    static void* run(void* arg);
+    void runBlocking(Worker* w);
+    Histogram* stmt_histogram(Worker* w, const string& sql);
+    void complete(Worker* w, Request& req, DbResult& result);
+#if ASYNC_DB_NONBLOCKING
+    void runNonblocking(Worker* w);
+    void watch(Worker* w, size_t idx);
+    void advance(Worker* w, Slot& slot);
+    void finishSlot(Worker* w, Slot& slot, bool ok, MYSQL_RES* res);
+#endif
+
+public:
+    AsyncDb() : next_worker(0), stopping(false), port(3306), submitted(0), failed(0),
+                latency_us_total(0), in_flight(0), max_in_flight(0) {}
+
+    ~AsyncDb() {
+        stop();
+    }
+
+    /**
+     * @brief 建立连接并启动I/O线程
+     * @param threads I/O线程数
+     * @param conns_per_thread 每个线程复用的连接数（阻塞模式下固定为1）
+     */
+    bool start(const string& host_, const string& user_, const string& pwd_, const string& db_, int port_,
+               int threads = ASYNC_DB_THREADS, int conns_per_thread = ASYNC_DB_CONNS_PER_THREAD);
+
+    void stop();
+
+    /**
+     * @brief 提交一条语句（任意线程），完成后在I/O线程中调用 cb
+     * @param sql 用 ? 作占位符的语句
+     */
+    void submit(const string& sql, const vector<DbParam>& params, DbCallback cb);
+
+    string stats();
+};
+
+inline bool AsyncDb::start(const string& host_, const string& user_, const string& pwd_, const string& db_, int port_,
+                           int threads, int conns_per_thread) {
+    host = host_;
+    user = user_;
+    pwd = pwd_;
+    db_name = db_;
+    port = port_;
+    threads = max(threads, 1);
+    conns_per_thread = max(conns_per_thread, 1);
+#if !ASYNC_DB_NONBLOCKING
+    conns_per_thread = 1;
+#endif
+    for (int i = 0; i < threads; i++) {
+        Worker* w = new Worker();
+        w->owner = this;
+        pthread_mutex_init(&w->mutex, nullptr);
+        pthread_cond_init(&w->cond, nullptr);
+        w->epoll_fd = epoll_create(1);
+        w->event_fd = eventfd(0, EFD_NONBLOCK);
+        if (w->epoll_fd == -1 || w->event_fd == -1) {
+            LOG_ERROR("AsyncDb failed to create epoll/eventfd", ERR_SYSTEM_CALL_FAIL);
+            return false;
+        }
+        struct epoll_event ev;
+        ev.events = EPOLLIN;
+        ev.data.u64 = (uint64_t)-1;  // eventfd 的标记
+        epoll_ctl(w->epoll_fd, EPOLL_CTL_ADD, w->event_fd, &ev);
+        for (int j = 0; j < conns_per_thread; j++) {
+            MyDb* db = new MyDb();
+            if (!db->initDB(host, user, pwd, db_name, port)) {
+                LOG_ERROR("AsyncDb failed to open connection", ERR_DB_CONNECTION_FAIL);
+                delete db;
+                return false;
+            }
+            w->slots.push_back(Slot{db, -1, SLOT_IDLE, Request(), ""});
+        }
+        workers.push_back(w);
+    }
+    for (Worker* w : workers) {
+        if (pthread_create(&w->tid, nullptr, run, w) != 0) {
+            LOG_ERROR("AsyncDb failed to create I/O thread", ERR_THREAD_CREATE_FAIL);
+            return false;
+        }
+    }
+    Metrics::getInstance()->gauge("chatroom_async_db_in_flight", "", [this] { return (long long)in_flight.load(); });
+    LOG_INFO(string("AsyncDb started: ") + to_string(threads) + " threads x " + to_string(conns_per_thread) +
+             " connections, " + (ASYNC_DB_NONBLOCKING ? "nonblocking" : "blocking fallback"));
+    return true;
+}
+
+inline void AsyncDb::stop() {
+    if (workers.empty()) {
+        return;
+    }
+    stopping = true;
+    for (Worker* w : workers) {
+        pthread_mutex_lock(&w->mutex);
+        pthread_cond_signal(&w->cond);
+        pthread_mutex_unlock(&w->mutex);
+        uint64_t one = 1;
+        write(w->event_fd, &one, sizeof(one));
+    }
+    for (Worker* w : workers) {
+        pthread_join(w->tid, nullptr);
+        // I/O线程已退出，剩下的语句不会再执行，以失败回调（此时再 submit 会直接失败，不会重新入队）
+        size_t dropped = 0;
+        for (Slot& slot : w->slots) {
+            if (slot.stage != SLOT_IDLE) {
+                DbResult result{false, {}, 0};
+                slot.stage = SLOT_IDLE;
+                complete(w, slot.req, result);
+                dropped++;
+            }
+        }
+        pthread_mutex_lock(&w->mutex);
+        deque<Request> rest;
+        rest.swap(w->queue);
+        pthread_mutex_unlock(&w->mutex);
+        for (Request& req : rest) {
+            DbResult result{false, {}, 0};
+            complete(w, req, result);
+            dropped++;
+        }
+        if (dropped > 0) {
+            LOG_WARN("AsyncDb stopped with " + to_string(dropped) + " statements not executed");
+        }
+        for (Slot& slot : w->slots) {
+            delete slot.db;
+        }
+        close(w->epoll_fd);
+        close(w->event_fd);
+        pthread_mutex_destroy(&w->mutex);
+        pthread_cond_destroy(&w->cond);
+        delete w;
+    }
+    workers.clear();
+}
+
+inline void AsyncDb::submit(const string& sql, const vector<DbParam>& params, DbCallback cb) {
+    if (workers.empty() || stopping) {
+        DbResult result{false, {}, 0};
+        cb(result);
+        return;
+    }
+    submitted++;
+    int cur = ++in_flight;
+    int peak = max_in_flight.load();
+    while (cur > peak && !max_in_flight.compare_exchange_weak(peak, cur)) {
+    }
+    Worker* w = workers[next_worker++ % workers.size()];
+    pthread_mutex_lock(&w->mutex);
+    w->queue.push_back(Request{sql, params, std::move(cb), nowUs(), Tracer::current()});
+    pthread_cond_signal(&w->cond);
+    pthread_mutex_unlock(&w->mutex);
+    uint64_t one = 1;
+    write(w->event_fd, &one, sizeof(one));
+}
+
+inline Histogram* AsyncDb::stmt_histogram(Worker* w, const string& sql) {
+    // 按模板（带?的语句）区分，格式化后的文本含参数，不能作为标签
+    Histogram*& h = w->stmt_hist[sql];
+    if (h == nullptr) {
+        h = Metrics::getInstance()->histogram("chatroom_async_db_us", Metrics::label("sql", sql));
+    }
+    return h;
+}
+
+inline void AsyncDb::complete(Worker* w, Request& req, DbResult& result) {
+    if (!result.ok) {
+        failed++;
+    }
+    long long elapsed = nowUs() - req.submit_us;
+    latency_us_total += elapsed;
+    stmt_histogram(w, req.sql)->record(elapsed);
+    in_flight--;
+    if (req.trace) {
+        req.trace->addDbCall(req.sql, Metrics::nowUs() - elapsed, elapsed);
+    }
+    if (req.cb) {
+        TraceScope scope(req.trace);
+        req.cb(result);
+    }
+}
+
+inline void* AsyncDb::run(void* arg) {
+    Worker* w = (Worker*)arg;
+#if ASYNC_DB_NONBLOCKING
+    w->owner->runNonblocking(w);
+#else
+    w->owner->runBlocking(w);
+#endif
+    return nullptr;
+}
+
+inline void AsyncDb::runBlocking(Worker* w) {
+    MyDb* db = w->slots[0].db;
+    while (1) {
+        pthread_mutex_lock(&w->mutex);
+        while (w->queue.empty() && !stopping) {
+            pthread_cond_wait(&w->cond, &w->mutex);
+        }
+        if (w->queue.empty()) {
+            pthread_mutex_unlock(&w->mutex);
+            break;
+        }
+        Request req = std::move(w->queue.front());
+        w->queue.pop_front();
+        pthread_mutex_unlock(&w->mutex);
+
+        DbResult result{false, {}, 0};
+        string text = db->format(req.sql, req.params);
+        result.ok = db->text_query(text, result.rows, &result.affected_rows);
+        if (!result.ok && !db->ping()) {
+            db->reconnect();
+        }
+        complete(w, req, result);
+    }
+}
+
+#if ASYNC_DB_NONBLOCKING
+inline void AsyncDb::watch(Worker* w, size_t idx) {
+    Slot& slot = w->slots[idx];
+    int fd = mysql_get_socket(slot.db->handle());
+    if (fd == slot.fd) {
+        return;
+    }
+    if (slot.fd != -1) {
+        epoll_ctl(w->epoll_fd, EPOLL_CTL_DEL, slot.fd, nullptr);
+    }
+    struct epoll_event ev;
+    ev.events = EPOLLIN;
+    ev.data.u64 = idx;
+    epoll_ctl(w->epoll_fd, EPOLL_CTL_ADD, fd, &ev);
+    slot.fd = fd;
+}
+
+inline void AsyncDb::finishSlot(Worker* w, Slot& slot, bool ok, MYSQL_RES* res) {
+    DbResult result{ok, {}, 0};
+    if (res != nullptr) {
+        MyDb::fetch_rows(res, result.rows);
+        mysql_free_result(res);
+    }
+    if (ok) {
+        result.affected_rows = mysql_affected_rows(slot.db->handle());
+    }
+    else {
+        LOG_DB_ERROR(slot.text, string("async query failed: ") + mysql_error(slot.db->handle()), ERR_DB_QUERY_FAIL);
+    }
+    Request req = std::move(slot.req);
+    slot.stage = SLOT_IDLE;
+    slot.text.clear();
+    complete(w, req, result);
+}
+
+inline void AsyncDb::advance(Worker* w, Slot& slot) {
+    MYSQL* h = slot.db->handle();
+    if (slot.stage == SLOT_QUERY) {
+        net_async_status st = mysql_real_query_nonblocking(h, slot.text.c_str(), slot.text.size());
+        if (st == NET_ASYNC_NOT_READY) {
+            return;
+        }
+        if (st == NET_ASYNC_ERROR) {
+            finishSlot(w, slot, false, nullptr);
+            if (!slot.db->ping()) {
+                slot.db->reconnect();
+                watch(w, &slot - &w->slots[0]);
+            }
+            return;
+        }
+        slot.stage = SLOT_STORE;
+    }
+    if (slot.stage == SLOT_STORE) {
+        MYSQL_RES* res = nullptr;
+        net_async_status st = mysql_store_result_nonblocking(h, &res);
+        if (st == NET_ASYNC_NOT_READY) {
+            return;
+        }
+        // 非 select 语句没有结果集，res 为空且 errno 为 0
+        bool ok = st != NET_ASYNC_ERROR && (res != nullptr || mysql_errno(h) == 0);
+        finishSlot(w, slot, ok, res);
+    }
+}
+
+inline void AsyncDb::runNonblocking(Worker* w) {
+    for (size_t i = 0; i < w->slots.size(); i++) {
+        watch(w, i);
+    }
+    struct epoll_event events[64];
+    while (!stopping) {
+        bool busy = false;
+        for (Slot& slot : w->slots) {
+            busy = busy || slot.stage != SLOT_IDLE;
+        }
+        int n = epoll_wait(w->epoll_fd, events, 64, busy ? ASYNC_DB_POLL_MS : -1);
+        if (n == -1 && errno != EINTR) {
+            LOG_ERROR("AsyncDb epoll_wait failed", ERR_EPOLL_WAIT_FAIL);
+            break;
+        }
+        for (int i = 0; i < n; i++) {
+            if (events[i].data.u64 == (uint64_t)-1) {
+                uint64_t tmp;
+                read(w->event_fd, &tmp, sizeof(tmp));
+                continue;
+            }
+            size_t idx = events[i].data.u64;
+            Slot& slot = w->slots[idx];
+            if (slot.stage != SLOT_IDLE) {
+                advance(w, slot);
+            }
+            else {
+                // 空闲连接可读说明服务端断开了它（如 wait_timeout），重连
+                LOG_WARN("AsyncDb connection dropped by server, reconnecting");
+                slot.db->reconnect();
+                watch(w, idx);
+            }
+        }
+        if (n == 0) {
+            // 超时：兜底推进所有在途查询（例如语句较长、发送时遇到写阻塞）
+            for (Slot& slot : w->slots) {
+                if (slot.stage != SLOT_IDLE) {
+                    advance(w, slot);
+                }
+            }
+        }
+        // 把排队的请求分给空闲连接
+        for (size_t i = 0; i < w->slots.size(); i++) {
+            Slot& slot = w->slots[i];
+            if (slot.stage != SLOT_IDLE) {
+                continue;
+            }
+            pthread_mutex_lock(&w->mutex);
+            if (w->queue.empty()) {
+                pthread_mutex_unlock(&w->mutex);
+                break;
+            }
+            slot.req = std::move(w->queue.front());
+            w->queue.pop_front();
+            pthread_mutex_unlock(&w->mutex);
+            slot.text = slot.db->format(slot.req.sql, slot.req.params);
+            slot.stage = SLOT_QUERY;
+            advance(w, slot);
+            watch(w, i);
+        }
+    }
+}
+#endif
+
+inline string AsyncDb::stats() {
+    unsigned long long total = submitted.load();
+    int pending = in_flight.load();
+    unsigned long long done = total - (pending > 0 ? pending : 0);
+    double avg_ms = done ? latency_us_total.load() / 1000.0 / done : 0.0;
+    return "submitted=" + to_string(total) + ", failed=" + to_string(failed.load()) +
+           ", in_flight=" + to_string(pending) + ", max_in_flight=" + to_string(max_in_flight.load()) +
+           ", avg_latency_ms=" + to_string(avg_ms);
+}
@@ -0,0 +1,206 @@
+#pragma once
+/**
+ * @file AuthExecutor.h
+ * @brief 登录/注册专用的有界执行器 - 密码哈希不再占用聊天消息的工作线程
+ *
+ * sign_in / sign_up 需要做 MD5-crypt 哈希并访问数据库，重连风暴时会大量涌入。
+ * 这些任务交给独立的少量线程执行：
+ * - 并发数（线程数）和排队上限可配置，排队已满时 submit 直接返回false，
+ *   由调用方回复"服务器繁忙"（削峰）；
+ * - 任务出队时已经排队超过 max_wait_ms 的不再执行，调用 on_shed 回复繁忙，
+ *   客户端多半已经超时重试，没必要再做一次哈希；
+ * - 哈希使用可重入的 crypt_r，每个线程一份 crypt_data；
+ * - 记录排队时间、执行时间、拒绝和丢弃次数，stats() 输出；
+ * - 提交时线程上的追踪（Trace）随任务保存，执行时恢复。
+ */
+
+#include <deque>
+#include <vector>
+#include <string>
+#include <atomic>
+#include <cstring>
+#include <functional>
+#include <pthread.h>
+#include <sys/time.h>
+#include <crypt.h>
+#include "Logger.h"
+#include "ErrorCode.h"
+#include "Trace.h"
+
+using namespace std;
+
+#define AUTH_THREADS 4          // 默认并发数
+#define AUTH_QUEUE_MAX 256      // 排队上限
+#define AUTH_MAX_WAIT_MS 3000   // 排队超过该时间的任务直接丢弃
+
+class AuthExecutor {
+private:
+    struct Job {
+        function<void()> run;
+        function<void()> on_shed;
+        long long enqueue_us;
+        shared_ptr<Trace> trace;
+    };
+    deque<Job> queue;
+    vector<pthread_t> threads;
+    pthread_mutex_t mutex;
+    pthread_cond_t cond;
+    size_t queue_max;
+    int max_wait_ms;
+    bool stopping;
+
+    atomic<unsigned long long> submitted;
+    atomic<unsigned long long> rejected;     // 排队已满被拒绝
+    atomic<unsigned long long> shed;         // 排队超时被丢弃
+    atomic<unsigned long long> completed;
+    atomic<unsigned long long> wait_us_total;
+    atomic<unsigned long long> wait_us_max;
+    atomic<unsigned long long> run_us_total;
+
+    static long long nowUs() {
+        struct timeval tv;
+        gettimeofday(&tv, nullptr);
+        return tv.tv_sec * 1000000LL + tv.tv_usec;
+    }
+
+    static void* worker(void* arg);
+
+public:
+    AuthExecutor(size_t queue_limit = AUTH_QUEUE_MAX, int max_wait = AUTH_MAX_WAIT_MS)
+        : queue_max(queue_limit), max_wait_ms(max_wait), stopping(false), submitted(0), rejected(0), shed(0),
+          completed(0), wait_us_total(0), wait_us_max(0), run_us_total(0) {
+        pthread_mutex_init(&mutex, nullptr);
+        pthread_cond_init(&cond, nullptr);
+    }
+
+    ~AuthExecutor() {
+        stop();
+        pthread_mutex_destroy(&mutex);
+        pthread_cond_destroy(&cond);
+    }
+
+    /**
+     * @brief 启动执行线程
+     * @param concurrency 同时执行的认证任务数
+     */
+    bool start(int concurrency = AUTH_THREADS);
+
+    void stop();
+
+    /**
+     * @brief 提交一个认证任务（任意线程）
+     * @param run 任务本体
+     * @param on_shed 任务排队超时被丢弃时调用（在执行线程中）
+     * @return 排队已满返回false，任务不会执行
+     */
+    bool submit(function<void()> run, function<void()> on_shed);
+
+    /**
+     * @brief 可重入的 crypt（每个线程一份 crypt_data）
+     */
+    static string hash(const string& password, const string& salt);
+
+    string stats();
+};
+
+inline bool AuthExecutor::start(int concurrency) {
+    if (concurrency < 1) {
+        concurrency = 1;
+    }
+    for (int i = 0; i < concurrency; i++) {
+        pthread_t tid;
+        if (pthread_create(&tid, nullptr, worker, this) != 0) {
+            LOG_ERROR("AuthExecutor failed to create worker " + to_string(i), ERR_THREAD_CREATE_FAIL);
+            return false;
+        }
+        threads.push_back(tid);
+    }
+    LOG_INFO("AuthExecutor started: " + to_string(concurrency) + " threads, queue limit " + to_string(queue_max));
+    return true;
+}
+
+inline void AuthExecutor::stop() {
+    pthread_mutex_lock(&mutex);
+    stopping = true;
+    pthread_cond_broadcast(&cond);
+    pthread_mutex_unlock(&mutex);
+    for (pthread_t tid : threads) {
+        pthread_join(tid, nullptr);
+    }
+    threads.clear();
+}
+
+inline bool AuthExecutor::submit(function<void()> run, function<void()> on_shed) {
+    pthread_mutex_lock(&mutex);
+    if (queue.size() >= queue_max) {
+        pthread_mutex_unlock(&mutex);
+        rejected++;
+        return false;
+    }
+    queue.push_back(Job{std::move(run), std::move(on_shed), nowUs(), Tracer::current()});
+    pthread_cond_signal(&cond);
+    pthread_mutex_unlock(&mutex);
+    submitted++;
+    return true;
+}
+
+inline void* AuthExecutor::worker(void* arg) {
+    AuthExecutor* ex = (AuthExecutor*)arg;
+    while (1) {
+        pthread_mutex_lock(&ex->mutex);
+        while (ex->queue.empty() && !ex->stopping) {
+            pthread_cond_wait(&ex->cond, &ex->mutex);
+        }
+        if (ex->queue.empty()) {
+            pthread_mutex_unlock(&ex->mutex);
+            break;
+        }
+        Job job = std::move(ex->queue.front());
+        ex->queue.pop_front();
+        pthread_mutex_unlock(&ex->mutex);
+
+        TraceScope scope(job.trace);
+        long long start = nowUs();
+        unsigned long long waited = start - job.enqueue_us;
+        ex->wait_us_total += waited;
+        unsigned long long cur = ex->wait_us_max.load();
+        while (waited > cur && !ex->wait_us_max.compare_exchange_weak(cur, waited)) {
+        }
+        if (waited > (unsigned long long)ex->max_wait_ms * 1000ULL) {
+            ex->shed++;
+            if (job.on_shed) {
+                job.on_shed();
+            }
+            continue;
+        }
+        job.run();
+        ex->run_us_total += nowUs() - start;
+        ex->completed++;
+    }
+    return nullptr;
+}
+
+inline string AuthExecutor::hash(const string& password, const string& salt) {
+    static thread_local struct crypt_data data;
+    static thread_local bool initialized = false;
+    if (!initialized) {
+        memset(&data, 0, sizeof(data));
+        initialized = true;
+    }
+    const char* res = crypt_r(password.c_str(), salt.c_str(), &data);
+    return res ? string(res) : string();
+}
+
+inline string AuthExecutor::stats() {
+    pthread_mutex_lock(&mutex);
+    size_t pending = queue.size();
+    pthread_mutex_unlock(&mutex);
+    unsigned long long started = completed.load() + shed.load();
+    double avg_wait_ms = started ? wait_us_total.load() / 1000.0 / started : 0.0;
+    double avg_run_ms = completed.load() ? run_us_total.load() / 1000.0 / completed.load() : 0.0;
+    return "threads=" + to_string(threads.size()) + ", queued=" + to_string(pending) +
+           ", submitted=" + to_string(submitted.load()) + ", rejected=" + to_string(rejected.load()) +
+           ", shed=" + to_string(shed.load()) + ", completed=" + to_string(completed.load()) +
+           ", avg_wait_ms=" + to_string(avg_wait_ms) + ", max_wait_ms=" + to_string(wait_us_max.load() / 1000.0) +
+           ", avg_run_ms=" + to_string(avg_run_ms);
+}
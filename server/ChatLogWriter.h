@@ -0,0 +1,345 @@
+#pragma once
+/**
+ * @file ChatLogWriter.h
+ * @brief 聊天记录异步批量持久化（write-behind）
+ *
+ * 工作线程不再为每条投递的消息同步执行 insert into chat_log 和
+ * update user_status set last_active，而是把记录交给 ChatLogWriter 后立即返回。
+ * 后台写线程持有独立的数据库连接，攒够 batch_size 条或等待 flush_interval_ms
+ * 后，在一个事务中用多行 INSERT 写入 chat_log；同一批次内对同一用户的
+ * last_active 更新合并为一条 UPDATE ... WHERE user_id IN (...)。
+ *
+ * 在线状态（user_status.is_online）也经由这里批量写回：连接的存活由事件循环
+ * 在内存中判断，上线/下线只记录每个用户最后一次的状态，刷盘时按状态合并成
+ * 两条 UPDATE。所有状态变更走同一个队列，因此同一用户先下线后上线的顺序不会颠倒。
+ *
+ * 待写队列有上限，数据库长时间不可用时 append() 会阻塞调用方（背压），
+ * 避免内存无限增长。
+ *
+ * 写入失败时不丢弃整批数据：
+ * - 每次刷盘前 ping 连接，断开（wait_timeout、MySQL 重启）时先重连；
+ * - 事务失败后重连并整批重试一次；
+ * - 仍然失败且连接不可用时，整批放回队列头部，CHAT_LOG_RETRY_MS 后再试；
+ * - 连接可用说明是数据本身的问题（如外键不满足），拆开逐条写入，
+ *   有问题的记录只影响它自己。
+ */
+
+#include <string>
+#include <vector>
+#include <unordered_set>
+#include <unordered_map>
+#include <iterator>
+#include <pthread.h>
+#include <sys/time.h>
+#include <unistd.h>
+#include "MyDb.h"
+
+using namespace std;
+
+#define CHAT_LOG_BATCH_SIZE 256       // 达到该条数立即刷盘
+#define CHAT_LOG_FLUSH_MS 100         // 最长攒批时间
+#define CHAT_LOG_MAX_PENDING 100000   // 待写记录上限，超过后 append 阻塞
+#define CHAT_LOG_ROWS_PER_INSERT 500  // 单条 INSERT 语句最多携带的行数
+#define CHAT_LOG_INSERT_BYTES (1024 * 1024)  // 单条 INSERT 语句的字节上限，远低于 max_allowed_packet（5.7 默认4MB）
+#define CHAT_LOG_RETRY_MS 1000        // 数据库不可用时，放回队列的批次过多久再重试
+
+// 一条待写入 chat_log 的记录
+struct ChatRecord {
+    int sender_id;
+    int receiver_id;
+    bool delivered;
+    string group_type;  // single / multi / broadcast
+    string content;
+};
+
+class ChatLogWriter {
+private:
+    MyDb db;
+    vector<ChatRecord> records;      // 待写入的聊天记录
+    unordered_set<int> active_users; // 待更新 last_active 的用户（已去重）
+    unordered_map<int, bool> online_changes; // 待写回的在线状态，user_id -> 是否在线
+    pthread_mutex_t mutex;
+    pthread_cond_t cond;             // 有新数据或需要退出
+    pthread_cond_t space_cond;       // 队列有空位
+    pthread_t tid;
+    bool running;
+    bool stopping;
+
+    static void* run(void* arg);
+    bool flush(vector<ChatRecord>& batch, unordered_set<int>& users, unordered_map<int, bool>& online);
+    bool flushOnce(const vector<ChatRecord>& batch, const unordered_set<int>& users, const unordered_map<int, bool>& online);
+    void flushEach(const vector<ChatRecord>& batch, const unordered_set<int>& users, const unordered_map<int, bool>& online);
+    void requeue(vector<ChatRecord>& batch, unordered_set<int>& users, unordered_map<int, bool>& online);
+    bool ensureConnected();
+    bool updateUsers(const string& sql_prefix, const vector<int>& ids);
+    bool insertRecords(const vector<ChatRecord>& batch, size_t begin, size_t end);
+
+public:
+    ChatLogWriter() : running(false), stopping(false) {
+        pthread_mutex_init(&mutex, nullptr);
+        pthread_cond_init(&cond, nullptr);
+        pthread_cond_init(&space_cond, nullptr);
+    }
+
+    ~ChatLogWriter() {
+        stop();
+        pthread_mutex_destroy(&mutex);
+        pthread_cond_destroy(&cond);
+        pthread_cond_destroy(&space_cond);
+    }
+
+    /**
+     * @brief 连接数据库并启动写线程
+     */
+    bool start(const string& host, const string& user, const string& pwd, const string& db_name, int port);
+
+    /**
+     * @brief 停止写线程（退出前会把剩余数据写完）
+     */
+    void stop();
+
+    /**
+     * @brief 提交一条聊天记录
+     */
+    void append(ChatRecord record);
+
+    /**
+     * @brief 标记用户活跃，last_active 在下次刷盘时更新
+     */
+    void touch(int user_id);
+
+    /**
+     * @brief 记录用户上线/下线，在下次刷盘时批量写回 is_online
+     */
+    void setOnline(int user_id, bool online);
+};
+
+inline bool ChatLogWriter::start(const string& host, const string& user, const string& pwd, const string& db_name, int port) {
+    if (!db.initDB(host, user, pwd, db_name, port)) {
+        LOG_ERROR("ChatLogWriter failed to connect database", ERR_DB_CONNECTION_FAIL);
+        return false;
+    }
+    // 在线状态以内存中的连接为准，启动时清掉上次运行遗留的在线标记
+    db.stmt_execute("update user_status set is_online=0 where is_online=1", {});
+    running = true;
+    if (pthread_create(&tid, nullptr, run, this) != 0) {
+        LOG_ERROR("ChatLogWriter failed to create writer thread", ERR_THREAD_CREATE_FAIL);
+        running = false;
+        return false;
+    }
+    return true;
+}
+
+inline void ChatLogWriter::stop() {
+    pthread_mutex_lock(&mutex);
+    if (!running) {
+        pthread_mutex_unlock(&mutex);
+        return;
+    }
+    stopping = true;
+    pthread_cond_signal(&cond);
+    pthread_mutex_unlock(&mutex);
+    pthread_join(tid, nullptr);
+    running = false;
+}
+
+inline void ChatLogWriter::append(ChatRecord record) {
+    pthread_mutex_lock(&mutex);
+    while (records.size() >= CHAT_LOG_MAX_PENDING && !stopping) {
+        pthread_cond_wait(&space_cond, &mutex);
+    }
+    records.push_back(std::move(record));
+    if (records.size() >= CHAT_LOG_BATCH_SIZE) {
+        pthread_cond_signal(&cond);
+    }
+    pthread_mutex_unlock(&mutex);
+}
+
+inline void ChatLogWriter::touch(int user_id) {
+    if (user_id < 0) {
+        return;
+    }
+    pthread_mutex_lock(&mutex);
+    active_users.insert(user_id);
+    pthread_mutex_unlock(&mutex);
+}
+
+inline void ChatLogWriter::setOnline(int user_id, bool online) {
+    if (user_id < 0) {
+        return;
+    }
+    pthread_mutex_lock(&mutex);
+    online_changes[user_id] = online;
+    pthread_mutex_unlock(&mutex);
+}
+
+inline void* ChatLogWriter::run(void* arg) {
+    ChatLogWriter* writer = (ChatLogWriter*)arg;
+    vector<ChatRecord> batch;
+    unordered_set<int> users;
+    unordered_map<int, bool> online;
+    while (1) {
+        pthread_mutex_lock(&writer->mutex);
+        if (!writer->stopping && writer->records.size() < CHAT_LOG_BATCH_SIZE) {
+            // 等到攒够一批或超时
+            struct timeval now;
+            gettimeofday(&now, nullptr);
+            struct timespec deadline;
+            long nsec = now.tv_usec * 1000L + CHAT_LOG_FLUSH_MS * 1000000L;
+            deadline.tv_sec = now.tv_sec + nsec / 1000000000L;
+            deadline.tv_nsec = nsec % 1000000000L;
+            pthread_cond_timedwait(&writer->cond, &writer->mutex, &deadline);
+        }
+        batch.swap(writer->records);
+        users.swap(writer->active_users);
+        online.swap(writer->online_changes);
+        bool exiting = writer->stopping;
+        pthread_cond_broadcast(&writer->space_cond);
+        pthread_mutex_unlock(&writer->mutex);
+
+        bool retry_later = false;
+        if (!batch.empty() || !users.empty() || !online.empty()) {
+            retry_later = !writer->flush(batch, users, online);
+            batch.clear();
+            users.clear();
+            online.clear();
+        }
+        if (exiting) {
+            if (retry_later) {
+                pthread_mutex_lock(&writer->mutex);
+                LOG_ERROR("ChatLogWriter stopping with database unavailable, dropped " +
+                          to_string(writer->records.size()) + " records", ERR_DB_CONNECTION_FAIL);
+                pthread_mutex_unlock(&writer->mutex);
+            }
+            break;
+        }
+        if (retry_later) {
+            usleep(CHAT_LOG_RETRY_MS * 1000);
+        }
+    }
+    return nullptr;
+}
+
+// 写入 batch[begin, end)，按行数和语句字节数切成多条 INSERT（单行超过字节上限时独占一条）
+inline bool ChatLogWriter::insertRecords(const vector<ChatRecord>& batch, size_t begin, size_t end) {
+    string sql;
+    size_t rows = 0;
+    for (size_t i = begin; i < end; i++) {
+        const ChatRecord& r = batch[i];
+        string row = "(" + to_string(r.sender_id) + "," + to_string(r.receiver_id) + "," +
+                     (r.delivered ? "1" : "0") + ",'" + db.escape(r.group_type) + "','" +
+                     db.escape(r.content) + "')";
+        if (rows > 0 && (rows == CHAT_LOG_ROWS_PER_INSERT || sql.size() + 1 + row.size() > CHAT_LOG_INSERT_BYTES)) {
+            if (!db.exeSQL(sql)) {
+                return false;
+            }
+            rows = 0;
+        }
+        if (rows == 0) {
+            sql = "insert into chat_log (sender_id,receiver_id,is_delivered,group_type,content) values ";
+        }
+        else {
+            sql += ",";
+        }
+        sql += row;
+        rows++;
+    }
+    return rows == 0 || db.exeSQL(sql);
+}
+
+inline bool ChatLogWriter::updateUsers(const string& sql_prefix, const vector<int>& ids) {
+    if (ids.empty()) {
+        return true;
+    }
+    string sql = sql_prefix + " where user_id in (";
+    for (size_t i = 0; i < ids.size(); i++) {
+        if (i) {
+            sql += ",";
+        }
+        sql += to_string(ids[i]);
+    }
+    sql += ")";
+    return db.exeSQL(sql);
+}
+
+inline bool ChatLogWriter::ensureConnected() {
+    if (db.ping()) {
+        return true;
+    }
+    LOG_WARN("ChatLogWriter database connection lost, reconnecting");
+    return db.reconnect();
+}
+
+// 在一个事务中写入整批数据，失败时回滚
+inline bool ChatLogWriter::flushOnce(const vector<ChatRecord>& batch, const unordered_set<int>& users,
+                                     const unordered_map<int, bool>& online) {
+    if (!db.exeSQL("start transaction")) {
+        return false;
+    }
+    vector<int> went_online, went_offline;
+    for (auto& it : online) {
+        (it.second ? went_online : went_offline).push_back(it.first);
+    }
+    bool ok = insertRecords(batch, 0, batch.size()) &&
+              updateUsers("update user_status set last_active = NOW()", vector<int>(users.begin(), users.end())) &&
+              updateUsers("update user_status set is_online = 1, last_active = NOW()", went_online) &&
+              updateUsers("update user_status set is_online = 0", went_offline);
+    if (ok && db.exeSQL("commit")) {
+        return true;
+    }
+    db.exeSQL("rollback");
+    return false;
+}
+
+// 连接正常但整批写入失败：状态更新单独提交，聊天记录逐条写入，只丢弃写不进去的记录
+inline void ChatLogWriter::flushEach(const vector<ChatRecord>& batch, const unordered_set<int>& users,
+                                     const unordered_map<int, bool>& online) {
+    if ((!users.empty() || !online.empty()) && !flushOnce(vector<ChatRecord>(), users, online)) {
+        LOG_ERROR("ChatLogWriter dropped " + to_string(users.size()) + " last_active and " + to_string(online.size()) +
+                  " status updates", ERR_DB_TRANSACTION_FAIL);
+    }
+    size_t dropped = 0;
+    for (size_t i = 0; i < batch.size(); i++) {
+        if (!insertRecords(batch, i, i + 1)) {
+            dropped++;
+            LOG_ERROR("ChatLogWriter dropped record: sender_id=" + to_string(batch[i].sender_id) +
+                      ", receiver_id=" + to_string(batch[i].receiver_id) + ", type=" + batch[i].group_type,
+                      ERR_DB_EXECUTE_FAIL);
+        }
+    }
+    LOG_WARN("ChatLogWriter wrote batch row by row: " + to_string(batch.size() - dropped) + " written, " +
+             to_string(dropped) + " dropped");
+}
+
+// 放回队列头部，保持与之后提交的数据的先后顺序；之后的在线状态变化比放回的新，不覆盖
+inline void ChatLogWriter::requeue(vector<ChatRecord>& batch, unordered_set<int>& users,
+                                   unordered_map<int, bool>& online) {
+    pthread_mutex_lock(&mutex);
+    records.insert(records.begin(), make_move_iterator(batch.begin()), make_move_iterator(batch.end()));
+    active_users.insert(users.begin(), users.end());
+    for (auto& it : online) {
+        online_changes.emplace(it.first, it.second);
+    }
+    pthread_mutex_unlock(&mutex);
+}
+
+/**
+ * @return 数据库不可用、数据已放回队列时返回false，调用方稍后重试
+ */
+inline bool ChatLogWriter::flush(vector<ChatRecord>& batch, unordered_set<int>& users, unordered_map<int, bool>& online) {
+    for (int attempt = 0; attempt < 2; attempt++) {
+        if (ensureConnected() && flushOnce(batch, users, online)) {
+            LOG_DEBUG("ChatLogWriter flushed " + to_string(batch.size()) + " records, " + to_string(users.size()) +
+                      " active users, " + to_string(online.size()) + " status changes");
+            return true;
+        }
+    }
+    if (!db.ping()) {
+        LOG_ERROR("ChatLogWriter database unavailable, keeping " + to_string(batch.size()) + " records for retry",
+                  ERR_DB_CONNECTION_FAIL);
+        requeue(batch, users, online);
+        return false;
+    }
+    flushEach(batch, users, online);
+    return true;
+}
@@ -0,0 +1,135 @@
+#pragma once
+/**
+ * @file Compression.h
+ * @brief 每连接的 deflate 压缩 - 大的响应压缩后发送，压缩窗口在连接内保留
+ *
+ * 客户端发送 "hello|2|deflate" 协商压缩，服务器回复 "hello|1|2;deflate" 后，
+ * 发往该连接、编码后超过 PROTOCOL_DEFLATE_THRESHOLD 的消息整体压缩，
+ * 长度字段置 PROTOCOL_COMPRESSED_FLAG（压缩后仍可能拆成续帧，每个分片都带该标志）。
+ *
+ * 每个连接一个压缩流（raw deflate），消息之间用 Z_SYNC_FLUSH 结束而不重置，
+ * 之前发过的用户名、时间戳等留在滑动窗口中作为后续消息的字典，重复内容压缩率更高。
+ * 因此压缩后的消息必须按压缩顺序全部送达：压缩只在连接所属的事件循环线程、
+ * 追加到发送队列时进行；客户端收到第一条压缩消息时创建解压流，之后一直复用。
+ */
+
+#include <string>
+#include <cstring>
+#include <zlib.h>
+
+using namespace std;
+
+#define PROTOCOL_DEFLATE_THRESHOLD 256  // 编码后超过该字节数的消息才压缩
+#define DEFLATE_WINDOW_BITS 12          // 服务器压缩窗口 4KB，控制每个连接的内存
+#define DEFLATE_MEM_LEVEL 5
+#define INFLATE_WINDOW_BITS 15          // 解压窗口取最大值，兼容任意压缩窗口
+
+/**
+ * @class Deflater
+ * @brief 保留上下文的 raw deflate 压缩流（非线程安全）
+ */
+class Deflater {
+private:
+    z_stream zs;
+    bool ok;
+
+public:
+    Deflater() {
+        memset(&zs, 0, sizeof(zs));
+        ok = deflateInit2(&zs, Z_DEFAULT_COMPRESSION, Z_DEFLATED, -DEFLATE_WINDOW_BITS,
+                          DEFLATE_MEM_LEVEL, Z_DEFAULT_STRATEGY) == Z_OK;
+    }
+
+    Deflater(const Deflater&) = delete;
+    Deflater& operator=(const Deflater&) = delete;
+
+    ~Deflater() {
+        if (ok) {
+            deflateEnd(&zs);
+        }
+    }
+
+    /**
+     * @brief 压缩一条消息追加到 out 末尾（以 Z_SYNC_FLUSH 结束，接收方可立即完整解出）
+     * @return 失败后流状态不再可靠，调用方应停止压缩
+     */
+    bool compress(const char* data, size_t len, string& out) {
+        if (!ok) {
+            return false;
+        }
+        zs.next_in = (Bytef*)data;
+        zs.avail_in = len;
+        size_t start = out.size();
+        do {
+            size_t used = out.size() - start;
+            out.resize(start + used + deflateBound(&zs, zs.avail_in) + 16);
+            zs.next_out = (Bytef*)&out[start + used];
+            zs.avail_out = out.size() - start - used;
+            if (deflate(&zs, Z_SYNC_FLUSH) == Z_STREAM_ERROR) {
+                ok = false;
+                out.resize(start);
+                return false;
+            }
+            out.resize(out.size() - zs.avail_out);
+        } while (zs.avail_out == 0);
+        return true;
+    }
+};
+
+/**
+ * @class Inflater
+ * @brief 与 Deflater 对应的解压流（非线程安全）
+ */
+class Inflater {
+private:
+    z_stream zs;
+    bool ok;
+
+public:
+    Inflater() {
+        memset(&zs, 0, sizeof(zs));
+        ok = inflateInit2(&zs, -INFLATE_WINDOW_BITS) == Z_OK;
+    }
+
+    Inflater(const Inflater&) = delete;
+    Inflater& operator=(const Inflater&) = delete;
+
+    ~Inflater() {
+        if (ok) {
+            inflateEnd(&zs);
+        }
+    }
+
+    /**
+     * @brief 解压一条消息
+     * @param max_len 解压后的长度上限，超出视为失败
+     */
+    bool decompress(const char* data, size_t len, string& out, size_t max_len) {
+        if (!ok) {
+            return false;
+        }
+        out.clear();
+        zs.next_in = (Bytef*)data;
+        zs.avail_in = len;
+        char chunk[4096];
+        do {
+            zs.next_out = (Bytef*)chunk;
+            zs.avail_out = sizeof(chunk);
+            int ret = inflate(&zs, Z_SYNC_FLUSH);
+            if (ret != Z_OK && ret != Z_BUF_ERROR) {
+                ok = false;
+                return false;
+            }
+            size_t produced = sizeof(chunk) - zs.avail_out;
+            if (out.size() + produced > max_len) {
+                ok = false;
+                return false;
+            }
+            out.append(chunk, produced);
+            if (ret == Z_BUF_ERROR) {
+                break;  // 没有更多可解出的数据
+            }
+        } while (zs.avail_in > 0 || zs.avail_out == 0);
+        return true;
+    }
+};
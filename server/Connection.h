@@ -0,0 +1,282 @@
+#pragma once
+/**
+ * @file Connection.h
+ * @brief 连接表 - 按fd索引的连接槽，接收缓冲区和连接对象都来自 slab
+ *
+ * 每个连接的状态（接收缓冲区、发送队列）放在一个 Connection 对象里，
+ * 通过 fd 直接索引，只由连接所属的事件循环线程访问，因此不需要全局锁。
+ *
+ * 内存只分配给活跃的连接：
+ * - Connection 对象在 accept 时从所属循环的 Slab 中取出，关闭时归还复用；
+ * - 接收缓冲区按需从 BlockPool 借一个固定大小的块，收到的数据全部解析完
+ *   （缓冲区为空）就立即归还，空闲连接不占用接收缓冲区。
+ *
+ * 接收缓冲区按偏移量（head/tail）管理：直接 recv 到 tail 处，解析时只移动
+ * head，不再为每一帧 memmove 剩余数据；只有块尾部不够放下一帧时，才把
+ * 尚未解析完的半帧挪到块首（最多 PROTOCOL_MAX_TOTAL_SIZE 字节）。
+ *
+ * 超过单帧上限的消息以续帧发送，分片由 Reassembly 逐帧拼接到同一个 BlockPool
+ * 借来的块中，每个连接最多占用 PROTOCOL_MAX_ASSEMBLED_SIZE 字节；超出预算的
+ * 消息丢弃其余分片并回复错误，连接本身不受影响。
+ */
+
+#include <vector>
+#include <cstring>
+#include <string>
+#include <algorithm>
+#include <new>
+#include <memory>
+#include "Protocol.h"
+#include "OutQueue.h"
+#include "Compression.h"
+
+using namespace std;
+
+#define SLAB_CHUNK_ITEMS 256  // 每次向系统申请的对象/块数量
+
+/**
+ * @class Slab
+ * @brief 固定类型对象的简单 slab 分配器（非线程安全，每个事件循环一个）
+ *
+ * 按块批量申请内存，释放的对象挂到空闲链表上复用，不归还给系统。
+ */
+template <typename T>
+class Slab {
+private:
+    union Slot {
+        Slot* next;
+        alignas(T) char storage[sizeof(T)];
+    };
+    vector<Slot*> chunks;
+    Slot* free_list;
+    size_t in_use;
+
+    void grow() {
+        Slot* chunk = static_cast<Slot*>(::operator new(sizeof(Slot) * SLAB_CHUNK_ITEMS));
+        chunks.push_back(chunk);
+        for (size_t i = 0; i < SLAB_CHUNK_ITEMS; i++) {
+            chunk[i].next = free_list;
+            free_list = &chunk[i];
+        }
+    }
+
+public:
+    Slab() : free_list(nullptr), in_use(0) {}
+
+    Slab(const Slab&) = delete;
+    Slab& operator=(const Slab&) = delete;
+
+    ~Slab() {
+        for (Slot* chunk : chunks) {
+            ::operator delete(chunk);
+        }
+    }
+
+    T* create() {
+        if (free_list == nullptr) {
+            grow();
+        }
+        Slot* slot = free_list;
+        free_list = slot->next;
+        in_use++;
+        return new (slot->storage) T();
+    }
+
+    void destroy(T* obj) {
+        obj->~T();
+        Slot* slot = reinterpret_cast<Slot*>(obj);
+        slot->next = free_list;
+        free_list = slot;
+        in_use--;
+    }
+
+    size_t size() const {
+        return in_use;
+    }
+};
+
+/**
+ * @class BlockPool
+ * @brief 固定大小（PROTOCOL_MAX_TOTAL_SIZE）接收缓冲块的池（非线程安全）
+ */
+class BlockPool {
+private:
+    struct Block {
+        char data[PROTOCOL_MAX_TOTAL_SIZE];
+    };
+    Slab<Block> slab;
+public:
+    char* alloc() {
+        return slab.create()->data;
+    }
+
+    void release(char* data) {
+        slab.destroy(reinterpret_cast<Block*>(data));
+    }
+
+    size_t size() const {
+        return slab.size();
+    }
+};
+
+/**
+ * @class RecvBuffer
+ * @brief 基于偏移量的接收缓冲区，块按需从 BlockPool 借用
+ */
+class RecvBuffer {
+private:
+    char* data;   // nullptr 表示当前没有借用块
+    size_t head;  // 下一个待解析字节
+    size_t tail;  // 已接收数据的末尾
+public:
+    RecvBuffer() : data(nullptr), head(0), tail(0) {}
+
+    /**
+     * @brief 准备写入空间，返回可写位置
+     * @param avail 输出可写字节数；为0说明块内是一条超长的不完整消息
+     */
+    char* writable(BlockPool& pool, size_t& avail) {
+        if (data == nullptr) {
+            data = pool.alloc();
+            head = tail = 0;
+        }
+        else if (tail == PROTOCOL_MAX_TOTAL_SIZE && head > 0) {
+            // 块尾部已满，把剩余的半帧挪到块首
+            memmove(data, data + head, tail - head);
+            tail -= head;
+            head = 0;
+        }
+        avail = PROTOCOL_MAX_TOTAL_SIZE - tail;
+        return data + tail;
+    }
+
+    void produced(size_t n) {
+        tail += n;
+    }
+
+    const char* readable() const {
+        return data + head;
+    }
+
+    size_t readableBytes() const {
+        return tail - head;
+    }
+
+    /**
+     * @brief 标记已解析的字节；缓冲区读空时把块还给 pool
+     */
+    void consume(BlockPool& pool, size_t n) {
+        head += n;
+        if (head == tail) {
+            release(pool);
+        }
+    }
+
+    void release(BlockPool& pool) {
+        if (data != nullptr) {
+            pool.release(data);
+            data = nullptr;
+        }
+        head = tail = 0;
+    }
+};
+
+/**
+ * @class Reassembly
+ * @brief 续帧的增量拼接，分片数据存放在从 BlockPool 借来的块中
+ *
+ * 每个块存放 PROTOCOL_MAX_TOTAL_SIZE 字节，合计超过预算后进入丢弃状态：
+ * 不再保存后续分片，直到最后一帧到达，由调用方回复错误。
+ */
+class Reassembly {
+private:
+    vector<char*> blocks;
+    size_t total;     // 已保存的字节数
+    size_t budget;
+    bool active;      // 正在拼接一条消息
+    bool overflow;    // 超出预算，正在丢弃剩余分片
+    string head_;     // 第一个分片的开头，用于生成错误回复
+
+public:
+    Reassembly() : total(0), budget(PROTOCOL_MAX_ASSEMBLED_SIZE), active(false), overflow(false) {}
+
+    Reassembly(const Reassembly&) = delete;
+    Reassembly& operator=(const Reassembly&) = delete;
+
+    bool inProgress() const {
+        return active;
+    }
+
+    bool overflowed() const {
+        return overflow;
+    }
+
+    const string& head() const {
+        return head_;
+    }
+
+    /**
+     * @brief 追加一个分片
+     */
+    void append(BlockPool& pool, const char* data, size_t len) {
+        if (!active) {
+            active = true;
+            head_.assign(data, min(len, (size_t)64));
+        }
+        if (overflow) {
+            return;
+        }
+        if (total + len > budget) {
+            release(pool);  // 提前归还已占用的块
+            active = true;
+            overflow = true;
+            return;
+        }
+        while (len > 0) {
+            size_t offset = total % PROTOCOL_MAX_TOTAL_SIZE;
+            if (offset == 0) {
+                blocks.push_back(pool.alloc());
+            }
+            size_t n = min(len, (size_t)PROTOCOL_MAX_TOTAL_SIZE - offset);
+            memcpy(blocks.back() + offset, data, n);
+            data += n;
+            len -= n;
+            total += n;
+        }
+    }
+
+    /**
+     * @brief 取出拼接好的消息（最后一个分片已追加），并归还所有块
+     */
+    void take(BlockPool& pool, string& message) {
+        message.clear();
+        message.reserve(total);
+        size_t left = total;
+        for (char* block : blocks) {
+            size_t n = min(left, (size_t)PROTOCOL_MAX_TOTAL_SIZE);
+            message.append(block, n);
+            left -= n;
+        }
+        release(pool);
+    }
+
+    void release(BlockPool& pool) {
+        for (char* block : blocks) {
+            pool.release(block);
+        }
+        blocks.clear();
+        total = 0;
+        active = false;
+        overflow = false;
+    }
+};
+
+/**
+ * @brief 一个客户端连接在事件循环中的全部状态
+ */
+struct Connection {
+    RecvBuffer recv_buf;  // 接收缓冲区（处理粘包/拆包）
+    Reassembly partial;   // 正在拼接的续帧消息
+    OutQueue out;         // 发送队列
+    unique_ptr<Deflater> deflater;  // 协商了压缩后，第一条需要压缩的消息到来时创建
+};
@@ -0,0 +1,363 @@
+#pragma once
+/**
+ * @file DbPool.h
+ * @brief 数据库连接池 - 与工作线程解耦的弹性连接池
+ *
+ * 连接只借给真正需要访问数据库的处理阶段，用完立即归还：
+ * - acquire(timeout) 在没有空闲连接且已达上限时按先来先服务（FIFO）排队等待，
+ *   归还的连接直接交给队首的等待者，超时返回 nullptr 由调用方回复"服务器繁忙"；
+ * - 连接数在 [min_size, max_size] 之间弹性伸缩：不够用时新建，空闲超过
+ *   DB_POOL_IDLE_SHRINK_SEC 的多余连接由后台线程关闭；
+ * - 后台线程定期对空闲连接 ping，断开的连接自动重连，重连失败的丢弃后补足到 min_size；
+ * - 记录借用次数、排队次数、超时次数和等待时间，stats() 输出用于评估池的大小；
+ *   每次借用的等待时间另记入直方图 chatroom_db_pool_wait_us，连接数/空闲数/排队数导出为采样值。
+ */
+
+#include <deque>
+#include <vector>
+#include <errno.h>
+#include <string>
+#include <atomic>
+#include <pthread.h>
+#include <sys/time.h>
+#include <time.h>
+#include "MyDb.h"
+#include "Metrics.h"
+
+using namespace std;
+
+#define DB_POOL_MIN 4                   // 常驻连接数
+#define DB_POOL_MAX 32                  // 连接数上限
+#define DB_POOL_ACQUIRE_TIMEOUT_MS 3000 // 借用连接的默认等待时间
+#define DB_POOL_MAINTAIN_SEC 15         // 后台检查间隔
+#define DB_POOL_IDLE_SHRINK_SEC 60      // 多余连接空闲超过该时间后关闭
+
+class DbPool {
+private:
+    struct IdleConn {
+        MyDb* db;
+        time_t since;  // 开始空闲的时间
+    };
+    struct Waiter {
+        pthread_cond_t cond;
+        MyDb* conn;    // 归还者直接交给等待者的连接
+    };
+    deque<IdleConn> idle;      // 尾部是最近归还的连接，头部空闲最久
+    deque<Waiter*> waiters;    // 按到达顺序排队
+    size_t total;              // 已建立（含正在建立）的连接数
+    size_t min_size;
+    size_t max_size;
+    string host, user, pwd, db_name;
+    int port;
+    pthread_mutex_t mutex;
+    pthread_cond_t maintain_cond;
+    pthread_t maintain_tid;
+    bool running;
+    bool stopping;
+
+    atomic<unsigned long long> acquire_count;
+    atomic<unsigned long long> wait_count;     // 需要排队的次数
+    atomic<unsigned long long> timeout_count;
+    atomic<unsigned long long> wait_us_total;
+    atomic<unsigned long long> wait_us_max;
+    atomic<unsigned long long> reconnect_count;
+    Histogram* wait_hist;      // 每次借用的等待时间（含新建连接的时间）
+
+    static void* maintain(void* arg);
+    void maintainOnce();
+    MyDb* connect();
+    void recordWait(unsigned long long us);
+
+    static long long nowUs() {
+        struct timeval tv;
+        gettimeofday(&tv, nullptr);
+        return tv.tv_sec * 1000000LL + tv.tv_usec;
+    }
+
+public:
+    DbPool(size_t min_conn = DB_POOL_MIN, size_t max_conn = DB_POOL_MAX)
+        : total(0), min_size(min_conn), max_size(max_conn < min_conn ? min_conn : max_conn), port(3306),
+          running(false), stopping(false), acquire_count(0), wait_count(0), timeout_count(0),
+          wait_us_total(0), wait_us_max(0), reconnect_count(0),
+          wait_hist(Metrics::getInstance()->histogram("chatroom_db_pool_wait_us")) {
+        pthread_mutex_init(&mutex, nullptr);
+        pthread_cond_init(&maintain_cond, nullptr);
+    }
+
+    ~DbPool() {
+        stop();
+        for (IdleConn& c : idle) {
+            delete c.db;
+        }
+        pthread_mutex_destroy(&mutex);
+        pthread_cond_destroy(&maintain_cond);
+    }
+
+    /**
+     * @brief 建立 min_size 个连接并启动后台维护线程
+     */
+    bool start(const string& host_, const string& user_, const string& pwd_, const string& db_, int port_);
+
+    void stop();
+
+    /**
+     * @brief 借用一个连接
+     * @param timeout_ms 最长等待时间
+     * @return 超时或无法建立连接返回 nullptr
+     */
+    MyDb* acquire(int timeout_ms = DB_POOL_ACQUIRE_TIMEOUT_MS);
+
+    /**
+     * @brief 归还连接（有人排队时直接交给队首的等待者）
+     */
+    void release(MyDb* db);
+
+    string stats();
+};
+
+inline MyDb* DbPool::connect() {
+    MyDb* db = new MyDb();
+    if (!db->initDB(host, user, pwd, db_name, port)) {
+        delete db;
+        return nullptr;
+    }
+    return db;
+}
+
+inline void DbPool::recordWait(unsigned long long us) {
+    wait_us_total += us;
+    unsigned long long cur = wait_us_max.load();
+    while (us > cur && !wait_us_max.compare_exchange_weak(cur, us)) {
+    }
+}
+
+inline bool DbPool::start(const string& host_, const string& user_, const string& pwd_, const string& db_, int port_) {
+    host = host_;
+    user = user_;
+    pwd = pwd_;
+    db_name = db_;
+    port = port_;
+    for (size_t i = 0; i < min_size; i++) {
+        MyDb* db = connect();
+        if (db == nullptr) {
+            LOG_ERROR("DbPool failed to open initial connection " + to_string(i), ERR_DB_CONNECTION_FAIL);
+            return false;
+        }
+        pthread_mutex_lock(&mutex);
+        idle.push_back(IdleConn{db, time(nullptr)});
+        total++;
+        pthread_mutex_unlock(&mutex);
+    }
+    Metrics* metrics = Metrics::getInstance();
+    metrics->gauge("chatroom_db_pool_connections", "", [this] {
+        pthread_mutex_lock(&mutex);
+        long long n = total;
+        pthread_mutex_unlock(&mutex);
+        return n;
+    });
+    metrics->gauge("chatroom_db_pool_idle", "", [this] {
+        pthread_mutex_lock(&mutex);
+        long long n = idle.size();
+        pthread_mutex_unlock(&mutex);
+        return n;
+    });
+    metrics->gauge("chatroom_db_pool_waiting", "", [this] {
+        pthread_mutex_lock(&mutex);
+        long long n = waiters.size();
+        pthread_mutex_unlock(&mutex);
+        return n;
+    });
+    running = true;
+    if (pthread_create(&maintain_tid, nullptr, maintain, this) != 0) {
+        LOG_ERROR("DbPool failed to create maintenance thread", ERR_THREAD_CREATE_FAIL);
+        running = false;
+        return false;
+    }
+    return true;
+}
+
+inline void DbPool::stop() {
+    pthread_mutex_lock(&mutex);
+    if (!running) {
+        pthread_mutex_unlock(&mutex);
+        return;
+    }
+    stopping = true;
+    pthread_cond_signal(&maintain_cond);
+    pthread_mutex_unlock(&mutex);
+    pthread_join(maintain_tid, nullptr);
+    running = false;
+}
+
+inline MyDb* DbPool::acquire(int timeout_ms) {
+    acquire_count++;
+    ScopedTimer timer(wait_hist);
+    pthread_mutex_lock(&mutex);
+    if (!idle.empty()) {
+        MyDb* db = idle.back().db;
+        idle.pop_back();
+        pthread_mutex_unlock(&mutex);
+        return db;
+    }
+    if (total < max_size) {
+        // 先占住名额再在锁外建立连接
+        total++;
+        pthread_mutex_unlock(&mutex);
+        MyDb* db = connect();
+        if (db != nullptr) {
+            return db;
+        }
+        pthread_mutex_lock(&mutex);
+        total--;
+    }
+
+    // 排队等待归还的连接
+    wait_count++;
+    long long begin = nowUs();
+    Waiter w;
+    pthread_cond_init(&w.cond, nullptr);
+    w.conn = nullptr;
+    waiters.push_back(&w);
+    long long deadline_us = begin + timeout_ms * 1000LL;
+    struct timespec deadline;
+    deadline.tv_sec = deadline_us / 1000000LL;
+    deadline.tv_nsec = (deadline_us % 1000000LL) * 1000L;
+    while (w.conn == nullptr) {
+        if (pthread_cond_timedwait(&w.cond, &mutex, &deadline) == ETIMEDOUT) {
+            break;
+        }
+    }
+    if (w.conn == nullptr) {
+        for (auto it = waiters.begin(); it != waiters.end(); ++it) {
+            if (*it == &w) {
+                waiters.erase(it);
+                break;
+            }
+        }
+    }
+    pthread_mutex_unlock(&mutex);
+    pthread_cond_destroy(&w.cond);
+    recordWait(nowUs() - begin);
+    if (w.conn == nullptr) {
+        timeout_count++;
+        LOG_WARN("DbPool acquire timed out after " + to_string(timeout_ms) + "ms");
+    }
+    return w.conn;
+}
+
+inline void DbPool::release(MyDb* db) {
+    if (db == nullptr) {
+        return;
+    }
+    pthread_mutex_lock(&mutex);
+    if (!waiters.empty()) {
+        Waiter* w = waiters.front();
+        waiters.pop_front();
+        w->conn = db;
+        pthread_cond_signal(&w->cond);
+    }
+    else {
+        idle.push_back(IdleConn{db, time(nullptr)});
+    }
+    pthread_mutex_unlock(&mutex);
+}
+
+inline void DbPool::maintainOnce() {
+    // 取出所有空闲连接在锁外检查，期间的 acquire 会新建连接或排队
+    deque<IdleConn> checking;
+    pthread_mutex_lock(&mutex);
+    checking.swap(idle);
+    pthread_mutex_unlock(&mutex);
+
+    time_t now = time(nullptr);
+    vector<IdleConn> alive;
+    for (IdleConn& c : checking) {
+        pthread_mutex_lock(&mutex);
+        bool surplus = total > min_size;
+        if (surplus && now - c.since >= DB_POOL_IDLE_SHRINK_SEC) {
+            total--;
+            pthread_mutex_unlock(&mutex);
+            delete c.db;
+            continue;
+        }
+        pthread_mutex_unlock(&mutex);
+        if (!c.db->ping()) {
+            reconnect_count++;
+            if (!c.db->reconnect()) {
+                LOG_ERROR("DbPool dropped a broken connection", ERR_DB_DISCONNECT);
+                pthread_mutex_lock(&mutex);
+                total--;
+                pthread_mutex_unlock(&mutex);
+                delete c.db;
+                continue;
+            }
+        }
+        alive.push_back(c);
+    }
+    // 放回时保留原来的空闲起始时间（放在头部，保持头部空闲最久的顺序）；有人排队时先交给等待者
+    pthread_mutex_lock(&mutex);
+    for (auto it = alive.rbegin(); it != alive.rend(); ++it) {
+        if (!waiters.empty()) {
+            Waiter* w = waiters.front();
+            waiters.pop_front();
+            w->conn = it->db;
+            pthread_cond_signal(&w->cond);
+        }
+        else {
+            idle.push_front(*it);
+        }
+    }
+    pthread_mutex_unlock(&mutex);
+
+    // 补足常驻连接
+    while (1) {
+        pthread_mutex_lock(&mutex);
+        if (total >= min_size || stopping) {
+            pthread_mutex_unlock(&mutex);
+            break;
+        }
+        total++;
+        pthread_mutex_unlock(&mutex);
+        MyDb* db = connect();
+        if (db == nullptr) {
+            pthread_mutex_lock(&mutex);
+            total--;
+            pthread_mutex_unlock(&mutex);
+            break;
+        }
+        release(db);
+    }
+}
+
+inline void* DbPool::maintain(void* arg) {
+    DbPool* pool = (DbPool*)arg;
+    while (1) {
+        pthread_mutex_lock(&pool->mutex);
+        if (!pool->stopping) {
+            struct timespec deadline;
+            deadline.tv_sec = time(nullptr) + DB_POOL_MAINTAIN_SEC;
+            deadline.tv_nsec = 0;
+            pthread_cond_timedwait(&pool->maintain_cond, &pool->mutex, &deadline);
+        }
+        bool exiting = pool->stopping;
+        pthread_mutex_unlock(&pool->mutex);
+        if (exiting) {
+            break;
+        }
+        pool->maintainOnce();
+    }
+    return nullptr;
+}
+
+inline string DbPool::stats() {
+    pthread_mutex_lock(&mutex);
+    size_t t = total, i = idle.size(), w = waiters.size();
+    pthread_mutex_unlock(&mutex);
+    unsigned long long waits = wait_count.load();
+    double avg_ms = waits ? wait_us_total.load() / 1000.0 / waits : 0.0;
+    return "total=" + to_string(t) + ", idle=" + to_string(i) + ", waiting=" + to_string(w) +
+           ", acquires=" + to_string(acquire_count.load()) + ", waits=" + to_string(waits) +
+           ", timeouts=" + to_string(timeout_count.load()) + ", avg_wait_ms=" + to_string(avg_ms) +
+           ", max_wait_ms=" + to_string(wait_us_max.load() / 1000.0) +
+           ", reconnects=" + to_string(reconnect_count.load());
+}
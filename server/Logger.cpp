@@ -3,6 +3,9 @@
 #include <sys/types.h>
 #include <dirent.h>
 #include <cstring>
+#include <sched.h>
+#include <sys/time.h>
+#include <unistd.h>
 
 using namespace std;
 
@@ -16,8 +19,17 @@ Logger::Logger()
     : current_level(LogLevel::INFO), 
       max_file_size(10 * 1024 * 1024),  // 10MB
       current_file_size(0),
-      console_output(true) {
+      console_output(true),
+      ring(nullptr),
+      writer_stop(false),
+      writer_sleeping(false),
+      urgent_flush(false),
+      pushed(0),
+      written(0),
+      dropped(0) {
     pthread_mutex_init(&log_mutex, nullptr);
+    pthread_mutex_init(&wake_mutex, nullptr);
+    pthread_cond_init(&wake_cond, nullptr);
 }
 
 /**
@@ -26,16 +38,24 @@ Logger::Logger()
 Logger::~Logger() {
     close();
     pthread_mutex_destroy(&log_mutex);
+    pthread_mutex_destroy(&wake_mutex);
+    pthread_cond_destroy(&wake_cond);
 }
 
 /**
  * @brief 获取当前时间戳
  */
 string Logger::getCurrentTimestamp() {
+    // localtime 不是线程安全的，改用 localtime_r；同一秒内的日志复用本线程上次的结果
+    static thread_local time_t cached_sec = 0;
+    static thread_local char buffer[32];
     time_t now = time(nullptr);
-    struct tm* timeinfo = localtime(&now);
-    char buffer[32];
-    strftime(buffer, sizeof(buffer), "%Y-%m-%d %H:%M:%S", timeinfo);
+    if (now != cached_sec) {
+        struct tm timeinfo;
+        localtime_r(&now, &timeinfo);
+        strftime(buffer, sizeof(buffer), "%Y-%m-%d %H:%M:%S", &timeinfo);
+        cached_sec = now;
+    }
     return string(buffer);
 }
 
@@ -60,7 +80,8 @@ string Logger::getLevelString(LogLevel level) {
 bool Logger::initialize(const string& dir, 
                        const string& filename,
                        LogLevel level,
-                       bool enable_console) {
+                       bool enable_console,
+                       bool async) {
     pthread_mutex_lock(&log_mutex);
 
     log_dir = dir;
@@ -99,10 +120,152 @@ bool Logger::initialize(const string& dir,
 
     pthread_mutex_unlock(&log_mutex);
 
-    info("Logger initialized successfully");
+    if (async && !startAsync()) {
+        return false;
+    }
+    info(async ? "Logger initialized successfully (async)" : "Logger initialized successfully");
+    return true;
+}
+
+/**
+ * @brief 启用异步模式
+ */
+bool Logger::startAsync(size_t capacity) {
+    if (ring != nullptr) {
+        return true;
+    }
+    MpscRing<string>* r = new MpscRing<string>(capacity);
+    writer_stop.store(false);
+    ring.store(r, memory_order_release);
+    if (pthread_create(&writer_tid, nullptr, writerMain, this) != 0) {
+        ring.store(nullptr);
+        delete r;
+        cerr << "Failed to create log writer thread" << endl;
+        return false;
+    }
     return true;
 }
 
+/**
+ * @brief 停止后台写线程（须在没有其他线程写日志时调用，如退出前）
+ */
+void Logger::stopAsync() {
+    if (ring == nullptr) {
+        return;
+    }
+    writer_stop.store(true);
+    pthread_mutex_lock(&wake_mutex);
+    pthread_cond_signal(&wake_cond);
+    pthread_mutex_unlock(&wake_mutex);
+    pthread_join(writer_tid, nullptr);
+    delete ring.exchange(nullptr);
+}
+
+/**
+ * @brief 后台写线程：批量取出日志行写文件，定期刷盘
+ */
+void* Logger::writerMain(void* arg) {
+    Logger* logger = (Logger*)arg;
+    MpscRing<string>* ring = logger->ring.load();
+    vector<string> batch;
+    batch.reserve(LOG_BATCH_MAX);
+    string line;
+    bool unflushed = false;
+    unsigned long long reported_drops = 0;
+    struct timeval tv;
+    gettimeofday(&tv, nullptr);
+    long long last_flush_ms = tv.tv_sec * 1000LL + tv.tv_usec / 1000;
+    while (1) {
+        while (batch.size() < LOG_BATCH_MAX && ring->pop(line)) {
+            batch.push_back(std::move(line));
+        }
+        if (batch.empty()) {
+            if (logger->writer_stop.load()) {
+                break;
+            }
+            // 队列空闲时把已写的数据刷盘，然后等待新日志或刷盘间隔到期
+            if (unflushed) {
+                pthread_mutex_lock(&logger->log_mutex);
+                if (logger->log_file.is_open()) {
+                    logger->log_file.flush();
+                }
+                pthread_mutex_unlock(&logger->log_mutex);
+                unflushed = false;
+            }
+            pthread_mutex_lock(&logger->wake_mutex);
+            logger->writer_sleeping.store(true);
+            if (ring->pop(line)) {
+                batch.push_back(std::move(line));  // 设置等待标志前刚好有日志入队
+            }
+            else if (!logger->writer_stop.load()) {
+                struct timespec deadline;
+                clock_gettime(CLOCK_REALTIME, &deadline);
+                deadline.tv_nsec += LOG_FLUSH_INTERVAL_MS * 1000000L;
+                deadline.tv_sec += deadline.tv_nsec / 1000000000L;
+                deadline.tv_nsec %= 1000000000L;
+                pthread_cond_timedwait(&logger->wake_cond, &logger->wake_mutex, &deadline);
+            }
+            logger->writer_sleeping.store(false);
+            pthread_mutex_unlock(&logger->wake_mutex);
+            continue;
+        }
+
+        gettimeofday(&tv, nullptr);
+        long long now_ms = tv.tv_sec * 1000LL + tv.tv_usec / 1000;
+        unsigned long long drops = logger->dropped.load();
+        pthread_mutex_lock(&logger->log_mutex);
+        if (drops != reported_drops) {
+            logger->writeLine(logger->formatLine(LogLevel::WARNING, "Log ring full, dropped " +
+                                                 to_string(drops - reported_drops) + " records", 0));
+            reported_drops = drops;
+        }
+        for (const string& l : batch) {
+            logger->writeLine(l);
+        }
+        if (logger->urgent_flush.exchange(false) || now_ms - last_flush_ms >= LOG_FLUSH_INTERVAL_MS) {
+            if (logger->log_file.is_open()) {
+                logger->log_file.flush();
+            }
+            last_flush_ms = now_ms;
+            unflushed = false;
+        }
+        else {
+            unflushed = true;
+        }
+        pthread_mutex_unlock(&logger->log_mutex);
+        logger->written += batch.size();
+        batch.clear();
+    }
+    pthread_mutex_lock(&logger->log_mutex);
+    if (logger->log_file.is_open()) {
+        logger->log_file.flush();
+    }
+    pthread_mutex_unlock(&logger->log_mutex);
+    return nullptr;
+}
+
+/**
+ * @brief 刷新日志
+ */
+void Logger::flush() {
+    if (ring != nullptr) {
+        // 等后台线程写完调用前已入队的日志（最多等1秒）
+        unsigned long long target = pushed.load();
+        urgent_flush.store(true);
+        pthread_mutex_lock(&wake_mutex);
+        pthread_cond_signal(&wake_cond);
+        pthread_mutex_unlock(&wake_mutex);
+        for (int i = 0; i < 1000 && written.load() < target; i++) {
+            usleep(1000);
+        }
+    }
+    pthread_mutex_lock(&log_mutex);
+    if (log_file.is_open()) {
+        log_file.flush();
+    }
+    pthread_mutex_unlock(&log_mutex);
+}
+
 /**
  * @brief 轮转日志文件
  */
@@ -113,9 +276,10 @@ void Logger::rotateLogFile() {
 
     // 生成带时间戳的备份文件名
     time_t now = time(nullptr);
-    struct tm* timeinfo = localtime(&now);
+    struct tm timeinfo;
+    localtime_r(&now, &timeinfo);
     char timestamp[32];
-    strftime(timestamp, sizeof(timestamp), "%Y%m%d_%H%M%S", timeinfo);
+    strftime(timestamp, sizeof(timestamp), "%Y%m%d_%H%M%S", &timeinfo);
 
     string old_path = log_dir + "/" + log_filename;
     string new_path = log_dir + "/" + log_filename + "." + timestamp;
@@ -140,46 +304,86 @@ void Logger::checkAndRotateLogFile() {
 }
 
 /**
- * @brief 内部日志写入函数
+ * @brief 格式化一行日志
  */
-void Logger::writeLog(LogLevel level, const string& message, int error_code) {
-    pthread_mutex_lock(&log_mutex);
-
-    // 检查是否需要轮转日志文件
-    checkAndRotateLogFile();
-
-    string timestamp = getCurrentTimestamp();
-    string level_str = getLevelString(level);
-    pthread_t thread_id = pthread_self();
-
-    // 构建日志消息
-    stringstream ss;
-    ss << "[" << timestamp << "] "
-       << "[" << level_str << "] "
-       << "[TID:" << thread_id << "] ";
+string Logger::formatLine(LogLevel level, const string& message, int error_code) {
+    string line;
+    line.reserve(64 + message.size());
+    line += "[";
+    line += getCurrentTimestamp();
+    line += "] [";
+    line += getLevelString(level);
+    line += "] [TID:";
+    line += to_string((unsigned long)pthread_self());
+    line += "] ";
 
     // 如果有错误码，添加错误信息
     if (error_code != 0) {
-        string error_info = ErrorCodeManager::getFullMessage(error_code);
-        ss << "[ERR:" << error_info << "] ";
+        line += "[ERR:";
+        line += ErrorCodeManager::getFullMessage(error_code);
+        line += "] ";
     }
 
-    ss << message;
+    line += message;
+    return line;
+}
 
-    string log_message = ss.str();
+/**
+ * @brief 写入一行日志（调用方持有 log_mutex）
+ */
+void Logger::writeLine(const string& line) {
+    // 检查是否需要轮转日志文件
+    checkAndRotateLogFile();
 
     // 写入文件
     if (log_file.is_open()) {
-        log_file << log_message << "\n";
-        log_file.flush();
-        current_file_size += log_message.length() + 1;  // +1 for newline
+        log_file << line << "\n";
+        current_file_size += line.length() + 1;  // +1 for newline
     }
 
     // 输出到控制台
     if (console_output) {
-        cout << log_message << "\n";
+        cout << line << "\n";
     }
+}
 
+/**
+ * @brief 内部日志写入函数
+ */
+void Logger::writeLog(LogLevel level, const string& message, int error_code) {
+    string line = formatLine(level, message, error_code);
+
+    MpscRing<string>* r = ring.load(memory_order_acquire);
+    if (r != nullptr) {
+        // 异步模式：只入队，由后台线程写文件
+        bool important = level >= LogLevel::INFO;
+        while (!r->push(std::move(line))) {
+            if (!important) {
+                dropped++;  // 队列满时丢弃低级别日志，不阻塞业务线程
+                return;
+            }
+            pthread_mutex_lock(&wake_mutex);
+            pthread_cond_signal(&wake_cond);
+            pthread_mutex_unlock(&wake_mutex);
+            sched_yield();
+        }
+        pushed++;
+        if (level >= LogLevel::ERROR_) {
+            urgent_flush.store(true);
+        }
+        if (writer_sleeping.load()) {
+            pthread_mutex_lock(&wake_mutex);
+            pthread_cond_signal(&wake_cond);
+            pthread_mutex_unlock(&wake_mutex);
+        }
+        return;
+    }
+
+    pthread_mutex_lock(&log_mutex);
+    writeLine(line);
+    if (log_file.is_open()) {
+        log_file.flush();
+    }
     pthread_mutex_unlock(&log_mutex);
 }
 
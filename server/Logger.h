@@ -7,6 +7,10 @@
  * 2. 线程安全的日志写入
  * 3. 日志文件轮转
  * 4. 结构化日志记录（带时间戳、线程ID、错误码等）
+ * 5. 异步模式：调用线程只格式化出一行日志写入无锁环形队列，后台线程批量写文件，
+ *    按 LOG_FLUSH_INTERVAL_MS 定期刷盘（ERROR/FATAL 立即刷盘）
+ *
+ * LOG_* 宏先检查日志级别再求值消息表达式，级别关闭时不会拼接字符串。
  */
 
 #pragma once
@@ -18,11 +22,17 @@
 #include <mutex>
 #include <sstream>
 #include <iomanip>
+#include <atomic>
 #include <pthread.h>
 #include "ErrorCode.h"
+#include "Ring.h"
 
 using namespace std;
 
+#define LOG_RING_CAPACITY 8192      // 异步模式环形队列的槽数（2的幂）
+#define LOG_BATCH_MAX 256           // 后台线程每批最多写入的条数
+#define LOG_FLUSH_INTERVAL_MS 200   // 异步模式的刷盘间隔
+
 
 // 日志级别
 enum class LogLevel {
@@ -46,8 +56,8 @@ private:
     ofstream log_file;
     // 日志互斥锁
     pthread_mutex_t log_mutex;
-    // 当前日志级别
-    LogLevel current_level;
+    // 当前日志级别（任意线程读取）
+    atomic<LogLevel> current_level;
     // 日志目录
     string log_dir;
     // 日志文件名
@@ -58,6 +68,34 @@ private:
     size_t current_file_size;
     // 是否输出到控制台
     bool console_output;
+
+    // 异步模式
+    atomic<MpscRing<string>*> ring;    // 格式化好的日志行，nullptr 表示同步模式
+    pthread_t writer_tid;
+    atomic<bool> writer_stop;
+    atomic<bool> writer_sleeping;      // 后台线程正在等待新日志
+    atomic<bool> urgent_flush;         // 收到 ERROR/FATAL，写完本批后立即刷盘
+    pthread_mutex_t wake_mutex;
+    pthread_cond_t wake_cond;
+    atomic<unsigned long long> pushed;   // 已入队的条数
+    atomic<unsigned long long> written;  // 已写出的条数
+    atomic<unsigned long long> dropped;  // 队列满时丢弃的低级别日志条数
+
+    /**
+     * @brief 后台写线程主体
+     */
+    static void* writerMain(void* arg);
+
+    /**
+     * @brief 格式化一行日志（调用线程中执行，不加锁）
+     */
+    string formatLine(LogLevel level, const string& message, int error_code);
+
+    /**
+     * @brief 把一行日志写入文件和控制台（调用方持有 log_mutex）
+     */
+    void writeLine(const string& line);
+
     /**
      * @brief 获取当前时间戳
      */
@@ -109,11 +147,38 @@ public:
      * @param filename 日志文件名
      * @param level 初始日志级别
      * @param enable_console 是否输出到控制台
+     * @param async 是否启用异步模式（后台线程写文件）
      */
     bool initialize(const string& dir = "logs", 
                    const string& filename = "chatroom.log",
                    LogLevel level = LogLevel::INFO,
-                   bool enable_console = true);
+                   bool enable_console = true,
+                   bool async = false);
+
+    /**
+     * @brief 启用异步模式：启动后台写线程
+     * @param capacity 环形队列槽数（2的幂），队列满时丢弃 DEBUG 及以下的日志，INFO 及以上等待空位
+     */
+    bool startAsync(size_t capacity = LOG_RING_CAPACITY);
+
+    /**
+     * @brief 停止后台写线程，写完队列中剩余的日志后回到同步模式
+     */
+    void stopAsync();
+
+    /**
+     * @brief 该级别的日志是否会被记录（宏在构造消息前调用）
+     */
+    bool isEnabled(LogLevel level) const {
+        return current_level.load(memory_order_relaxed) <= level;
+    }
+
+    /**
+     * @brief 队列满被丢弃的日志条数
+     */
+    unsigned long long droppedCount() const {
+        return dropped.load();
+    }
     
     /**
      * @brief 设置日志级别
@@ -126,7 +191,7 @@ public:
      * @brief 获取日志级别
      */
     LogLevel getLogLevel() const {
-        return current_level;
+        return current_level.load();
     }
     
     /**
@@ -140,7 +205,7 @@ public:
      * @brief 记录TRACE级别日志
      */
     void trace(const string& message) {
-        if (current_level <= LogLevel::TRACE) {
+        if (isEnabled(LogLevel::TRACE)) {
             writeLog(LogLevel::TRACE, message);
         }
     }
@@ -149,7 +214,7 @@ public:
      * @brief 记录DEBUG级别日志
      */
     void debug(const string& message) {
-        if (current_level <= LogLevel::DEBUG) {
+        if (isEnabled(LogLevel::DEBUG)) {
             writeLog(LogLevel::DEBUG, message);
         }
     }
@@ -158,7 +223,7 @@ public:
      * @brief 记录INFO级别日志
      */
     void info(const string& message) {
-        if (current_level <= LogLevel::INFO) {
+        if (isEnabled(LogLevel::INFO)) {
             writeLog(LogLevel::INFO, message);
         }
     }
@@ -167,7 +232,7 @@ public:
      * @brief 记录WARNING级别日志
      */
     void warning(const string& message) {
-        if (current_level <= LogLevel::WARNING) {
+        if (isEnabled(LogLevel::WARNING)) {
             writeLog(LogLevel::WARNING, message);
         }
     }
@@ -176,7 +241,7 @@ public:
      * @brief 记录ERROR级别日志（带错误码）
      */
     void error(const string& message, int error_code = ERR_UNKNOWN) {
-        if (current_level <= LogLevel::ERROR_) {
+        if (isEnabled(LogLevel::ERROR_)) {
             writeLog(LogLevel::ERROR_, message, error_code);
         }
     }
@@ -185,7 +250,7 @@ public:
      * @brief 记录FATAL级别日志（带错误码）
      */
     void fatal(const string& message, int error_code = ERR_UNKNOWN) {
-        if (current_level <= LogLevel::FATAL) {
+        if (isEnabled(LogLevel::FATAL)) {
             writeLog(LogLevel::FATAL, message, error_code);
         }
     }
@@ -194,7 +259,7 @@ public:
      * @brief 记录带错误码的日志
      */
     void logWithErrorCode(LogLevel level, const string& message, int error_code) {
-        if (current_level <= level) {
+        if (isEnabled(level)) {
             writeLog(level, message, error_code);
         }
     }
@@ -218,20 +283,15 @@ public:
     void logNetworkError(int client_fd, const string& error_msg, int error_code);
     
     /**
-     * @brief 刷新日志
+     * @brief 刷新日志（异步模式下先等待已入队的日志写完）
      */
-    void flush() {
-        pthread_mutex_lock(&log_mutex);
-        if (log_file.is_open()) {
-            log_file.flush();
-        }
-        pthread_mutex_unlock(&log_mutex);
-    }
+    void flush();
     
     /**
      * @brief 关闭日志系统
      */
     void close() {
+        stopAsync();
         pthread_mutex_lock(&log_mutex);
         if (log_file.is_open()) {
             log_file.close();
@@ -252,12 +312,14 @@ public:
 };
 
 // 便捷宏定义 - 简化日志记录
-#define LOG_TRACE(msg)              Logger::getInstance()->trace(msg)
-#define LOG_DEBUG(msg)              Logger::getInstance()->debug(msg)
-#define LOG_INFO(msg)               Logger::getInstance()->info(msg)
-#define LOG_WARN(msg)               Logger::getInstance()->warning(msg)
-#define LOG_ERROR(msg, code)        Logger::getInstance()->error(msg, code)
-#define LOG_FATAL(msg, code)        Logger::getInstance()->fatal(msg, code)
-#define LOG_OPERATION(uid, op, det) Logger::getInstance()->logOperation(uid, op, det)
-#define LOG_DB_ERROR(sql, err, code) Logger::getInstance()->logDatabaseError(sql, err, code)
-#define LOG_NET_ERROR(fd, err, code) Logger::getInstance()->logNetworkError(fd, err, code)
+// 先检查级别再求值 msg，级别关闭时调用处的 to_string / substr 等都不会执行
+#define LOG_ENABLED(level)          Logger::getInstance()->isEnabled(level)
+#define LOG_TRACE(msg)              do { if (LOG_ENABLED(LogLevel::TRACE)) Logger::getInstance()->trace(msg); } while (0)
+#define LOG_DEBUG(msg)              do { if (LOG_ENABLED(LogLevel::DEBUG)) Logger::getInstance()->debug(msg); } while (0)
+#define LOG_INFO(msg)               do { if (LOG_ENABLED(LogLevel::INFO)) Logger::getInstance()->info(msg); } while (0)
+#define LOG_WARN(msg)               do { if (LOG_ENABLED(LogLevel::WARNING)) Logger::getInstance()->warning(msg); } while (0)
+#define LOG_ERROR(msg, code)        do { if (LOG_ENABLED(LogLevel::ERROR_)) Logger::getInstance()->error(msg, code); } while (0)
+#define LOG_FATAL(msg, code)        do { if (LOG_ENABLED(LogLevel::FATAL)) Logger::getInstance()->fatal(msg, code); } while (0)
+#define LOG_OPERATION(uid, op, det) do { if (LOG_ENABLED(LogLevel::INFO)) Logger::getInstance()->logOperation(uid, op, det); } while (0)
+#define LOG_DB_ERROR(sql, err, code) do { if (LOG_ENABLED(LogLevel::ERROR_)) Logger::getInstance()->logDatabaseError(sql, err, code); } while (0)
+#define LOG_NET_ERROR(fd, err, code) do { if (LOG_ENABLED(LogLevel::ERROR_)) Logger::getInstance()->logNetworkError(fd, err, code); } while (0)
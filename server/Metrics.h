@@ -0,0 +1,448 @@
+#pragma once
+/**
+ * @file Metrics.h
+ * @brief 进程内指标注册表 - 计数器、延迟直方图和采样值，通过本地 UNIX 套接字导出
+ *
+ * - Counter：单调递增的计数；
+ * - Histogram：对数-线性分桶（HDR 风格）的延迟分布，单位微秒，每个2的幂区间
+ *   再分 8 个子桶，相对误差不超过 12.5%，记录只做几次原子加，不加锁；
+ * - 采样值（gauge）：注册一个回调，导出时才调用（队列深度、连接数等）。
+ *
+ * 指标按"名字+标签"注册，返回的指针在进程生命周期内有效，热路径上应缓存指针，
+ * 不要每次都查表。startAdmin() 启动一个线程监听 UNIX 套接字，每个连接可以先发送
+ * 一行命令（其它模块用 command() 注册，如追踪的开关和导出），不发送（等待
+ * ADMIN_READ_TIMEOUT_MS 或关闭写端）或发送 "stats" 时写出 render() 的全部文本，
+ * 然后关闭连接，可直接用 `nc -U /tmp/chatroom_admin.sock < /dev/null` 抓取。
+ *
+ * 导出格式每行一个值（与 Prometheus 文本格式兼容）：
+ *   chatroom_connections 12
+ *   chatroom_cmd_total{cmd="sign_in"} 345
+ *   chatroom_cmd_us{cmd="sign_in",q="0.99"} 1843
+ *   chatroom_cmd_us_count{cmd="sign_in"} 345
+ */
+
+#include <map>
+#include <string>
+#include <memory>
+#include <atomic>
+#include <functional>
+#include <poll.h>
+#include <pthread.h>
+#include <time.h>
+#include <errno.h>
+#include <cstring>
+#include <unistd.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include "Logger.h"
+#include "ErrorCode.h"
+
+using namespace std;
+
+#define ADMIN_SOCKET_PATH "/tmp/chatroom_admin.sock"  // 指标导出的本地套接字
+#define ADMIN_READ_TIMEOUT_MS 200                      // 等待客户端发送命令行的时间
+#define HIST_SUB_BITS 3                                // 每个2的幂区间的子桶数为 2^HIST_SUB_BITS
+#define HIST_MAX_BITS 40                               // 超过 2^40 微秒（约12天）的值计入最后一个桶
+#define HIST_BUCKETS ((HIST_MAX_BITS - HIST_SUB_BITS + 1) << HIST_SUB_BITS)
+
+/**
+ * @class Counter
+ * @brief 单调递增的计数器（线程安全）
+ */
+class Counter {
+private:
+    atomic<unsigned long long> value;
+
+public:
+    Counter() : value(0) {}
+
+    void inc(unsigned long long n = 1) {
+        value.fetch_add(n, memory_order_relaxed);
+    }
+
+    unsigned long long get() const {
+        return value.load(memory_order_relaxed);
+    }
+};
+
+/**
+ * @class Histogram
+ * @brief 对数-线性分桶的直方图（线程安全，记录不加锁）
+ *
+ * 小于 2^HIST_SUB_BITS 的值每个值一个桶；之后每个区间 [2^k, 2^(k+1)) 等分为
+ * 2^HIST_SUB_BITS 个桶。分位数取所在桶的上界（不超过记录过的最大值）。
+ */
+class Histogram {
+private:
+    atomic<unsigned long long> buckets[HIST_BUCKETS];
+    atomic<unsigned long long> count;
+    atomic<unsigned long long> sum;
+    atomic<unsigned long long> max_value;
+
+    static int bucketOf(unsigned long long v) {
+        if (v < (1ULL << HIST_SUB_BITS)) {
+            return (int)v;
+        }
+        int msb = 63 - __builtin_clzll(v);
+        if (msb >= HIST_MAX_BITS) {
+            return HIST_BUCKETS - 1;
+        }
+        int shift = msb - HIST_SUB_BITS;
+        return ((shift + 1) << HIST_SUB_BITS) + (int)((v >> shift) & ((1ULL << HIST_SUB_BITS) - 1));
+    }
+
+    // 桶内的最大值
+    static unsigned long long bucketUpper(int idx) {
+        if (idx < (1 << HIST_SUB_BITS)) {
+            return idx;
+        }
+        int shift = (idx >> HIST_SUB_BITS) - 1;
+        unsigned long long base = (1ULL << HIST_SUB_BITS) + (idx & ((1 << HIST_SUB_BITS) - 1));
+        return ((base + 1) << shift) - 1;
+    }
+
+public:
+    Histogram() : count(0), sum(0), max_value(0) {
+        for (int i = 0; i < HIST_BUCKETS; i++) {
+            buckets[i].store(0, memory_order_relaxed);
+        }
+    }
+
+    void record(unsigned long long v) {
+        buckets[bucketOf(v)].fetch_add(1, memory_order_relaxed);
+        count.fetch_add(1, memory_order_relaxed);
+        sum.fetch_add(v, memory_order_relaxed);
+        unsigned long long cur = max_value.load(memory_order_relaxed);
+        while (v > cur && !max_value.compare_exchange_weak(cur, v, memory_order_relaxed)) {
+        }
+    }
+
+    unsigned long long total() const {
+        return count.load(memory_order_relaxed);
+    }
+
+    unsigned long long totalSum() const {
+        return sum.load(memory_order_relaxed);
+    }
+
+    unsigned long long maxValue() const {
+        return max_value.load(memory_order_relaxed);
+    }
+
+    /**
+     * @brief 分位数（并发记录时为近似值）
+     * @param q 0~1
+     */
+    unsigned long long percentile(double q) const {
+        unsigned long long n = total();
+        if (n == 0) {
+            return 0;
+        }
+        unsigned long long rank = (unsigned long long)(q * n);
+        if (rank >= n) {
+            rank = n - 1;
+        }
+        unsigned long long seen = 0;
+        for (int i = 0; i < HIST_BUCKETS; i++) {
+            seen += buckets[i].load(memory_order_relaxed);
+            if (seen > rank) {
+                return min(bucketUpper(i), maxValue());
+            }
+        }
+        return maxValue();
+    }
+};
+
+/**
+ * @class Metrics
+ * @brief 指标注册表（单例）
+ */
+class Metrics {
+private:
+    struct Series {
+        string name;
+        string labels;  // 不含花括号，如 cmd="sign_in"
+        unique_ptr<Counter> counter;
+        unique_ptr<Histogram> histogram;
+        function<long long()> gauge;
+    };
+    map<string, unique_ptr<Series>> series;  // name{labels} -> 指标，按名字有序导出
+    map<string, function<string(const string&)>> commands;  // 导出套接字上的命令 -> 处理函数（参数为命令后的部分）
+    pthread_mutex_t mutex;
+    pthread_t admin_tid;
+    int admin_fd;
+    string admin_path;
+
+    Metrics() : admin_fd(-1) {
+        pthread_mutex_init(&mutex, nullptr);
+    }
+
+    // 调用方持有锁
+    Series* findOrCreate(const string& name, const string& labels) {
+        string key = labels.empty() ? name : name + "{" + labels + "}";
+        unique_ptr<Series>& s = series[key];
+        if (!s) {
+            s.reset(new Series());
+            s->name = name;
+            s->labels = labels;
+        }
+        return s.get();
+    }
+
+    static string braced(const string& labels, const string& extra = "") {
+        if (labels.empty() && extra.empty()) {
+            return "";
+        }
+        if (labels.empty() || extra.empty()) {
+            return "{" + labels + extra + "}";
+        }
+        return "{" + labels + "," + extra + "}";
+    }
+
+    static void* adminThread(void* arg);
+    static string readCommand(int conn);
+    string execute(const string& line);
+
+public:
+    Metrics(const Metrics&) = delete;
+    Metrics& operator=(const Metrics&) = delete;
+
+    static Metrics* getInstance() {
+        static Metrics* instance = new Metrics();  // 不析构：进程退出时导出线程可能仍在运行
+        return instance;
+    }
+
+    /**
+     * @brief 单调时钟，微秒
+     */
+    static long long nowUs() {
+        struct timespec ts;
+        clock_gettime(CLOCK_MONOTONIC, &ts);
+        return ts.tv_sec * 1000000LL + ts.tv_nsec / 1000;
+    }
+
+    /**
+     * @brief 生成一个标签 key="value"（转义引号、反斜杠和换行）
+     */
+    static string label(const char* key, const string& value) {
+        string out = key;
+        out += "=\"";
+        for (char c : value) {
+            if (c == '"' || c == '\\') {
+                out += '\\';
+                out += c;
+            }
+            else if (c == '\n') {
+                out += "\\n";
+            }
+            else {
+                out += c;
+            }
+        }
+        out += '"';
+        return out;
+    }
+
+    Counter* counter(const string& name, const string& labels = "") {
+        pthread_mutex_lock(&mutex);
+        Series* s = findOrCreate(name, labels);
+        if (!s->counter) {
+            s->counter.reset(new Counter());
+        }
+        Counter* c = s->counter.get();
+        pthread_mutex_unlock(&mutex);
+        return c;
+    }
+
+    Histogram* histogram(const string& name, const string& labels = "") {
+        pthread_mutex_lock(&mutex);
+        Series* s = findOrCreate(name, labels);
+        if (!s->histogram) {
+            s->histogram.reset(new Histogram());
+        }
+        Histogram* h = s->histogram.get();
+        pthread_mutex_unlock(&mutex);
+        return h;
+    }
+
+    /**
+     * @brief 注册采样值，导出时在导出线程中调用 fn（同名再次注册会替换）
+     */
+    void gauge(const string& name, const string& labels, function<long long()> fn) {
+        pthread_mutex_lock(&mutex);
+        findOrCreate(name, labels)->gauge = std::move(fn);
+        pthread_mutex_unlock(&mutex);
+    }
+
+    /**
+     * @brief 注册导出套接字上的命令（在导出线程中执行）
+     * @param name 命令名，一行中第一个空格之前的部分
+     * @param fn 参数为命令名之后的部分，返回值原样写回客户端
+     */
+    void command(const string& name, function<string(const string&)> fn) {
+        pthread_mutex_lock(&mutex);
+        commands[name] = std::move(fn);
+        pthread_mutex_unlock(&mutex);
+    }
+
+    /**
+     * @brief 导出全部指标的文本
+     */
+    string render() {
+        static const struct { double q; const char* text; } quantiles[] = {
+            {0.5, "0.5"}, {0.9, "0.9"}, {0.99, "0.99"}, {0.999, "0.999"}};
+        string out;
+        pthread_mutex_lock(&mutex);
+        for (auto& it : series) {
+            Series* s = it.second.get();
+            if (s->counter) {
+                out += s->name + braced(s->labels) + " " + to_string(s->counter->get()) + "\n";
+            }
+            if (s->gauge) {
+                out += s->name + braced(s->labels) + " " + to_string(s->gauge()) + "\n";
+            }
+            if (s->histogram) {
+                Histogram* h = s->histogram.get();
+                for (const auto& q : quantiles) {
+                    out += s->name + braced(s->labels, string("q=\"") + q.text + "\"") + " " +
+                           to_string(h->percentile(q.q)) + "\n";
+                }
+                out += s->name + "_max" + braced(s->labels) + " " + to_string(h->maxValue()) + "\n";
+                out += s->name + "_sum" + braced(s->labels) + " " + to_string(h->totalSum()) + "\n";
+                out += s->name + "_count" + braced(s->labels) + " " + to_string(h->total()) + "\n";
+            }
+        }
+        pthread_mutex_unlock(&mutex);
+        return out;
+    }
+
+    /**
+     * @brief 启动导出线程，监听本地 UNIX 套接字
+     * @param path 套接字路径（已存在的旧文件会被删除）
+     */
+    bool startAdmin(const string& path = ADMIN_SOCKET_PATH);
+};
+
+inline bool Metrics::startAdmin(const string& path) {
+    struct sockaddr_un addr;
+    if (path.size() >= sizeof(addr.sun_path)) {
+        LOG_ERROR("Admin socket path too long: " + path, ERR_PARAMETER_INVALID);
+        return false;
+    }
+    int fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (fd == -1) {
+        LOG_ERROR("Failed to create admin socket", ERR_SOCKET_CREATE_FAIL);
+        return false;
+    }
+    memset(&addr, 0, sizeof(addr));
+    addr.sun_family = AF_UNIX;
+    memcpy(addr.sun_path, path.c_str(), path.size());
+    unlink(path.c_str());
+    if (bind(fd, (struct sockaddr*)&addr, sizeof(addr)) == -1 || listen(fd, 16) == -1) {
+        LOG_ERROR("Failed to bind admin socket " + path, ERR_SOCKET_BIND_FAIL);
+        close(fd);
+        return false;
+    }
+    admin_fd = fd;
+    admin_path = path;
+    if (pthread_create(&admin_tid, nullptr, adminThread, this) != 0) {
+        LOG_ERROR("Failed to create admin thread", ERR_THREAD_CREATE_FAIL);
+        close(fd);
+        admin_fd = -1;
+        return false;
+    }
+    pthread_detach(admin_tid);
+    LOG_INFO("Metrics admin endpoint listening on " + path);
+    return true;
+}
+
+inline void* Metrics::adminThread(void* arg) {
+    Metrics* m = (Metrics*)arg;
+    while (1) {
+        int conn = accept(m->admin_fd, nullptr, nullptr);
+        if (conn == -1) {
+            if (errno == EINTR) {
+                continue;
+            }
+            LOG_ERROR("Admin socket accept failed", ERR_SOCKET_ACCEPT_FAIL);
+            break;
+        }
+        string text = m->execute(readCommand(conn));
+        size_t sent = 0;
+        while (sent < text.size()) {
+            ssize_t n = write(conn, text.data() + sent, text.size() - sent);
+            if (n <= 0) {
+                if (n == -1 && errno == EINTR) {
+                    continue;
+                }
+                break;
+            }
+            sent += n;
+        }
+        close(conn);
+    }
+    return nullptr;
+}
+
+// 读取客户端的一行命令（超时或对端关闭写端时返回已读到的部分）
+inline string Metrics::readCommand(int conn) {
+    string line;
+    char buf[256];
+    struct pollfd pfd;
+    pfd.fd = conn;
+    pfd.events = POLLIN;
+    while (line.find('\n') == string::npos && line.size() < sizeof(buf)) {
+        if (poll(&pfd, 1, ADMIN_READ_TIMEOUT_MS) <= 0) {
+            break;
+        }
+        ssize_t n = read(conn, buf, sizeof(buf));
+        if (n <= 0) {
+            break;
+        }
+        line.append(buf, n);
+    }
+    size_t end = line.find_first_of("\r\n");
+    if (end != string::npos) {
+        line.resize(end);
+    }
+    return line;
+}
+
+inline string Metrics::execute(const string& line) {
+    size_t space = line.find(' ');
+    string name = line.substr(0, space);
+    string arg = space == string::npos ? "" : line.substr(space + 1);
+    if (name.empty() || name == "stats") {
+        return render();
+    }
+    pthread_mutex_lock(&mutex);
+    auto it = commands.find(name);
+    function<string(const string&)> fn = it != commands.end() ? it->second : nullptr;
+    pthread_mutex_unlock(&mutex);
+    if (!fn) {
+        return "unknown command: " + name + "\n";
+    }
+    return fn(arg);
+}
+
+/**
+ * @class ScopedTimer
+ * @brief 作用域计时（RAII）：析构时把经过的微秒数记入直方图，直方图为空则不计时
+ */
+class ScopedTimer {
+private:
+    Histogram* hist;
+    long long begin;
+
+public:
+    explicit ScopedTimer(Histogram* h) : hist(h), begin(h ? Metrics::nowUs() : 0) {}
+
+    ScopedTimer(const ScopedTimer&) = delete;
+    ScopedTimer& operator=(const ScopedTimer&) = delete;
+
+    ~ScopedTimer() {
+        if (hist) {
+            hist->record(Metrics::nowUs() - begin);
+        }
+    }
+};
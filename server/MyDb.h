@@ -3,46 +3,292 @@
 #include<mysql/mysql.h>
 #include<iostream>
 #include<vector>
+#include<unordered_map>
+#include<cstring>
+#include<cstdlib>
+#include<memory>
+#include<type_traits>
 #include"Logger.h"
 #include"ErrorCode.h"
+#include"Metrics.h"
+#include"Trace.h"
 using namespace std;
 typedef unsigned long long ull;
+// MYSQL_BIND::is_null 的元素类型（MySQL 8 为 bool，旧版本/MariaDB 为 my_bool）
+typedef remove_pointer<decltype(MYSQL_BIND::is_null)>::type stmt_bool;
+
+// 预处理语句的输入参数（整数或字符串）
+struct DbParam{
+    bool is_int;
+    long long num;
+    string str;
+    DbParam(int v):is_int(true),num(v){}
+    DbParam(long long v):is_int(true),num(v){}
+    DbParam(const string&v):is_int(false),num(0),str(v){}
+    DbParam(const char*v):is_int(false),num(0),str(v?v:""){}
+};
+
+// 预处理语句结果中的一列：整数列按二进制取回到num，其余列取回到str
+struct DbValue{
+    bool is_null;
+    bool is_int;
+    long long num;
+    string str;
+    string text() const {
+        if(is_null)return "";
+        return is_int?to_string(num):str;
+    }
+};
+typedef vector<DbValue> DbRow;
+
+// 把结果集拼成与 select_many_SQL 相同的文本格式：列之间空格分隔，行之间换行
+inline string rowsToText(const vector<DbRow>&rows){
+    string str;
+    for(const DbRow&row:rows){
+        for(const DbValue&v:row){
+            if(!v.is_null){
+                str+=v.text()+" ";
+            }
+        }
+        str+='\n';
+    }
+    if(!str.empty())
+        str.pop_back();
+    return str;
+}
 
 class MyDb{
 private:
     MYSQL*mysql;
+    string conn_host,conn_user,conn_pwd,conn_db;  // 连接参数，重连时使用
+    int conn_port;
+    unordered_map<string,MYSQL_STMT*> stmt_cache;  // 按语句文本缓存的预处理语句
+    unordered_map<string,Histogram*> stmt_hist;    // 按语句文本缓存的延迟直方图（注册表中按语句共享）
+    Histogram* stmt_histogram(const string& sql);
+    MYSQL_STMT* prepare(const string& sql);
+    void drop_stmt(const string& sql);
+    bool bind_execute(MYSQL_STMT* stmt,const string& sql,const vector<DbParam>& params);
 public:
     MyDb();
     ~MyDb();
     bool initDB(string host,string user,string pwd,string db_name,int port);
+    bool ping();//检查连接是否可用
+    bool reconnect();//用initDB时的参数重新建立连接（预处理语句缓存随之清空）
     bool exeSQL(string sql);
     bool select_one_SQL(string sql,string& str);
     bool select_many_SQL(string sql,string& str);
     int get_id(const char* name);
     string get_name(int user_id);
+    string escape(const string& str);
+    // 预处理语句接口：语句用?占位，参数绑定传入，同一连接上相同文本的语句只prepare一次
+    bool stmt_execute(const string& sql,const vector<DbParam>& params,ull* affected_rows=nullptr);
+    bool stmt_query(const string& sql,const vector<DbParam>& params,vector<DbRow>& rows);
+    void clear_stmt_cache();
+    // 文本协议接口（异步执行阶段使用，非阻塞API不支持预处理语句）
+    MYSQL* handle(){return mysql;}
+    string format(const string& sql,const vector<DbParam>& params);//把?替换为转义后的参数
+    static void fetch_rows(MYSQL_RES* res,vector<DbRow>& rows);//文本结果集转换为DbRow
+    bool text_query(const string& sql,vector<DbRow>& rows,ull* affected_rows=nullptr);//阻塞执行一条已格式化的语句
 };
 
+MYSQL_STMT* MyDb::prepare(const string& sql){
+    auto it=stmt_cache.find(sql);
+    if(it!=stmt_cache.end()){
+        return it->second;
+    }
+    MYSQL_STMT* stmt=mysql_stmt_init(mysql);
+    if(!stmt){
+        LOG_DB_ERROR(sql,"mysql_stmt_init failed",ERR_DB_EXECUTE_FAIL);
+        return nullptr;
+    }
+    if(mysql_stmt_prepare(stmt,sql.c_str(),sql.size())){
+        LOG_DB_ERROR(sql,string("prepare failed: ")+mysql_stmt_error(stmt),ERR_DB_QUERY_FAIL);
+        mysql_stmt_close(stmt);
+        return nullptr;
+    }
+    stmt_cache[sql]=stmt;
+    return stmt;
+}
+
+void MyDb::drop_stmt(const string& sql){
+    // 出错（如连接断开）后语句句柄可能已失效，下次使用时重新prepare
+    auto it=stmt_cache.find(sql);
+    if(it!=stmt_cache.end()){
+        mysql_stmt_close(it->second);
+        stmt_cache.erase(it);
+    }
+}
+
+void MyDb::clear_stmt_cache(){
+    for(auto&it:stmt_cache){
+        mysql_stmt_close(it.second);
+    }
+    stmt_cache.clear();
+}
+
+bool MyDb::bind_execute(MYSQL_STMT* stmt,const string& sql,const vector<DbParam>& params){
+    if(mysql_stmt_param_count(stmt)!=params.size()){
+        LOG_DB_ERROR(sql,"parameter count mismatch",ERR_PARAMETER_INVALID);
+        return false;
+    }
+    vector<MYSQL_BIND> binds(params.size());
+    vector<unsigned long> lengths(params.size());
+    for(size_t i=0;i<params.size();i++){
+        MYSQL_BIND&b=binds[i];
+        memset(&b,0,sizeof(b));
+        if(params[i].is_int){
+            b.buffer_type=MYSQL_TYPE_LONGLONG;
+            b.buffer=(void*)&params[i].num;
+        }
+        else{
+            lengths[i]=params[i].str.size();
+            b.buffer_type=MYSQL_TYPE_STRING;
+            b.buffer=(void*)params[i].str.data();
+            b.buffer_length=lengths[i];
+            b.length=&lengths[i];
+        }
+    }
+    if(!binds.empty()&&mysql_stmt_bind_param(stmt,binds.data())){
+        LOG_DB_ERROR(sql,string("bind param failed: ")+mysql_stmt_error(stmt),ERR_DB_EXECUTE_FAIL);
+        return false;
+    }
+    if(mysql_stmt_execute(stmt)){
+        LOG_DB_ERROR(sql,string("execute failed: ")+mysql_stmt_error(stmt),ERR_DB_QUERY_FAIL);
+        return false;
+    }
+    return true;
+}
+
+Histogram* MyDb::stmt_histogram(const string& sql){
+    // 连接只被一个线程使用，本地缓存避免每次查询都锁注册表
+    Histogram*&h=stmt_hist[sql];
+    if(h==nullptr){
+        h=Metrics::getInstance()->histogram("chatroom_db_stmt_us",Metrics::label("sql",sql));
+    }
+    return h;
+}
+
+bool MyDb::stmt_execute(const string& sql,const vector<DbParam>& params,ull* affected_rows){
+    ScopedTimer timer(stmt_histogram(sql));
+    TraceDbSpan span(sql);
+    MYSQL_STMT* stmt=prepare(sql);
+    if(!stmt)return false;
+    if(!bind_execute(stmt,sql,params)){
+        drop_stmt(sql);
+        return false;
+    }
+    if(affected_rows){
+        *affected_rows=mysql_stmt_affected_rows(stmt);
+    }
+    return true;
+}
+
+bool MyDb::stmt_query(const string& sql,const vector<DbParam>& params,vector<DbRow>& rows){
+    ScopedTimer timer(stmt_histogram(sql));
+    TraceDbSpan span(sql);
+    MYSQL_STMT* stmt=prepare(sql);
+    if(!stmt)return false;
+    if(!bind_execute(stmt,sql,params)){
+        drop_stmt(sql);
+        return false;
+    }
+    MYSQL_RES* meta=mysql_stmt_result_metadata(stmt);
+    if(!meta){
+        LOG_DB_ERROR(sql,"statement returned no result set",ERR_DB_NO_RESULT);
+        mysql_stmt_free_result(stmt);
+        return false;
+    }
+    // 让 store_result 计算每列的最大长度，以便一次分配足够的字符串缓冲
+    stmt_bool update_max=1;
+    mysql_stmt_attr_set(stmt,STMT_ATTR_UPDATE_MAX_LENGTH,&update_max);
+    if(mysql_stmt_store_result(stmt)){
+        LOG_DB_ERROR(sql,string("store result failed: ")+mysql_stmt_error(stmt),ERR_DB_QUERY_FAIL);
+        mysql_free_result(meta);
+        drop_stmt(sql);
+        return false;
+    }
+    unsigned int num_fields=mysql_num_fields(meta);
+    MYSQL_FIELD* fields=mysql_fetch_fields(meta);
+    vector<MYSQL_BIND> binds(num_fields);
+    vector<long long> nums(num_fields);
+    vector<vector<char>> bufs(num_fields);
+    vector<unsigned long> lengths(num_fields);
+    vector<bool> int_col(num_fields);
+    unique_ptr<stmt_bool[]> nulls(new stmt_bool[num_fields+1]);
+    for(unsigned int i=0;i<num_fields;i++){
+        MYSQL_BIND&b=binds[i];
+        memset(&b,0,sizeof(b));
+        enum_field_types t=fields[i].type;
+        int_col[i]=(t==MYSQL_TYPE_TINY||t==MYSQL_TYPE_SHORT||t==MYSQL_TYPE_LONG||
+                    t==MYSQL_TYPE_INT24||t==MYSQL_TYPE_LONGLONG);
+        nulls[i]=0;
+        b.is_null=&nulls[i];
+        b.length=&lengths[i];
+        if(int_col[i]){
+            b.buffer_type=MYSQL_TYPE_LONGLONG;
+            b.buffer=&nums[i];
+        }
+        else{
+            bufs[i].resize(max(fields[i].max_length,(unsigned long)64)+1);
+            b.buffer_type=MYSQL_TYPE_STRING;
+            b.buffer=bufs[i].data();
+            b.buffer_length=bufs[i].size();
+        }
+    }
+    bool ok=true;
+    if(num_fields>0&&mysql_stmt_bind_result(stmt,binds.data())){
+        LOG_DB_ERROR(sql,string("bind result failed: ")+mysql_stmt_error(stmt),ERR_DB_QUERY_FAIL);
+        ok=false;
+    }
+    while(ok){
+        int ret=mysql_stmt_fetch(stmt);
+        if(ret==MYSQL_NO_DATA)break;
+        if(ret==1){
+            LOG_DB_ERROR(sql,string("fetch failed: ")+mysql_stmt_error(stmt),ERR_DB_QUERY_FAIL);
+            ok=false;
+            break;
+        }
+        DbRow row(num_fields);
+        for(unsigned int i=0;i<num_fields;i++){
+            DbValue&v=row[i];
+            v.is_null=nulls[i]!=0;
+            v.is_int=int_col[i];
+            v.num=int_col[i]?nums[i]:0;
+            if(!v.is_null&&!int_col[i]){
+                v.str.assign(bufs[i].data(),min(lengths[i],(unsigned long)bufs[i].size()));
+            }
+        }
+        rows.push_back(std::move(row));
+    }
+    mysql_free_result(meta);
+    mysql_stmt_free_result(stmt);
+    return ok;
+}
+
+// 转义字符串，用于拼接到SQL的字符串字面量中
+string MyDb::escape(const string& str){
+    string out;
+    out.resize(str.size()*2+1);
+    unsigned long n=mysql_real_escape_string(mysql,&out[0],str.data(),str.size());
+    out.resize(n);
+    return out;
+}
+
 
 string MyDb::get_name(int user_id){
     if(mysql==NULL){
         LOG_ERROR("MySQL connection not initialized",ERR_DB_CONNECTION_FAIL);
         return "";
     }
-    string sql="select user_name from user where user_id="+to_string(user_id);
-    if(mysql_query(mysql,sql.c_str())){
-        LOG_DB_ERROR(sql,"get_name query failed",ERR_DB_QUERY_FAIL);
+    vector<DbRow> rows;
+    if(!stmt_query("select user_name from user where user_id=?",{user_id},rows)){
+        LOG_ERROR("get_name query failed for user_id: "+to_string(user_id),ERR_DB_QUERY_FAIL);
         return "";
     }
-    MYSQL_RES* result=mysql_store_result(mysql);  // 使用局部变量
-    if(!result)return "";
-    MYSQL_ROW row=mysql_fetch_row(result);         // 使用局部变量
-    if(!row||!row[0]){
-        mysql_free_result(result);
+    if(rows.empty()||rows[0][0].is_null){
         return "";
     }
-    string name=row[0];
-    mysql_free_result(result);
-    return name;
+    return rows[0][0].str;
 }
 int MyDb::get_id(const char* name){
     if(name==nullptr){
@@ -53,25 +299,20 @@ int MyDb::get_id(const char* name){
         LOG_ERROR("MySQL connection not initialized",ERR_DB_CONNECTION_FAIL);
         return -1;
     }
-    string sql="select user_id from user where user_name='"+string(name)+"'";
-    if(mysql_query(mysql,sql.c_str())){
-        LOG_DB_ERROR(sql,"get_id query failed for username: "+string(name),ERR_DB_QUERY_FAIL);
+    vector<DbRow> rows;
+    if(!stmt_query("select user_id from user where user_name=?",{name},rows)){
+        LOG_ERROR("get_id query failed for username: "+string(name),ERR_DB_QUERY_FAIL);
         return -1;
     }
-    MYSQL_RES* result=mysql_store_result(mysql);  // 使用局部变量
-    if(!result)return -1;
-    MYSQL_ROW row=mysql_fetch_row(result);         // 使用局部变量
-    if(!row||!row[0]){
-        mysql_free_result(result);
+    if(rows.empty()||rows[0][0].is_null){
         return -1;
     }
-    int id = atoi(row[0]);
-    mysql_free_result(result);
-    return id;
+    return (int)rows[0][0].num;
 }
 
 
 MyDb::MyDb(){
+    conn_port=3306;
     mysql=mysql_init(NULL);
     if(mysql==NULL){
         LOG_ERROR("Failed to initialize MySQL",ERR_DB_CONNECTION_FAIL);
@@ -80,14 +321,20 @@ MyDb::MyDb(){
 
 }
 MyDb::~MyDb(){
+    clear_stmt_cache();
     if(mysql){
         mysql_close(mysql);
     }
 }
 
 bool MyDb::initDB(string host,string user,string pwd,string db_name,int port=3306){
-    mysql=mysql_real_connect(mysql,host.c_str(),user.c_str(),pwd.c_str(),db_name.c_str(),port,NULL,0);
-    if(!mysql){
+    conn_host=host;
+    conn_user=user;
+    conn_pwd=pwd;
+    conn_db=db_name;
+    conn_port=port;
+    // 失败时保留句柄，便于析构时释放和之后重连
+    if(!mysql_real_connect(mysql,host.c_str(),user.c_str(),pwd.c_str(),db_name.c_str(),port,NULL,0)){
         LOG_ERROR("Failed to connect to database: "+string(db_name)+" on "+host,ERR_DB_CONNECTION_FAIL);
         return false;
     }
@@ -95,6 +342,95 @@ bool MyDb::initDB(string host,string user,string pwd,string db_name,int port=330
     return true;
 }
 
+string MyDb::format(const string& sql,const vector<DbParam>& params){
+    // 语句中的?只用作占位符（不能出现在字符串字面量里）
+    string out;
+    out.reserve(sql.size()+64);
+    size_t idx=0;
+    for(char c:sql){
+        if(c=='?'&&idx<params.size()){
+            const DbParam&p=params[idx++];
+            if(p.is_int){
+                out+=to_string(p.num);
+            }
+            else{
+                out+="'"+escape(p.str)+"'";
+            }
+        }
+        else{
+            out+=c;
+        }
+    }
+    return out;
+}
+
+void MyDb::fetch_rows(MYSQL_RES* res,vector<DbRow>& rows){
+    unsigned int num_fields=mysql_num_fields(res);
+    MYSQL_FIELD* fields=mysql_fetch_fields(res);
+    vector<bool> int_col(num_fields);
+    for(unsigned int i=0;i<num_fields;i++){
+        enum_field_types t=fields[i].type;
+        int_col[i]=(t==MYSQL_TYPE_TINY||t==MYSQL_TYPE_SHORT||t==MYSQL_TYPE_LONG||
+                    t==MYSQL_TYPE_INT24||t==MYSQL_TYPE_LONGLONG);
+    }
+    MYSQL_ROW row;
+    while((row=mysql_fetch_row(res))!=NULL){
+        unsigned long* lengths=mysql_fetch_lengths(res);
+        DbRow r(num_fields);
+        for(unsigned int i=0;i<num_fields;i++){
+            DbValue& v=r[i];
+            v.is_null=(row[i]==NULL);
+            v.is_int=int_col[i];
+            v.num=0;
+            if(v.is_null)continue;
+            if(v.is_int){
+                v.num=strtoll(row[i],NULL,10);
+            }
+            else{
+                v.str.assign(row[i],lengths[i]);
+            }
+        }
+        rows.push_back(std::move(r));
+    }
+}
+
+bool MyDb::text_query(const string& sql,vector<DbRow>& rows,ull* affected_rows){
+    if(mysql_real_query(mysql,sql.c_str(),sql.size())){
+        LOG_DB_ERROR(sql,string("query failed: ")+mysql_error(mysql),ERR_DB_QUERY_FAIL);
+        return false;
+    }
+    MYSQL_RES* res=mysql_store_result(mysql);
+    if(res){
+        fetch_rows(res,rows);
+        mysql_free_result(res);
+    }
+    else if(mysql_errno(mysql)){
+        LOG_DB_ERROR(sql,string("store result failed: ")+mysql_error(mysql),ERR_DB_QUERY_FAIL);
+        return false;
+    }
+    if(affected_rows){
+        *affected_rows=mysql_affected_rows(mysql);
+    }
+    return true;
+}
+
+bool MyDb::ping(){
+    return mysql!=NULL&&mysql_ping(mysql)==0;
+}
+
+bool MyDb::reconnect(){
+    clear_stmt_cache();
+    if(mysql){
+        mysql_close(mysql);
+    }
+    mysql=mysql_init(NULL);
+    if(mysql==NULL){
+        LOG_ERROR("Failed to initialize MySQL",ERR_DB_CONNECTION_FAIL);
+        return false;
+    }
+    return initDB(conn_host,conn_user,conn_pwd,conn_db,conn_port);
+}
+
 bool MyDb::exeSQL(string sql){
     if(mysql_query(mysql,sql.c_str())){
         LOG_DB_ERROR(sql,"SQL query failed",ERR_DB_QUERY_FAIL);
@@ -0,0 +1,125 @@
+#pragma once
+/**
+ * @file OutQueue.h
+ * @brief 每个连接的发送队列 - 处理短写和背压
+ *
+ * 事件循环把编码好的帧追加到连接的发送队列后立即尝试发送；
+ * 内核发送缓冲区满（EAGAIN）时保留剩余数据，等 EPOLLOUT 触发后继续发送。
+ * 队列中积压的字节数超过高水位时，说明对端读得太慢，由调用方断开该连接，
+ * 这样一个慢客户端不会拖住整个事件循环，也不会无限占用内存。
+ *
+ * 队列中保存的是共享帧（SharedFrame）的引用：广播/多播时同一条消息只编码
+ * 一次，所有接收者的队列引用同一块内存，发送时用 writev（sendmsg）一次写出多帧。
+ *
+ * 追加帧时可以附带 on_sent 回调，帧的最后一个字节写入套接字后在事件循环线程中
+ * 调用（例如离线消息写出后再标记为已读）。连接关闭时未发送完的帧连同回调一起丢弃。
+ */
+
+#include <deque>
+#include <cstring>
+#include <string>
+#include <memory>
+#include <functional>
+#include <sys/socket.h>
+#include <sys/uio.h>
+#include <errno.h>
+
+using namespace std;
+
+#define OUT_QUEUE_HIGH_WATER (1024 * 1024)  // 单个连接最多积压1MB未发送数据
+#define OUT_QUEUE_MAX_IOV 64                // 单次 writev 最多携带的帧数
+
+// 已编码（含长度前缀）的只读帧，按引用计数在多个连接间共享
+typedef shared_ptr<const string> SharedFrame;
+
+// flush() 的返回值
+enum FlushResult {
+    FLUSH_DONE,   // 队列已清空
+    FLUSH_AGAIN,  // 内核缓冲区已满，需要等待 EPOLLOUT
+    FLUSH_ERROR   // 发送出错，连接应当关闭
+};
+
+// 帧写完后的回调（在事件循环线程中执行，不能再操作同一个发送队列）
+typedef function<void()> SentCallback;
+
+class OutQueue {
+private:
+    struct Chunk {
+        SharedFrame frame;
+        SentCallback on_sent;
+    };
+    deque<Chunk> chunks;        // 待发送的帧
+    size_t head_offset;     // 队首帧已发送的字节数
+    size_t pending;         // 队列中尚未发送的总字节数
+public:
+    bool watching_out;      // 是否已在epoll中注册 EPOLLOUT
+    bool close_when_drained;// 发送完毕后关闭连接（如 "bye"）
+
+    OutQueue() : head_offset(0), pending(0), watching_out(false), close_when_drained(false) {}
+
+    /**
+     * @brief 追加一帧数据
+     * @return 积压字节数未超过高水位返回true
+     */
+    bool append(const SharedFrame& frame, const SentCallback& on_sent = nullptr) {
+        pending += frame->size();
+        chunks.push_back(Chunk{frame, on_sent});
+        return pending <= OUT_QUEUE_HIGH_WATER;
+    }
+
+    bool empty() const {
+        return chunks.empty();
+    }
+
+    size_t size() const {
+        return pending;
+    }
+
+    /**
+     * @brief 尽可能多地把队列中的数据写入套接字（非阻塞）
+     */
+    FlushResult flush(int fd) {
+        struct iovec iov[OUT_QUEUE_MAX_IOV];
+        while (!chunks.empty()) {
+            int iov_cnt = 0;
+            for (auto it = chunks.begin(); it != chunks.end() && iov_cnt < OUT_QUEUE_MAX_IOV; ++it, ++iov_cnt) {
+                size_t skip = (iov_cnt == 0) ? head_offset : 0;
+                iov[iov_cnt].iov_base = (void*)(it->frame->data() + skip);
+                iov[iov_cnt].iov_len = it->frame->size() - skip;
+            }
+            // 等价于 writev，但可以带 MSG_NOSIGNAL，对端关闭时不会触发 SIGPIPE
+            struct msghdr msg;
+            memset(&msg, 0, sizeof(msg));
+            msg.msg_iov = iov;
+            msg.msg_iovlen = iov_cnt;
+            ssize_t n = sendmsg(fd, &msg, MSG_NOSIGNAL);
+            if (n < 0) {
+                if (errno == EINTR) {
+                    continue;
+                }
+                if (errno == EAGAIN || errno == EWOULDBLOCK) {
+                    return FLUSH_AGAIN;
+                }
+                return FLUSH_ERROR;
+            }
+            pending -= n;
+            // 按写出的字节数依次弹出已发送完的帧
+            size_t written = n;
+            while (written > 0) {
+                size_t left = chunks.front().frame->size() - head_offset;
+                if (written < left) {
+                    head_offset += written;
+                    break;
+                }
+                written -= left;
+                SentCallback on_sent = std::move(chunks.front().on_sent);
+                chunks.pop_front();
+                head_offset = 0;
+                if (on_sent) {
+                    on_sent();
+                }
+            }
+        }
+        return FLUSH_DONE;
+    }
+};
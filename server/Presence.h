@@ -0,0 +1,75 @@
+#pragma once
+/**
+ * @file Presence.h
+ * @brief 在线用户索引 - 按用户名有序的内存在线列表
+ *
+ * 登录成功时加入、连接关闭（主动退出、超时、断线）时移除，与 clint_nametofd
+ * 同步维护，show_online_user 直接从这里读取，不再查询数据库。
+ * 用户名按字典序保存，支持按前缀过滤和"从某个用户名之后"继续分页。
+ */
+
+#include <set>
+#include <string>
+#include <vector>
+#include <pthread.h>
+
+using namespace std;
+
+class PresenceIndex {
+private:
+    set<string> names;
+    pthread_mutex_t mutex;
+public:
+    PresenceIndex() {
+        pthread_mutex_init(&mutex, nullptr);
+    }
+
+    ~PresenceIndex() {
+        pthread_mutex_destroy(&mutex);
+    }
+
+    void add(const string& name) {
+        pthread_mutex_lock(&mutex);
+        names.insert(name);
+        pthread_mutex_unlock(&mutex);
+    }
+
+    void remove(const string& name) {
+        pthread_mutex_lock(&mutex);
+        names.erase(name);
+        pthread_mutex_unlock(&mutex);
+    }
+
+    size_t size() {
+        pthread_mutex_lock(&mutex);
+        size_t n = names.size();
+        pthread_mutex_unlock(&mutex);
+        return n;
+    }
+
+    /**
+     * @brief 按字典序取一页在线用户
+     * @param prefix 只返回以 prefix 开头的用户名（空串表示不过滤）
+     * @param after 只返回字典序大于 after 的用户名（空串表示从头开始）
+     * @param limit 最多返回的个数，0 表示不限制
+     * @param out 输出的用户名
+     * @return 因 limit 截断、之后还有符合条件的用户时返回true
+     */
+    bool page(const string& prefix, const string& after, size_t limit, vector<string>& out) {
+        pthread_mutex_lock(&mutex);
+        auto it = after.empty() || after < prefix ? names.lower_bound(prefix) : names.upper_bound(after);
+        bool more = false;
+        for (; it != names.end(); ++it) {
+            if (it->compare(0, prefix.size(), prefix) != 0) {
+                break;  // 已经越过前缀范围
+            }
+            if (limit > 0 && out.size() >= limit) {
+                more = true;
+                break;
+            }
+            out.push_back(*it);
+        }
+        pthread_mutex_unlock(&mutex);
+        return more;
+    }
+};
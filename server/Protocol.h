@@ -12,12 +12,22 @@
  * 例如:
  * 消息 "sign_up|user|pass" (16个字节)
  * 协议格式: 0x00 0x00 0x00 0x10 sign_up|user|pass
+ *
+ * 分片（续帧）：单帧数据不超过 PROTOCOL_MAX_MESSAGE_SIZE，更长的消息拆成多帧发送，
+ * 除最后一帧外长度字段的最高位（PROTOCOL_CONTINUATION_FLAG）置1，表示后面还有
+ * 同一条消息的分片；接收方按顺序拼接，直到收到最高位为0的帧。一条消息所有分片
+ * 合计不超过 PROTOCOL_MAX_ASSEMBLED_SIZE。不超过单帧上限的消息编码与原来完全相同。
+ *
+ * 压缩：协商了压缩的连接上，长度字段次高位（PROTOCOL_COMPRESSED_FLAG）置1的帧
+ * 数据是压缩后的消息（见 Compression.h），拼接完所有分片后再解压。
  */
 
 #include <cstring>
 #include <cstdint>
+#include <algorithm>
 #include <string>
 #include <iostream>
+#include <poll.h>
 
 using namespace std;
 
@@ -25,6 +35,11 @@ using namespace std;
 #define PROTOCOL_HEADER_SIZE 4      // 头部大小（4字节长度字段）
 #define PROTOCOL_MAX_MESSAGE_SIZE 4096  // 单条消息最大大小 (4KB)
 #define PROTOCOL_MAX_TOTAL_SIZE (PROTOCOL_HEADER_SIZE + PROTOCOL_MAX_MESSAGE_SIZE)  // 总大小
+#define PROTOCOL_SEND_TIMEOUT_MS 5000  // sendMessage 等待套接字可写的最长时间
+#define PROTOCOL_CONTINUATION_FLAG 0x80000000u  // 长度字段最高位：后面还有同一条消息的分片
+#define PROTOCOL_COMPRESSED_FLAG 0x40000000u    // 长度字段次高位：消息经过 deflate 压缩
+#define PROTOCOL_LENGTH_MASK 0x3fffffffu
+#define PROTOCOL_MAX_ASSEMBLED_SIZE (256 * 1024)  // 一条分片消息拼接后的上限（每个连接的重组预算）
 
 // ==================== 协议函数 ====================
 
@@ -37,28 +52,84 @@ using namespace std;
  * input:  "sign_up|user|pass"
  * output: "\0\0\0\x10sign_up|user|pass"
  */
+inline void encodeMessageTo(string& out, const char* data, size_t len, uint32_t flags = 0);
+
 inline string encodeMessage(const string& message) {
-    // 消息长度（4字节，大端序）
-    uint32_t msg_len = htonl(message.length());
-    
-    // 创建编码后的消息
+    // 创建编码后的消息（超过单帧上限时自动分片）
     string encoded;
-    encoded.resize(PROTOCOL_HEADER_SIZE + message.length());
-    
-    // 复制长度字段（大端序）
-    memcpy(encoded.data(), &msg_len, PROTOCOL_HEADER_SIZE);
-    
-    // 复制数据字段
-    memcpy(encoded.data() + PROTOCOL_HEADER_SIZE, message.data(), message.length());
+    encodeMessageTo(encoded, message.data(), message.length());
     cout<<"编码信息："<<encoded<<endl;
     return encoded;
 }
 
+/**
+ * @brief 将消息编码后追加到 out 末尾（不打印、不产生临时字符串）
+ * @param out 输出缓冲区
+ * @param data 消息内容
+ * @param len 消息长度，超过 PROTOCOL_MAX_MESSAGE_SIZE 时拆成多个续帧
+ * @param flags 附加到每一帧长度字段上的标志（如 PROTOCOL_COMPRESSED_FLAG）
+ */
+inline void encodeMessageTo(string& out, const char* data, size_t len, uint32_t flags) {
+    size_t chunks = len == 0 ? 1 : (len + PROTOCOL_MAX_MESSAGE_SIZE - 1) / PROTOCOL_MAX_MESSAGE_SIZE;
+    out.reserve(out.size() + chunks * PROTOCOL_HEADER_SIZE + len);
+    size_t pos = 0;
+    do {
+        size_t chunk = min(len - pos, (size_t)PROTOCOL_MAX_MESSAGE_SIZE);
+        uint32_t field = chunk | flags;
+        if (pos + chunk < len) {
+            field |= PROTOCOL_CONTINUATION_FLAG;
+        }
+        uint32_t msg_len = htonl(field);
+        out.append((const char*)&msg_len, PROTOCOL_HEADER_SIZE);
+        out.append(data + pos, chunk);
+        pos += chunk;
+    } while (pos < len);
+}
+
+/**
+ * @brief 从接收缓冲区中取出一帧（不拷贝数据）
+ * @param body 输出帧数据的起始位置（指向 buffer 内部）
+ * @param body_len 输出帧数据长度
+ * @param more 输出是否为续帧（后面还有同一条消息的分片）
+ * @param compressed 非空时输出帧数据是否经过压缩；为空时压缩帧视为长度无效
+ * @return -1: 数据不完整; -2: 长度无效; >0: 消费的字节数
+ */
+inline int extractFrame(const char* buffer, size_t buffer_len, const char*& body, size_t& body_len, bool& more,
+                        bool* compressed = nullptr) {
+    if (buffer_len < PROTOCOL_HEADER_SIZE) {
+        return -1;
+    }
+    uint32_t field;
+    memcpy(&field, buffer, PROTOCOL_HEADER_SIZE);
+    field = ntohl(field);
+    more = (field & PROTOCOL_CONTINUATION_FLAG) != 0;
+    uint32_t msg_len = field & PROTOCOL_LENGTH_MASK;
+    if (msg_len == 0 || msg_len > PROTOCOL_MAX_MESSAGE_SIZE) {
+        return -2;
+    }
+    if (field & PROTOCOL_COMPRESSED_FLAG) {
+        if (compressed == nullptr) {
+            return -2;  // 服务器不接收压缩帧
+        }
+        *compressed = true;
+    }
+    else if (compressed != nullptr) {
+        *compressed = false;
+    }
+    if (buffer_len < PROTOCOL_HEADER_SIZE + msg_len) {
+        return -1;
+    }
+    body = buffer + PROTOCOL_HEADER_SIZE;
+    body_len = msg_len;
+    return PROTOCOL_HEADER_SIZE + msg_len;
+}
+
 /**
  * @brief 从接收缓冲区中提取一条完整的消息
  * @param buffer 接收缓冲区
  * @param buffer_len 缓冲区中已有数据的长度
  * @param message 存储提取的消息（不包括长度前缀）
+ * @param more 非空时输出该帧是否为续帧（message 只是一个分片，需要与后续分片拼接）
  * @return -1: 数据不完整，需要继续接收; >=0: 消费的字节数
  * 
  * 使用例:
@@ -75,52 +146,67 @@ inline string encodeMessage(const string& message) {
  *     memmove(buffer, buffer + consumed, len);
  * }
  */
-inline int extractMessage(const char* buffer, size_t buffer_len, string& message) {
-    // 检查是否有完整的头部
-    if (buffer_len < PROTOCOL_HEADER_SIZE) {
-        return -1;  // 头部不完整
-    }
-    
-    // 读取消息长度（大端序）
-    uint32_t msg_len;
-    memcpy(&msg_len, buffer, PROTOCOL_HEADER_SIZE);
-    msg_len = ntohl(msg_len);
-    
-    // 验证消息长度的有效性
-    if (msg_len == 0 || msg_len > PROTOCOL_MAX_MESSAGE_SIZE) {
-        cerr << "Error: Invalid message length: " << msg_len << endl;
+inline int extractMessage(const char* buffer, size_t buffer_len, string& message, bool* more = nullptr) {
+    const char* body;
+    size_t body_len;
+    bool continued;
+    int consumed = extractFrame(buffer, buffer_len, body, body_len, continued);
+    if (consumed == -2 || (consumed > 0 && continued && more == nullptr)) {
+        // 不处理分片的调用方（more 为空）把续帧也当作无效长度
+        cerr << "Error: Invalid message length" << endl;
         return -2;  // 消息长度无效
     }
-    
-    // 检查是否有完整的消息
-    size_t total_needed = PROTOCOL_HEADER_SIZE + msg_len;
-    if (buffer_len < total_needed) {
+    if (consumed < 0) {
         return -1;  // 消息不完整，需要继续接收
     }
     
-    // 提取消息内容
-    message.assign(buffer + PROTOCOL_HEADER_SIZE, msg_len);
+    // 提取消息内容（续帧时只是消息的一个分片）
+    message.assign(body, body_len);
+    if (more != nullptr) {
+        *more = continued;
+    }
     
     // 返回消费的字节数
-    return total_needed;
+    return consumed;
 }
 
+inline bool sendEncoded(int fd, const string& encoded);
+
 /**
  * @brief 发送编码后的消息
  * @param fd 套接字文件描述符
  * @param message 消息内容（不包括长度前缀）
  * @return 成功返回true，失败返回false
  * 
- * 这个函数会自动编码消息并发送
+ * 这个函数会自动编码消息并发送。非阻塞套接字遇到 EAGAIN 时用 poll()
+ * 等待可写（最多 PROTOCOL_SEND_TIMEOUT_MS），而不是空转重试。
+ * 服务器端不使用此函数，而是通过连接的发送队列（OutQueue.h）发送。
  */
 inline bool sendMessage(int fd, const string& message) {
-    string encoded = encodeMessage(message);
-    
+    return sendEncoded(fd, encodeMessage(message));
+}
+
+/**
+ * @brief 发送已编码好的帧（含长度前缀），v2 帧用 textToFrameV2/encodeFrameV2To 生成后调用
+ */
+inline bool sendEncoded(int fd, const string& encoded) {
     size_t total = 0;
     while (total < encoded.length()) {
-        int n = send(fd, encoded.c_str() + total, encoded.length() - total, 0);
+        int n = send(fd, encoded.c_str() + total, encoded.length() - total, MSG_NOSIGNAL);
         if (n < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
             if (errno == EAGAIN || errno == EWOULDBLOCK) {
+                struct pollfd pfd;
+                pfd.fd = fd;
+                pfd.events = POLLOUT;
+                pfd.revents = 0;
+                int ready = poll(&pfd, 1, PROTOCOL_SEND_TIMEOUT_MS);
+                if (ready <= 0) {
+                    cerr << "Error sending message: socket not writable" << endl;
+                    return false;
+                }
                 continue;
             } else {
                 cerr << "Error sending message: " << strerror(errno) << endl;
@@ -202,3 +288,192 @@ inline int receiveMessage(int fd, string& message, char* buffer, int& buffer_pos
     
     return -1;  // 消息不完整，需要继续接收
 }
+
+// ==================== 协议 v2（二进制帧体） ====================
+/*
+ * v2 仍使用上面的4字节长度前缀，只是把帧体从 "cmd|code|data" 文本换成二进制：
+ * [version(1)=2][opcode(1)][flags(2)][request_id(4)][字段1长度(2)][字段1]...[字段N长度(2)][字段N]
+ * 多字节整数均为大端序，flags 目前保留为0。
+ *
+ * 协商：连接建立后默认 v1。客户端发送 v1 文本 "hello|2"，服务器回复 "hello|1|2"
+ * 之后，服务器发往该连接的帧全部改用 v2。客户端发来的帧按首字节区分（v2 首字节
+ * 为 2，v1 文本命令首字节总是可见字符），不需要等协商完成。
+ *
+ * 请求字段就是 v1 命令中 '|' 分隔的各个参数（不含命令名）；响应字段为
+ * [状态码, 数据]。响应的 request_id 与对应请求相同，服务器主动推送的帧为 0，
+ * 客户端据此可以不等回复连续发送多个请求（pipeline）。
+ */
+#define PROTOCOL_V2 2
+#define PROTOCOL_V2_HEADER_SIZE 8
+#define PROTOCOL_V2_MAX_FIELDS 8
+
+enum Opcode : uint8_t {
+    OP_INVALID = 0,
+    OP_HELLO,
+    OP_SIGN_UP,
+    OP_SIGN_IN,
+    OP_RESUME,
+    OP_SHOW_ONLINE_USER,
+    OP_SINGLE_CHAT,
+    OP_MULTI_CHAT,
+    OP_BROADCAST_CHAT,
+    OP_SHOW_HISTORY,
+    OP_HEARTBEAT,
+    OP_QUIT,         // 请求 q，响应 bye
+    OP_CHAT_UNREAD,  // 仅服务器推送
+    OP_SESSION,      // 仅服务器推送
+    OP_COUNT
+};
+
+/**
+ * @brief opcode 对应的 v1 命令名
+ */
+inline const char* opcodeName(uint8_t opcode) {
+    static const char* const names[OP_COUNT] = {
+        "", "hello", "sign_up", "sign_in", "resume", "show_online_user", "single_chat",
+        "multi_chat", "broadcast_chat", "show_history", "heartbeat", "q", "chat_unread", "session"
+    };
+    return opcode < OP_COUNT ? names[opcode] : "";
+}
+
+/**
+ * @brief v1 命令名转 opcode（忽略末尾换行，q/Q/bye 都对应 OP_QUIT）
+ * @return 未知命令返回 OP_INVALID
+ */
+inline uint8_t opcodeFromName(const char* name, size_t len) {
+    while (len > 0 && (name[len - 1] == '\n' || name[len - 1] == '\r')) {
+        len--;
+    }
+    if ((len == 1 && (name[0] == 'q' || name[0] == 'Q')) || (len == 3 && memcmp(name, "bye", 3) == 0)) {
+        return OP_QUIT;
+    }
+    for (uint8_t op = OP_HELLO; op < OP_COUNT; op++) {
+        const char* candidate = opcodeName(op);
+        if (strlen(candidate) == len && memcmp(candidate, name, len) == 0) {
+            return op;
+        }
+    }
+    return OP_INVALID;
+}
+
+/**
+ * @brief 指向帧内数据的字段（不拷贝）
+ */
+struct FieldRef {
+    const char* data;
+    size_t len;
+    string str() const {
+        return string(data, len);
+    }
+};
+
+/**
+ * @brief 解析后的 v2 帧，字段指向原始帧体
+ */
+struct FrameV2 {
+    uint8_t opcode;
+    uint16_t flags;
+    uint32_t request_id;
+    int field_count;
+    FieldRef fields[PROTOCOL_V2_MAX_FIELDS];
+};
+
+inline bool isFrameV2(const char* body, size_t len) {
+    return len >= PROTOCOL_V2_HEADER_SIZE && (uint8_t)body[0] == PROTOCOL_V2;
+}
+
+/**
+ * @brief 解析 v2 帧体（不含4字节长度前缀）
+ * @return 版本不对、字段越界或字段过多时返回false
+ */
+inline bool decodeFrameV2(const char* body, size_t len, FrameV2& frame) {
+    if (!isFrameV2(body, len)) {
+        return false;
+    }
+    const uint8_t* p = (const uint8_t*)body;
+    frame.opcode = p[1];
+    frame.flags = (uint16_t)(p[2] << 8 | p[3]);
+    frame.request_id = (uint32_t)p[4] << 24 | (uint32_t)p[5] << 16 | (uint32_t)p[6] << 8 | p[7];
+    frame.field_count = 0;
+    size_t pos = PROTOCOL_V2_HEADER_SIZE;
+    while (pos < len) {
+        if (frame.field_count == PROTOCOL_V2_MAX_FIELDS || len - pos < 2) {
+            return false;
+        }
+        size_t field_len = (size_t)(p[pos] << 8 | p[pos + 1]);
+        pos += 2;
+        if (len - pos < field_len) {
+            return false;
+        }
+        frame.fields[frame.field_count++] = FieldRef{body + pos, field_len};
+        pos += field_len;
+    }
+    return true;
+}
+
+/**
+ * @brief 把一个 v2 帧（含4字节长度前缀）追加到 out 末尾
+ */
+inline void encodeFrameV2To(string& out, uint8_t opcode, uint32_t request_id, const FieldRef* fields, int count,
+                            uint16_t flags = 0) {
+    size_t body_len = PROTOCOL_V2_HEADER_SIZE;
+    for (int i = 0; i < count; i++) {
+        body_len += 2 + min(fields[i].len, (size_t)0xffff);
+    }
+    string body;
+    body.reserve(body_len);
+    char header[PROTOCOL_V2_HEADER_SIZE] = {
+        (char)PROTOCOL_V2, (char)opcode, (char)(flags >> 8), (char)(flags & 0xff),
+        (char)(request_id >> 24), (char)(request_id >> 16), (char)(request_id >> 8), (char)request_id
+    };
+    body.append(header, PROTOCOL_V2_HEADER_SIZE);
+    for (int i = 0; i < count; i++) {
+        size_t field_len = min(fields[i].len, (size_t)0xffff);
+        char prefix[2] = {(char)(field_len >> 8), (char)(field_len & 0xff)};
+        body.append(prefix, 2);
+        body.append(fields[i].data, field_len);
+    }
+    encodeMessageTo(out, body.data(), body.size());  // 帧体较长时拆成续帧
+}
+
+/**
+ * @brief 把 v1 文本按 '|' 切成最多 max 段（保留空段，最后一段包含剩余的全部内容）
+ * @return 段数
+ */
+inline int splitTextFields(const char* text, size_t len, FieldRef* fields, int max) {
+    int count = 0;
+    size_t begin = 0;
+    while (count < max) {
+        const char* bar = count + 1 < max ? (const char*)memchr(text + begin, '|', len - begin) : nullptr;
+        size_t end = bar ? (size_t)(bar - text) : len;
+        fields[count++] = FieldRef{text + begin, end - begin};
+        if (!bar) {
+            break;
+        }
+        begin = end + 1;
+    }
+    return count;
+}
+
+/**
+ * @brief 把 v1 文本转换为 v2 帧（含长度前缀）追加到 out
+ * @param response true 表示 "cmd|code|data" 响应（data 中的 '|' 原样保留），
+ *                 false 表示 "cmd|arg1|arg2..." 请求
+ * @return 命令名未知时返回false
+ */
+inline bool textToFrameV2(string& out, const char* text, size_t len, uint32_t request_id, bool response) {
+    FieldRef parts[PROTOCOL_V2_MAX_FIELDS + 1];
+    int n = splitTextFields(text, len, parts, response ? 3 : PROTOCOL_V2_MAX_FIELDS + 1);
+    uint8_t opcode = opcodeFromName(parts[0].data, parts[0].len);
+    if (opcode == OP_INVALID) {
+        return false;
+    }
+    if (response && n == 1) {
+        // 只有命令名的响应（如 "bye\n"）视为成功
+        static const char ok[] = "1";
+        parts[1] = FieldRef{ok, 1};
+        n = 2;
+    }
+    encodeFrameV2To(out, opcode, request_id, parts + 1, n - 1);
+    return true;
+}
@@ -0,0 +1,104 @@
+#pragma once
+/**
+ * @file Ring.h
+ * @brief 有界无锁多生产者单消费者（MPSC）环形队列
+ *
+ * 用于工作线程向事件循环投递响应：任意多个线程可以同时 push，只有所属的
+ * 事件循环线程 pop。每个槽带一个序号（sequence），生产者用 CAS 抢占写入
+ * 位置，写完数据后再发布序号，消费者看到序号就绪才读取，全程不加锁。
+ *
+ * 容量必须是2的幂。队列满时 push 返回false，由调用方决定等待还是丢弃。
+ */
+
+#include <atomic>
+#include <vector>
+#include <cstddef>
+
+using namespace std;
+
+template <typename T>
+class MpscRing {
+private:
+    struct Cell {
+        atomic<size_t> sequence;
+        T data;
+    };
+    vector<Cell> cells;
+    size_t mask;
+    // 生产者和消费者的位置分开放在不同的缓存行，避免伪共享
+    alignas(64) atomic<size_t> tail;  // 下一个写入位置（生产者）
+    alignas(64) atomic<size_t> head;  // 下一个读取位置（仅消费者写入，size() 可从任意线程读取）
+
+public:
+    /**
+     * @param capacity 槽数量，必须是2的幂
+     */
+    explicit MpscRing(size_t capacity) : cells(capacity), mask(capacity - 1), tail(0), head(0) {
+        for (size_t i = 0; i < capacity; i++) {
+            cells[i].sequence.store(i, memory_order_relaxed);
+        }
+    }
+
+    MpscRing(const MpscRing&) = delete;
+    MpscRing& operator=(const MpscRing&) = delete;
+
+    /**
+     * @brief 写入一个元素（任意线程）
+     * @return 队列已满返回false
+     */
+    bool push(T&& value) {
+        size_t pos = tail.load(memory_order_relaxed);
+        Cell* cell;
+        while (1) {
+            cell = &cells[pos & mask];
+            size_t seq = cell->sequence.load(memory_order_acquire);
+            long diff = (long)seq - (long)pos;
+            if (diff == 0) {
+                if (tail.compare_exchange_weak(pos, pos + 1, memory_order_relaxed)) {
+                    break;
+                }
+            }
+            else if (diff < 0) {
+                return false;  // 消费者还没取走这一圈的数据，队列满
+            }
+            else {
+                pos = tail.load(memory_order_relaxed);
+            }
+        }
+        cell->data = std::move(value);
+        cell->sequence.store(pos + 1, memory_order_release);
+        return true;
+    }
+
+    /**
+     * @brief 取出一个元素（仅消费者线程）
+     * @return 队列为空（或队首元素尚未发布完成）返回false
+     */
+    bool pop(T& value) {
+        size_t pos = head.load(memory_order_relaxed);
+        Cell* cell = &cells[pos & mask];
+        size_t seq = cell->sequence.load(memory_order_acquire);
+        if ((long)seq - (long)(pos + 1) < 0) {
+            return false;
+        }
+        value = std::move(cell->data);
+        cell->data = T();  // 尽早释放共享帧等资源
+        cell->sequence.store(pos + mask + 1, memory_order_release);
+        head.store(pos + 1, memory_order_relaxed);
+        return true;
+    }
+
+    /**
+     * @brief 近似的元素个数（任意线程，用于监控）
+     * 包含已抢占位置但尚未发布完成的元素
+     */
+    size_t size() const {
+        size_t t = tail.load(memory_order_relaxed);
+        size_t h = head.load(memory_order_relaxed);
+        return t > h ? t - h : 0;
+    }
+
+    size_t capacity() const {
+        return mask + 1;
+    }
+};
@@ -0,0 +1,183 @@
+#pragma once
+/**
+ * @file SessionTable.h
+ * @brief 会话令牌表 - 断线重连时用 resume|token 恢复会话，跳过密码校验和数据库查询
+ *
+ * 登录成功后为用户签发一个不透明的随机令牌（32位十六进制），保存在内存中：
+ * - 每个用户同时只有一个有效令牌，重新登录会使旧令牌失效；
+ * - 令牌在签发（或上次恢复）SESSION_TTL_SEC 秒后过期，由定时器定期清理；
+ * - resume 成功后轮换令牌，旧令牌立即失效，防止被重放；
+ * - 记录已确认送达的最后一条离线消息id，恢复时只推送之后到达的消息；
+ * - 用户主动退出（q）时撤销令牌。
+ * 令牌只在内存中，服务器重启后全部失效，客户端回退到 sign_in。
+ */
+
+#include <string>
+#include <unordered_map>
+#include <pthread.h>
+#include <time.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include "Logger.h"
+#include "ErrorCode.h"
+
+using namespace std;
+
+#define SESSION_TTL_SEC 1800  // 令牌有效期
+#define SESSION_TOKEN_BYTES 16
+
+struct Session {
+    int user_id;
+    string user_name;
+    long long last_id;  // 已确认送达的最后一条离线消息id
+    time_t expires;
+};
+
+class SessionTable {
+private:
+    unordered_map<string, Session> sessions;  // token -> 会话
+    unordered_map<int, string> user_token;    // user_id -> 当前有效的token
+    pthread_mutex_t mutex;
+    int random_fd;
+
+    string newToken() {
+        unsigned char bytes[SESSION_TOKEN_BYTES];
+        size_t got = 0;
+        while (random_fd != -1 && got < sizeof(bytes)) {
+            ssize_t n = read(random_fd, bytes + got, sizeof(bytes) - got);
+            if (n <= 0) {
+                break;
+            }
+            got += n;
+        }
+        if (got < sizeof(bytes)) {
+            LOG_ERROR("Failed to read /dev/urandom for session token", ERR_FILE_READ_FAIL);
+            return "";
+        }
+        static const char hex[] = "0123456789abcdef";
+        string token;
+        token.reserve(sizeof(bytes) * 2);
+        for (unsigned char b : bytes) {
+            token += hex[b >> 4];
+            token += hex[b & 0xf];
+        }
+        return token;
+    }
+
+    // 调用方持有锁
+    string issueLocked(int user_id, const string& user_name, long long last_id) {
+        auto old = user_token.find(user_id);
+        if (old != user_token.end()) {
+            sessions.erase(old->second);
+        }
+        string token = newToken();
+        if (token.empty()) {
+            user_token.erase(user_id);
+            return token;
+        }
+        sessions[token] = Session{user_id, user_name, last_id, time(nullptr) + SESSION_TTL_SEC};
+        user_token[user_id] = token;
+        return token;
+    }
+
+public:
+    SessionTable() {
+        pthread_mutex_init(&mutex, nullptr);
+        random_fd = open("/dev/urandom", O_RDONLY | O_CLOEXEC);
+    }
+
+    ~SessionTable() {
+        if (random_fd != -1) {
+            close(random_fd);
+        }
+        pthread_mutex_destroy(&mutex);
+    }
+
+    /**
+     * @brief 登录成功后签发令牌（使该用户的旧令牌失效）
+     * @return 令牌；无法生成随机数时返回空串
+     */
+    string issue(int user_id, const string& user_name) {
+        pthread_mutex_lock(&mutex);
+        string token = issueLocked(user_id, user_name, 0);
+        pthread_mutex_unlock(&mutex);
+        return token;
+    }
+
+    /**
+     * @brief 用令牌恢复会话，成功时轮换令牌
+     * @param token 客户端提交的令牌
+     * @param out 恢复出的会话
+     * @param new_token 新令牌
+     * @return 令牌不存在或已过期返回false
+     */
+    bool resume(const string& token, Session& out, string& new_token) {
+        pthread_mutex_lock(&mutex);
+        auto it = sessions.find(token);
+        if (it == sessions.end() || it->second.expires < time(nullptr)) {
+            pthread_mutex_unlock(&mutex);
+            return false;
+        }
+        out = it->second;
+        new_token = issueLocked(out.user_id, out.user_name, out.last_id);
+        pthread_mutex_unlock(&mutex);
+        return !new_token.empty();
+    }
+
+    /**
+     * @brief 记录已送达的离线消息位置
+     */
+    void advance(int user_id, long long last_id) {
+        pthread_mutex_lock(&mutex);
+        auto it = user_token.find(user_id);
+        if (it != user_token.end()) {
+            Session& s = sessions[it->second];
+            if (last_id > s.last_id) {
+                s.last_id = last_id;
+            }
+        }
+        pthread_mutex_unlock(&mutex);
+    }
+
+    /**
+     * @brief 撤销用户的令牌（主动退出）
+     */
+    void revoke(int user_id) {
+        pthread_mutex_lock(&mutex);
+        auto it = user_token.find(user_id);
+        if (it != user_token.end()) {
+            sessions.erase(it->second);
+            user_token.erase(it);
+        }
+        pthread_mutex_unlock(&mutex);
+    }
+
+    /**
+     * @brief 清理过期令牌
+     * @return 清理的个数
+     */
+    size_t expire() {
+        time_t now = time(nullptr);
+        size_t removed = 0;
+        pthread_mutex_lock(&mutex);
+        for (auto it = sessions.begin(); it != sessions.end();) {
+            if (it->second.expires < now) {
+                user_token.erase(it->second.user_id);
+                it = sessions.erase(it);
+                removed++;
+            }
+            else {
+                ++it;
+            }
+        }
+        pthread_mutex_unlock(&mutex);
+        return removed;
+    }
+
+    size_t size() {
+        pthread_mutex_lock(&mutex);
+        size_t n = sessions.size();
+        pthread_mutex_unlock(&mutex);
+        return n;
+    }
+};
@@ -0,0 +1,98 @@
+#pragma once
+/**
+ * @file TimerWheel.h
+ * @brief 哈希时间轮 - 连接空闲/心跳超时检测
+ *
+ * 每个事件循环持有一个时间轮，只在该循环线程中访问，无需加锁。
+ * 时间轮有 slot_count 个槽，每 tick 前进一格；连接按到期 tick 对槽数取模
+ * 放入对应的槽。收到数据时 touch() 只更新到期时间（O(1)，不移动槽位），
+ * 槽被扫到时再检查：真正到期的返回给调用方，尚未到期的挪到新的槽中。
+ */
+
+#include <vector>
+#include <unordered_map>
+#include <unordered_set>
+
+using namespace std;
+
+class TimerWheel {
+private:
+    struct Entry {
+        unsigned long long expire_tick;  // 到期tick
+        size_t slot;                     // 当前所在的槽
+    };
+    vector<unordered_set<int>> slots;
+    unordered_map<int, Entry> entries;   // fd -> 定时信息
+    unsigned long long current_tick;
+
+    void place(int fd, Entry& e) {
+        e.slot = e.expire_tick % slots.size();
+        slots[e.slot].insert(fd);
+    }
+
+public:
+    explicit TimerWheel(size_t slot_count = 64) : slots(slot_count), current_tick(0) {}
+
+    /**
+     * @brief 刷新连接的到期时间（不存在则加入）
+     * @param timeout_ticks 距离现在多少tick后到期
+     */
+    void touch(int fd, unsigned long long timeout_ticks) {
+        auto it = entries.find(fd);
+        if (it == entries.end()) {
+            Entry e;
+            e.expire_tick = current_tick + timeout_ticks;
+            place(fd, e);
+            entries[fd] = e;
+            return;
+        }
+        it->second.expire_tick = current_tick + timeout_ticks;
+    }
+
+    /**
+     * @brief 移除连接（连接关闭时调用）
+     */
+    void remove(int fd) {
+        auto it = entries.find(fd);
+        if (it == entries.end()) {
+            return;
+        }
+        slots[it->second.slot].erase(fd);
+        entries.erase(it);
+    }
+
+    /**
+     * @brief 前进一个tick
+     * @param expired 输出本次到期的fd（已从时间轮移除）
+     */
+    void tick(vector<int>& expired) {
+        current_tick++;
+        size_t idx = current_tick % slots.size();
+        if (slots[idx].empty()) {
+            return;
+        }
+        vector<int> due(slots[idx].begin(), slots[idx].end());
+        for (int fd : due) {
+            Entry& e = entries[fd];
+            if (e.expire_tick <= current_tick) {
+                slots[idx].erase(fd);
+                entries.erase(fd);
+                expired.push_back(fd);
+            }
+            else if (e.expire_tick % slots.size() != idx) {
+                // 期间被touch过，挪到新的槽
+                slots[idx].erase(fd);
+                place(fd, e);
+            }
+            // 同一个槽但还要再转几圈的，原地保留
+        }
+    }
+
+    unsigned long long now() const {
+        return current_tick;
+    }
+
+    size_t size() const {
+        return entries.size();
+    }
+};
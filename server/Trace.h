@@ -0,0 +1,328 @@
+#pragma once
+/**
+ * @file Trace.h
+ * @brief 按消息采样的端到端延迟追踪 - 找出慢消息的时间花在哪一段
+ *
+ * 开启采样后（每 N 条消息追踪一条），被采中的消息带着一个 Trace 对象走完整条路径，
+ * 在以下位置打点：
+ *   recv     事件循环 recv 到数据（handle_clint_data）
+ *   enqueue  ThreadPool::addTask
+ *   dequeue  工作线程取出任务
+ *   db       每次数据库调用（预处理语句、异步查询）的起止时间
+ *   respond  第一次 en_resp 回复发起请求的连接
+ *   popped   事件循环从 mailbox 取出该回复
+ *   sent     回复的最后一帧写入套接字
+ *   done     工作线程处理结束
+ * 异步阶段（AsyncDb、AuthExecutor）提交时捕获当前线程的 Trace，回调时恢复，
+ * 因此登录、历史记录等跨线程的请求也能追踪到底。
+ *
+ * Trace 由 shared_ptr 持有，最后一个持有者释放时（任务、回调、回复都已结束）
+ * 计算各阶段耗时，记入直方图 chatroom_trace_stage_us{stage=...} 和
+ * chatroom_trace_us{cmd=...}，并放入最近 TRACE_RING_SIZE 条的环形缓冲区。
+ *
+ * 通过指标套接字控制和导出：
+ *   echo "trace 100" | nc -U /tmp/chatroom_admin.sock   每100条消息采样1条（0关闭）
+ *   echo "traces 20" | nc -U /tmp/chatroom_admin.sock   最近20条追踪及各阶段/各命令汇总
+ * 关闭时每条消息只多一次原子读，其余打点位置只判断线程局部指针是否为空。
+ */
+
+#include <deque>
+#include <string>
+#include <memory>
+#include <atomic>
+#include <cstdio>
+#include <cstdlib>
+#include <map>
+#include <vector>
+#include <pthread.h>
+#include "Metrics.h"
+
+using namespace std;
+
+#define TRACE_RING_SIZE 1024      // 保留的已完成追踪条数
+#define TRACE_MAX_DB_CALLS 8      // 每条消息最多记录的数据库调用数（超出只计入总数）
+
+enum TraceStamp {
+    TRACE_RECV,
+    TRACE_ENQUEUE,
+    TRACE_DEQUEUE,
+    TRACE_RESPOND,
+    TRACE_POPPED,
+    TRACE_SENT,
+    TRACE_DONE,
+    TRACE_STAMPS
+};
+
+struct TraceDbCall {
+    string sql;
+    long long start_us;
+    long long us;
+};
+
+/**
+ * @brief 一条被采样消息的打点（各字段可能由不同线程写入）
+ */
+struct Trace {
+    unsigned long long id;
+    int fd;
+    atomic<const char*> cmd;  // 命令名（静态字符串），工作线程解析后设置
+    atomic<long long> stamps[TRACE_STAMPS];
+    atomic<int> db_count;
+    atomic<long long> db_us;
+    TraceDbCall db[TRACE_MAX_DB_CALLS];  // 每个槽只由抢到它的线程写入
+
+    Trace(unsigned long long id_, int fd_) : id(id_), fd(fd_), cmd(nullptr), db_count(0), db_us(0) {
+        for (int i = 0; i < TRACE_STAMPS; i++) {
+            stamps[i].store(0, memory_order_relaxed);
+        }
+    }
+
+    void stamp(TraceStamp s) {
+        stamps[s].store(Metrics::nowUs(), memory_order_relaxed);
+    }
+
+    // 只记录第一次
+    void stampFirst(TraceStamp s) {
+        long long expected = 0;
+        stamps[s].compare_exchange_strong(expected, Metrics::nowUs(), memory_order_relaxed);
+    }
+
+    void addDbCall(const string& sql, long long start_us, long long us) {
+        db_us.fetch_add(us, memory_order_relaxed);
+        int slot = db_count.fetch_add(1, memory_order_relaxed);
+        if (slot < TRACE_MAX_DB_CALLS) {
+            db[slot] = TraceDbCall{sql, start_us, us};
+        }
+    }
+};
+
+class Tracer {
+private:
+    // 已完成追踪的各阶段耗时（微秒，-1 表示该阶段没有发生）
+    enum Stage { STAGE_REACTOR, STAGE_QUEUE, STAGE_HANDLER, STAGE_DB, STAGE_MAILBOX, STAGE_SOCKET, STAGE_TOTAL, STAGES };
+    struct Record {
+        unsigned long long id;
+        int fd;
+        const char* cmd;
+        long long stage_us[STAGES];
+        int db_calls;
+        vector<TraceDbCall> db;
+    };
+
+    atomic<unsigned int> sample_every;   // 0 表示关闭
+    atomic<unsigned long long> seq;
+    deque<Record> ring;
+    pthread_mutex_t mutex;
+    Histogram* stage_hist[STAGES];
+    map<string, Histogram*> cmd_hist;  // 命令名 -> 端到端耗时，与 ring 同一把锁
+
+    static const char* stageName(int s) {
+        static const char* const names[STAGES] = {"reactor", "queue", "handler", "db", "mailbox", "socket", "total"};
+        return names[s];
+    }
+
+    static long long span(long long from, long long to) {
+        return from > 0 && to >= from ? to - from : -1;
+    }
+
+    Tracer() : sample_every(0), seq(0) {
+        pthread_mutex_init(&mutex, nullptr);
+        Metrics* m = Metrics::getInstance();
+        for (int s = 0; s < STAGES; s++) {
+            stage_hist[s] = m->histogram("chatroom_trace_stage_us", Metrics::label("stage", stageName(s)));
+        }
+        m->command("trace", [this](const string& arg) {
+            setSampling(arg.empty() ? 0 : (unsigned int)strtoul(arg.c_str(), nullptr, 10));
+            return "trace sampling 1/" + to_string(sample_every.load()) + "\n";
+        });
+        m->command("traces", [this](const string& arg) {
+            return dump(arg.empty() ? 50 : (size_t)strtoul(arg.c_str(), nullptr, 10));
+        });
+    }
+
+    static void release(Trace* t) {
+        getInstance()->commit(t);
+        delete t;
+    }
+
+    void commit(const Trace* t);
+    static void formatRecord(const Record& r, string& out);
+
+    static void summarize(const string& name, const Histogram* h, string& out) {
+        out += name + " " + to_string(h->total()) + " " + to_string(h->percentile(0.5)) + " " +
+               to_string(h->percentile(0.99)) + " " + to_string(h->maxValue()) + "\n";
+    }
+
+public:
+    Tracer(const Tracer&) = delete;
+    Tracer& operator=(const Tracer&) = delete;
+
+    static Tracer* getInstance() {
+        static Tracer* instance = new Tracer();
+        return instance;
+    }
+
+    /**
+     * @brief 当前线程正在处理的消息的追踪（未采样时为空）
+     */
+    static shared_ptr<Trace>& current() {
+        static thread_local shared_ptr<Trace> cur;
+        return cur;
+    }
+
+    /**
+     * @brief 是否开启了采样（每条消息调用，只做一次原子读）
+     */
+    bool enabled() const {
+        return sample_every.load(memory_order_relaxed) != 0;
+    }
+
+    /**
+     * @brief 每 every 条消息采样一条，0 关闭
+     */
+    void setSampling(unsigned int every) {
+        sample_every.store(every, memory_order_relaxed);
+        LOG_INFO("Trace sampling set to " + (every ? "1/" + to_string(every) : string("off")));
+    }
+
+    /**
+     * @brief 为一条新消息决定是否采样
+     * @param recv_us 收到数据的时间（Metrics::nowUs）
+     * @return 未采中返回空
+     */
+    shared_ptr<Trace> begin(int fd, long long recv_us) {
+        unsigned int every = sample_every.load(memory_order_relaxed);
+        if (every == 0) {
+            return nullptr;
+        }
+        unsigned long long n = seq.fetch_add(1, memory_order_relaxed);
+        if (n % every != 0) {
+            return nullptr;
+        }
+        shared_ptr<Trace> t(new Trace(n, fd), release);
+        t->stamps[TRACE_RECV].store(recv_us, memory_order_relaxed);
+        return t;
+    }
+
+    /**
+     * @brief 最近 limit 条追踪和各阶段、各命令的汇总
+     */
+    string dump(size_t limit);
+};
+
+/**
+ * @brief 在作用域内把 trace 设为当前线程的追踪（RAII），离开时恢复
+ */
+class TraceScope {
+private:
+    shared_ptr<Trace> prev;
+
+public:
+    explicit TraceScope(const shared_ptr<Trace>& t) : prev(std::move(Tracer::current())) {
+        Tracer::current() = t;
+    }
+
+    TraceScope(const TraceScope&) = delete;
+    TraceScope& operator=(const TraceScope&) = delete;
+
+    ~TraceScope() {
+        Tracer::current() = std::move(prev);
+    }
+};
+
+/**
+ * @brief 一次同步数据库调用（RAII），当前线程有追踪时记录起止时间
+ */
+class TraceDbSpan {
+private:
+    Trace* trace;
+    const string& sql;
+    long long begin;
+
+public:
+    explicit TraceDbSpan(const string& sql_) : trace(Tracer::current().get()), sql(sql_),
+                                               begin(trace ? Metrics::nowUs() : 0) {}
+
+    TraceDbSpan(const TraceDbSpan&) = delete;
+    TraceDbSpan& operator=(const TraceDbSpan&) = delete;
+
+    ~TraceDbSpan() {
+        if (trace) {
+            trace->addDbCall(sql, begin, Metrics::nowUs() - begin);
+        }
+    }
+};
+
+inline void Tracer::commit(const Trace* t) {
+    long long st[TRACE_STAMPS];
+    for (int i = 0; i < TRACE_STAMPS; i++) {
+        st[i] = t->stamps[i].load(memory_order_relaxed);
+    }
+    Record r;
+    r.id = t->id;
+    r.fd = t->fd;
+    r.cmd = t->cmd.load(memory_order_relaxed);
+    r.db_calls = t->db_count.load(memory_order_relaxed);
+    r.db.assign(t->db, t->db + min(r.db_calls, TRACE_MAX_DB_CALLS));
+    r.stage_us[STAGE_REACTOR] = span(st[TRACE_RECV], st[TRACE_ENQUEUE]);
+    r.stage_us[STAGE_QUEUE] = span(st[TRACE_ENQUEUE], st[TRACE_DEQUEUE]);
+    r.stage_us[STAGE_HANDLER] = span(st[TRACE_DEQUEUE], st[TRACE_DONE]);
+    r.stage_us[STAGE_DB] = r.db_calls > 0 ? t->db_us.load(memory_order_relaxed) : -1;
+    r.stage_us[STAGE_MAILBOX] = span(st[TRACE_RESPOND], st[TRACE_POPPED]);
+    r.stage_us[STAGE_SOCKET] = span(st[TRACE_POPPED], st[TRACE_SENT]);
+    // 异步请求的回复可能晚于工作线程结束，取最后发生的时间点
+    r.stage_us[STAGE_TOTAL] = span(st[TRACE_RECV], max(st[TRACE_SENT], st[TRACE_DONE]));
+
+    for (int s = 0; s < STAGES; s++) {
+        if (r.stage_us[s] >= 0) {
+            stage_hist[s]->record(r.stage_us[s]);
+        }
+    }
+
+    pthread_mutex_lock(&mutex);
+    if (r.stage_us[STAGE_TOTAL] >= 0 && r.cmd != nullptr) {
+        Histogram*& h = cmd_hist[r.cmd];
+        if (h == nullptr) {
+            h = Metrics::getInstance()->histogram("chatroom_trace_us", Metrics::label("cmd", r.cmd));
+        }
+        h->record(r.stage_us[STAGE_TOTAL]);
+    }
+    ring.push_back(std::move(r));
+    if (ring.size() > TRACE_RING_SIZE) {
+        ring.pop_front();
+    }
+    pthread_mutex_unlock(&mutex);
+}
+
+inline void Tracer::formatRecord(const Record& r, string& out) {
+    char line[160];
+    snprintf(line, sizeof(line), "#%llu fd=%d cmd=%s", r.id, r.fd, r.cmd ? r.cmd : "?");
+    out += line;
+    for (int s = 0; s < STAGES; s++) {
+        out += string(" ") + stageName(s) + "=";
+        out += r.stage_us[s] >= 0 ? to_string(r.stage_us[s]) : "-";
+    }
+    out += " db_calls=" + to_string(r.db_calls) + "\n";
+    for (const TraceDbCall& c : r.db) {
+        out += "    db " + to_string(c.us) + "us: " + c.sql + "\n";
+    }
+}
+
+inline string Tracer::dump(size_t limit) {
+    string out = "# sampling 1/" + to_string(sample_every.load()) + ", stage times in us, '-' = stage not reached\n";
+    pthread_mutex_lock(&mutex);
+    size_t start = ring.size() > limit ? ring.size() - limit : 0;
+    for (size_t i = start; i < ring.size(); i++) {
+        formatRecord(ring[i], out);
+    }
+    out += "# per stage: count p50 p99 max\n";
+    for (int s = 0; s < STAGES; s++) {
+        summarize(stageName(s), stage_hist[s], out);
+    }
+    out += "# per command (total): count p50 p99 max\n";
+    for (auto& it : cmd_hist) {
+        summarize(it.first, it.second, out);
+    }
+    pthread_mutex_unlock(&mutex);
+    return out;
+}
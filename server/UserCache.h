@@ -0,0 +1,233 @@
+#pragma once
+/**
+ * @file UserCache.h
+ * @brief 用户目录缓存 - user_name <-> user_id 的进程级内存缓存
+ *
+ * 几乎每条命令都要把用户名和用户ID互相转换。缓存按需加载：未命中时通过
+ * 调用方传入的数据库连接查询一次并写入缓存，之后的查询只读内存。调用方也可以
+ * 传入 DbSource，只在未命中时才去借用数据库连接。
+ * 用户名和ID在注册后不会改变，因此只需在 sign_up 成功后写入新用户即可
+ * 保持一致；查询失败（用户不存在）的结果不缓存，避免注册后仍被判为不存在。
+ *
+ * 内部按 key 的哈希分成若干分片，每个分片一把锁，降低多线程竞争。
+ * capacity 不为0时，每个分片按LRU淘汰，总条目数不超过 capacity。
+ */
+
+#include <string>
+#include <list>
+#include <unordered_map>
+#include <functional>
+#include <atomic>
+#include <pthread.h>
+#include "MyDb.h"
+
+using namespace std;
+
+#define USER_CACHE_SHARDS 16
+
+/**
+ * @class LruShard
+ * @brief 带可选LRU淘汰的哈希表分片（调用方负责加锁）
+ */
+template <typename K, typename V>
+class LruShard {
+private:
+    typedef pair<K, V> Item;
+    list<Item> items;  // 头部为最近使用
+    unordered_map<K, typename list<Item>::iterator> index;
+    size_t capacity;   // 0 表示不淘汰
+public:
+    pthread_mutex_t mutex;
+
+    LruShard() : capacity(0) {
+        pthread_mutex_init(&mutex, nullptr);
+    }
+
+    ~LruShard() {
+        pthread_mutex_destroy(&mutex);
+    }
+
+    void setCapacity(size_t cap) {
+        capacity = cap;
+    }
+
+    bool get(const K& key, V& value) {
+        auto it = index.find(key);
+        if (it == index.end()) {
+            return false;
+        }
+        if (capacity > 0) {
+            items.splice(items.begin(), items, it->second);
+        }
+        value = it->second->second;
+        return true;
+    }
+
+    void put(const K& key, const V& value) {
+        auto it = index.find(key);
+        if (it != index.end()) {
+            it->second->second = value;
+            items.splice(items.begin(), items, it->second);
+            return;
+        }
+        items.emplace_front(key, value);
+        index[key] = items.begin();
+        if (capacity > 0 && items.size() > capacity) {
+            index.erase(items.back().first);
+            items.pop_back();
+        }
+    }
+
+    size_t size() const {
+        return items.size();
+    }
+};
+
+/**
+ * @class UserCache
+ * @brief 进程级用户目录缓存（线程安全）
+ */
+class UserCache {
+private:
+    LruShard<string, int> name_shards[USER_CACHE_SHARDS];
+    LruShard<int, string> id_shards[USER_CACHE_SHARDS];
+    atomic<unsigned long long> hit_count;
+    atomic<unsigned long long> miss_count;
+
+    LruShard<string, int>& nameShard(const string& name) {
+        return name_shards[hash<string>()(name) % USER_CACHE_SHARDS];
+    }
+
+    LruShard<int, string>& idShard(int user_id) {
+        return id_shards[(unsigned int)user_id % USER_CACHE_SHARDS];
+    }
+
+public:
+    // 按需提供数据库连接，取不到时返回 nullptr
+    typedef function<MyDb*()> DbSource;
+
+    /**
+     * @param capacity 最多缓存的用户数，0 表示不限制（不淘汰）
+     */
+    explicit UserCache(size_t capacity = 0) : hit_count(0), miss_count(0) {
+        size_t per_shard = capacity == 0 ? 0 : (capacity + USER_CACHE_SHARDS - 1) / USER_CACHE_SHARDS;
+        for (int i = 0; i < USER_CACHE_SHARDS; i++) {
+            name_shards[i].setCapacity(per_shard);
+            id_shards[i].setCapacity(per_shard);
+        }
+    }
+
+    /**
+     * @brief 写入一个用户（注册成功后调用，保持缓存与数据库一致）
+     */
+    void put(int user_id, const string& name) {
+        if (user_id < 0 || name.empty()) {
+            return;
+        }
+        LruShard<string, int>& ns = nameShard(name);
+        pthread_mutex_lock(&ns.mutex);
+        ns.put(name, user_id);
+        pthread_mutex_unlock(&ns.mutex);
+
+        LruShard<int, string>& is = idShard(user_id);
+        pthread_mutex_lock(&is.mutex);
+        is.put(user_id, name);
+        pthread_mutex_unlock(&is.mutex);
+    }
+
+    /**
+     * @brief 只查内存，不访问数据库
+     * @return 命中返回true
+     */
+    bool lookupId(const string& name, int& user_id) {
+        LruShard<string, int>& ns = nameShard(name);
+        pthread_mutex_lock(&ns.mutex);
+        bool found = ns.get(name, user_id);
+        pthread_mutex_unlock(&ns.mutex);
+        return found;
+    }
+
+    bool lookupName(int user_id, string& name) {
+        LruShard<int, string>& is = idShard(user_id);
+        pthread_mutex_lock(&is.mutex);
+        bool found = is.get(user_id, name);
+        pthread_mutex_unlock(&is.mutex);
+        return found;
+    }
+
+    /**
+     * @brief 用户名 -> 用户ID，未命中时用 db 查询并写入缓存
+     * @return 用户不存在或查询失败返回-1
+     */
+    int get_id(MyDb* db, const string& name) {
+        return get_id(DbSource([db] { return db; }), name);
+    }
+
+    int get_id(const DbSource& source, const string& name) {
+        int user_id;
+        if (lookupId(name, user_id)) {
+            hit_count++;
+            return user_id;
+        }
+        miss_count++;
+        MyDb* db = source();
+        if (db == nullptr) {
+            return -1;
+        }
+        user_id = db->get_id(name.c_str());
+        if (user_id != -1) {
+            put(user_id, name);
+        }
+        return user_id;
+    }
+
+    /**
+     * @brief 用户ID -> 用户名，未命中时用 db 查询并写入缓存
+     * @return 用户不存在或查询失败返回空串
+     */
+    string get_name(MyDb* db, int user_id) {
+        return get_name(DbSource([db] { return db; }), user_id);
+    }
+
+    string get_name(const DbSource& source, int user_id) {
+        string name;
+        if (lookupName(user_id, name)) {
+            hit_count++;
+            return name;
+        }
+        miss_count++;
+        MyDb* db = source();
+        if (db == nullptr) {
+            return "";
+        }
+        name = db->get_name(user_id);
+        if (!name.empty()) {
+            put(user_id, name);
+        }
+        return name;
+    }
+
+    unsigned long long hits() const {
+        return hit_count.load();
+    }
+
+    unsigned long long misses() const {
+        return miss_count.load();
+    }
+
+    /**
+     * @brief 统计信息（命中数、未命中数即节省/产生的数据库查询数）
+     */
+    string stats() {
+        size_t entries = 0;
+        for (int i = 0; i < USER_CACHE_SHARDS; i++) {
+            pthread_mutex_lock(&name_shards[i].mutex);
+            entries += name_shards[i].size();
+            pthread_mutex_unlock(&name_shards[i].mutex);
+        }
+        unsigned long long h = hits(), m = misses();
+        double ratio = (h + m) ? (double)h * 100.0 / (h + m) : 0.0;
+        return "entries=" + to_string(entries) + ", hits=" + to_string(h) +
+               ", misses=" + to_string(m) + ", hit_ratio=" + to_string(ratio) + "%";
+    }
+};
@@ -66,11 +66,16 @@ int main() {
 //             send_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 //             INDEX idx_receiver(receiver_id,is_delivered),
 //             INDEX idx_send_time(sender_id,send_time),
+//             INDEX idx_sender_id(sender_id,id),      -- show_history 按id分页
+//             INDEX idx_receiver_id(receiver_id,id),
 //             FOREIGN KEY (sender_id) REFERENCES user(user_id),
 //             FOREIGN KEY (receiver_id) REFERENCES user(user_id)
 //         );
 //     )");
         
+//     // 已有数据库补建分页索引
+//     execute_sql(conn, "ALTER TABLE chat_log ADD INDEX idx_sender_id(sender_id,id), ADD INDEX idx_receiver_id(receiver_id,id);");
+        
 //    //创建User_status表
 //    execute_sql(conn,R"(
 //         CREATE TABLE IF NOT EXISTS user_status(
@@ -5,14 +5,30 @@ using namespace std;
 
 unordered_map<string,int>clint_nametofd;
 unordered_map<int,string>clint_fdtoname;
-pthread_mutex_t resp_mutex;
+unordered_map<int,int>clint_fdtoid;  // 已登录连接 -> user_id
+PresenceIndex presence;  // 在线用户名（有序），与 clint_nametofd 在同一把锁内维护
 pthread_mutex_t client_map_mutex; // 在头文件中声明为 extern
-ThreadPool pool(16);  // 增加到16个连接以应对高并发
-int ser_fd,epoll_fd;
-int event_fd=eventfd(0,EFD_NONBLOCK);
-queue<Response>resp_queue;
-map<int, ClientBuffer> client_buffers;  // 为每个客户端维护接收缓冲区
-pthread_mutex_t buffer_map_mutex;  // 保护 client_buffers 的互斥锁
+ThreadPool pool(16);  // 16个工作线程
+DbPool db_pool(DB_POOL_MIN,DB_POOL_MAX);  // 连接数在 DB_POOL_MIN~DB_POOL_MAX 之间弹性伸缩
+AsyncDb async_db;  // 历史记录、离线消息等查询的异步执行阶段
+AuthExecutor auth_executor;  // 登录/注册（密码哈希）专用线程
+SessionTable sessions;  // 会话令牌（断线重连时恢复会话）
+UserCache user_cache(USER_CACHE_CAPACITY);  // user_name <-> user_id 缓存
+ChatLogWriter chat_log_writer;  // chat_log / last_active 异步批量写入
+EventLoop loops[MAX_LOOPS];
+int loop_num=1;
+atomic<int> fd_owner[MAX_CONN_FD];  // fd -> 所属事件循环id，-1表示未连接
+atomic<unsigned int> fd_gen[MAX_CONN_FD];  // fd 每关闭一次加1，异步任务据此识别fd已被复用
+atomic<uint8_t> fd_proto[MAX_CONN_FD];  // 发往该连接的帧使用的协议版本（0/1为v1文本，hello协商后为2）
+atomic<uint8_t> fd_deflate[MAX_CONN_FD];  // 该连接是否协商了压缩（hello|2|deflate）
+atomic<unsigned long long> deflate_in_bytes(0),deflate_out_bytes(0);  // 压缩前后的字节数
+Counter*conn_accepted=Metrics::getInstance()->counter("chatroom_connections_accepted_total");
+Counter*conn_closed=Metrics::getInstance()->counter("chatroom_connections_closed_total");
+thread_local int ReplyScope::cur_fd=-1;
+thread_local uint32_t ReplyScope::cur_id=0;
+thread_local long long ReplyScope::cur_gen=-1;
+// 按fd索引的连接表，每个槽只由连接所属的事件循环读写（accept时创建，close时归还）
+Connection* conn_table[MAX_CONN_FD];
 
 bool send_message(int clint_fd,const char buf[],int len){
     return sendMessage(clint_fd, string(buf, len));
@@ -36,7 +52,8 @@ string generate_str(){//生成salt，使用MD5
     }
     return str;
 }
-int server_init(){
+int server_init(bool reuseport){
+    int ser_fd;
     struct sockaddr_in ser_addr;
     if((ser_fd=socket(PF_INET,SOCK_STREAM,0))==-1){
         LOG_ERROR("Socket creation failed",ERR_SOCKET_CREATE_FAIL);
@@ -44,7 +61,7 @@ int server_init(){
     }
     memset(&ser_addr,0,sizeof(ser_addr));
     ser_addr.sin_family=AF_INET;
-    ser_addr.sin_port=htons(8080);
+    ser_addr.sin_port=htons(SERVER_PORT);
     ser_addr.sin_addr.s_addr=htonl(INADDR_ANY);
     int opt=1;
     if(setsockopt(ser_fd,SOL_SOCKET,SO_REUSEADDR,&opt,sizeof(opt))==-1){
@@ -52,6 +69,12 @@ int server_init(){
         close(ser_fd);
         exit(0);
     }
+    // 多个事件循环各自持有一个监听套接字，由内核负载均衡新连接
+    if(reuseport&&setsockopt(ser_fd,SOL_SOCKET,SO_REUSEPORT,&opt,sizeof(opt))==-1){
+        LOG_WARN("Failed to set SO_REUSEPORT");
+        close(ser_fd);
+        return -1;
+    }
     if(bind(ser_fd,(struct sockaddr*)&ser_addr,sizeof(ser_addr))==-1){
         LOG_ERROR("Socket bind failed",ERR_SOCKET_BIND_FAIL);
         close(ser_fd);
@@ -88,7 +111,57 @@ int set_unblocking(int fd){
     }
     return 1;
 }
-void handle_new_connect(){
+bool loop_init(EventLoop*loop,int id,int listen_fd){
+    struct epoll_event event;
+    loop->id=id;
+    loop->listen_fd=listen_fd;
+    loop->mailbox.reset(new MpscRing<Response>(RESPONSE_RING_SIZE));
+    loop->event_fd=eventfd(0,EFD_NONBLOCK);
+    if(loop->event_fd==-1){
+        LOG_FATAL("Eventfd create failed for loop "+to_string(id),ERR_SYSTEM_CALL_FAIL);
+        return false;
+    }
+    loop->epoll_fd=epoll_create(1);
+    if(loop->epoll_fd==-1){
+        LOG_FATAL("Epoll create failed",ERR_EPOLL_CREATE_FAIL);
+        return false;
+    }
+    loop->timer_fd=timerfd_create(CLOCK_MONOTONIC,TFD_NONBLOCK);
+    if(loop->timer_fd==-1){
+        LOG_FATAL("Timerfd create failed for loop "+to_string(id),ERR_SYSTEM_CALL_FAIL);
+        return false;
+    }
+    struct itimerspec its;
+    its.it_interval.tv_sec=TIMER_TICK_MS/1000;
+    its.it_interval.tv_nsec=(TIMER_TICK_MS%1000)*1000000L;
+    its.it_value=its.it_interval;
+    timerfd_settime(loop->timer_fd,0,&its,NULL);
+    if(listen_fd!=-1){
+        if(set_unblocking(listen_fd)==0){
+            return false;
+        }
+        event.events=EPOLLIN|EPOLLET|EPOLLRDHUP;
+        event.data.fd=listen_fd;
+        if(epoll_ctl(loop->epoll_fd,EPOLL_CTL_ADD,listen_fd,&event)==-1){
+            LOG_FATAL("Epoll_ctl add server socket failed",ERR_EPOLL_CTL_FAIL);
+            return false;
+        }
+    }
+    event.events=EPOLLIN;
+    event.data.fd=loop->event_fd;
+    if(epoll_ctl(loop->epoll_fd,EPOLL_CTL_ADD,loop->event_fd,&event)==-1){
+        LOG_FATAL("Epoll_ctl add event_fd failed",ERR_EPOLL_CTL_FAIL);
+        return false;
+    }
+    event.events=EPOLLIN;
+    event.data.fd=loop->timer_fd;
+    if(epoll_ctl(loop->epoll_fd,EPOLL_CTL_ADD,loop->timer_fd,&event)==-1){
+        LOG_FATAL("Epoll_ctl add timer_fd failed",ERR_EPOLL_CTL_FAIL);
+        return false;
+    }
+    return true;
+}
+void handle_new_connect(EventLoop*loop){
     socklen_t clint_size;
     int clint_fd;
     struct sockaddr_in clint_addr;
@@ -97,7 +170,7 @@ void handle_new_connect(){
     event.events=EPOLLIN|EPOLLET|EPOLLRDHUP;
     while(1){
         clint_size=sizeof(clint_addr);
-        clint_fd=accept(ser_fd,(struct sockaddr*)&clint_addr,&clint_size);
+        clint_fd=accept(loop->listen_fd,(struct sockaddr*)&clint_addr,&clint_size);
         if(clint_fd==-1){
             if(errno==EAGAIN||errno==EWOULDBLOCK){
                 break;
@@ -107,15 +180,26 @@ void handle_new_connect(){
                 break;
             }
         }
+        if(clint_fd>=MAX_CONN_FD){
+            LOG_WARN("Client FD="+to_string(clint_fd)+" exceeds MAX_CONN_FD, rejected");
+            close(clint_fd);
+            continue;
+        }
         if(set_unblocking(clint_fd)==0){
             close(clint_fd);
             continue;
         }
+        // 先登记归属，再加入epoll，保证工作线程能找到该连接所属的循环
+        conn_table[clint_fd]=loop->conn_slab.create();
+        fd_owner[clint_fd].store(loop->id);
         event.data.fd=clint_fd;
         event.events=EPOLLIN|EPOLLRDHUP;
-        if(epoll_ctl(epoll_fd,EPOLL_CTL_ADD,clint_fd,&event)==-1){
+        if(epoll_ctl(loop->epoll_fd,EPOLL_CTL_ADD,clint_fd,&event)==-1){
             // perror("epoll_ctl:");
             LOG_ERROR("Epoll_ctl failed",ERR_EPOLL_CTL_FAIL);
+            fd_owner[clint_fd].store(-1);
+            loop->conn_slab.destroy(conn_table[clint_fd]);
+            conn_table[clint_fd]=NULL;
             close(clint_fd);
             break;
         }
@@ -124,628 +208,1183 @@ void handle_new_connect(){
         if(setsockopt(clint_fd, IPPROTO_TCP, O_NDELAY, &nodelay, sizeof(nodelay)) == -1){
             LOG_WARN("Failed to set TCP_NODELAY for FD="+to_string(clint_fd));
         }
-        LOG_INFO("New client connected: FD="+to_string(clint_fd));
+        loop->wheel.touch(clint_fd,IDLE_TIMEOUT_TICKS);
+        conn_accepted->inc();
+        LOG_INFO("New client connected: FD="+to_string(clint_fd)+", loop="+to_string(loop->id));
     }
 }
-void close_clint(int epoll_fd,int clint_fd){
-    epoll_ctl(epoll_fd,EPOLL_CTL_DEL,clint_fd,NULL);
-    close(clint_fd);
-    LOG_INFO("Client disconnected: FD="+to_string(clint_fd));
+void close_clint(EventLoop*loop,int clint_fd){
+    epoll_ctl(loop->epoll_fd,EPOLL_CTL_DEL,clint_fd,NULL);
+    fd_owner[clint_fd].store(-1);
+    // 归还接收缓冲块和连接对象，丢弃未发送完的数据（须在close之前，fd关闭后可能立即被复用）
+    Connection*conn=conn_table[clint_fd];
+    conn->recv_buf.release(loop->block_pool);
+    conn->partial.release(loop->block_pool);
+    loop->conn_slab.destroy(conn);
+    conn_table[clint_fd]=NULL;
+    fd_gen[clint_fd]++;
+    fd_proto[clint_fd].store(0);
+    fd_deflate[clint_fd].store(0);
     
-    // 访问全局 map 前加锁，避免多线程竞争
+    // 会话映射同样要在close之前清理：fd关闭后另一个线程可能accept到同一个fd并bind_session，
+    // 之后再按fd擦除会删掉新连接的会话。访问全局 map 前加锁，避免多线程竞争
+    int offline_uid=-1;
     pthread_mutex_lock(&client_map_mutex);
     auto it_name = clint_fdtoname.find(clint_fd);
     if (it_name != clint_fdtoname.end()) {
-        clint_nametofd.erase(it_name->second);
+        // 同一用户可能已在新连接上重新登录，只清理指向本连接的映射
+        auto it_fd = clint_nametofd.find(it_name->second);
+        if (it_fd != clint_nametofd.end() && it_fd->second == clint_fd) {
+            clint_nametofd.erase(it_fd);
+            presence.remove(it_name->second);
+            auto it_id = clint_fdtoid.find(clint_fd);
+            if (it_id != clint_fdtoid.end()) offline_uid = it_id->second;
+        }
         clint_fdtoname.erase(it_name);
     }
+    clint_fdtoid.erase(clint_fd);
     pthread_mutex_unlock(&client_map_mutex);
-    
-    // 清除该客户端的接收缓冲区
-    pthread_mutex_lock(&buffer_map_mutex);
-    client_buffers.erase(clint_fd);
-    pthread_mutex_unlock(&buffer_map_mutex);
-}
-void handle_clint_data(int epoll_fd,int clint_fd){
-    // 获取或创建客户端缓冲区
-    pthread_mutex_lock(&buffer_map_mutex);
-    if(client_buffers.find(clint_fd) == client_buffers.end()){
-        client_buffers[clint_fd] = ClientBuffer();
-    }
-    ClientBuffer& client_buf = client_buffers[clint_fd];
-    pthread_mutex_unlock(&buffer_map_mutex);
-    
-    // 接收新数据并填充缓冲区
-    int bytes_read;
-    char temp_buf[BUF_SIZE];
+    if (offline_uid != -1) {
+        chat_log_writer.setOnline(offline_uid,false);  // 批量写回 is_online=0
+    }
+    loop->wheel.remove(clint_fd);
+    close(clint_fd);
+    conn_closed->inc();
+    LOG_INFO("Client disconnected: FD="+to_string(clint_fd));
+}
+void reject_oversized(EventLoop*loop,int clint_fd,const string&head){
+    // 超出重组预算的消息：按第一个分片的命令（v2为操作码和请求id）回复错误，连接保持
+    string reply;
+    if(isFrameV2(head.data(),head.size())&&head.size()>=PROTOCOL_V2_HEADER_SIZE){
+        uint32_t request_id;
+        memcpy(&request_id,head.data()+4,sizeof(request_id));
+        static const char code[]="0",text[]="消息过大";
+        FieldRef fields[2]={FieldRef{code,1},FieldRef{text,strlen(text)}};
+        encodeFrameV2To(reply,(uint8_t)head[1],ntohl(request_id),fields,2);
+    }
+    else{
+        string msg=head.substr(0,head.find('|'))+"|0|消息过大";
+        encodeMessageTo(reply,msg.data(),msg.size());
+    }
+    queue_output(loop,clint_fd,SharedFrame(make_shared<string>(std::move(reply))),false);
+}
+void handle_clint_data(EventLoop*loop,int clint_fd){
+    RecvBuffer&buf=conn_table[clint_fd]->recv_buf;
+    Reassembly&partial=conn_table[clint_fd]->partial;
+    Tracer*tracer=Tracer::getInstance();
+    string message;
     while(1){
-        bytes_read = recv(clint_fd, temp_buf, BUF_SIZE, 0);
+        // 直接接收到连接的缓冲块中（没有数据时不占用缓冲块）
+        size_t avail;
+        char*dst=buf.writable(loop->block_pool,avail);
+        if(avail==0){
+            LOG_NET_ERROR(clint_fd,"Receive buffer overflow",ERR_SOCKET_RECV_FAIL);
+            close_clint(loop,clint_fd);
+            return;
+        }
+        ssize_t bytes_read = recv(clint_fd, dst, avail, 0);
         if(bytes_read == -1){
-            if(errno == EAGAIN || errno == EWOULDBLOCK){
-                // 无数据可读，跳出接收循环
-                break;
+            if(errno == EINTR){
+                continue;
             }
-            else{
-                LOG_NET_ERROR(clint_fd,"Failed to receive message",ERR_SOCKET_RECV_FAIL);
-                close_clint(epoll_fd,clint_fd);
+            buf.consume(loop->block_pool,0);  // 缓冲区为空时归还缓冲块
+            if(errno == EAGAIN || errno == EWOULDBLOCK){
+                // 无数据可读
                 return;
             }
+            LOG_NET_ERROR(clint_fd,"Failed to receive message",ERR_SOCKET_RECV_FAIL);
+            close_clint(loop,clint_fd);
+            return;
         }
         else if(bytes_read == 0){
             // 客户端关闭连接
             LOG_INFO("Client closed connection: FD="+to_string(clint_fd));
-            close_clint(epoll_fd,clint_fd);
+            close_clint(loop,clint_fd);
             return;
         }
-        else{
-            // 将新数据追加到缓冲区
-            if(client_buf.pos + bytes_read <= PROTOCOL_MAX_TOTAL_SIZE){
-                memcpy(client_buf.buffer + client_buf.pos, temp_buf, bytes_read);
-                client_buf.pos += bytes_read;
+        buf.produced(bytes_read);
+        long long recv_us=tracer->enabled()?Metrics::nowUs():0;  // 只在开启追踪时取时间
+        
+        // 在缓冲区中原地解析完整的消息，只移动读偏移
+        while(true){
+            const char*body;
+            size_t body_len;
+            bool more;
+            int consumed = extractFrame(buf.readable(), buf.readableBytes(), body, body_len, more);
+            if(consumed == -1){
+                // 消息不完整，等待更多数据
+                LOG_DEBUG("Incomplete message in buffer, FD="+to_string(clint_fd)+", pending="+to_string(buf.readableBytes()));
+                break;
             }
-            else{
-                LOG_NET_ERROR(clint_fd,"Receive buffer overflow",ERR_SOCKET_RECV_FAIL);
-                close_clint(epoll_fd,clint_fd);
-                return;
+            else if(consumed == -2){
+                // 消息长度无效，跳过1个字节尝试重新同步
+                LOG_WARN("Invalid message length detected from FD="+to_string(clint_fd)+", attempting to resync buffer");
+                buf.consume(loop->block_pool,1);
+                continue;
             }
-        }
-    }
-    
-    // 从缓冲区中提取完整的消息
-    string message;
-    while(true){
-        int consumed = extractMessage(client_buf.buffer, client_buf.pos, message);
-        if(consumed == -1){
-            // 消息不完整，等待更多数据
-            LOG_DEBUG("Incomplete message in buffer, FD="+to_string(clint_fd)+", pos="+to_string(client_buf.pos));
-            break;
-        }
-        else if(consumed == -2){
-            // 消息长度无效，清理缓冲区的前1个字节并重新尝试
-            LOG_WARN("Invalid message length detected from FD="+to_string(clint_fd)+", attempting to resync buffer");
-            if(client_buf.pos > 1){
-                // 移除第一个字节，尝试重新同步
-                memmove(client_buf.buffer, client_buf.buffer + 1, client_buf.pos - 1);
-                client_buf.pos -= 1;
+            else if(consumed == 0){
+                // 缓冲区为空
+                break;
+            }
+            loop->wheel.touch(clint_fd,IDLE_TIMEOUT_TICKS);  // 收到完整帧即视为存活
+            if(more||partial.inProgress()){
+                // 续帧：分片拼接到连接的重组块中，最后一帧到达时得到完整消息
+                partial.append(loop->block_pool,body,body_len);
+                buf.consume(loop->block_pool,consumed);
+                if(more)continue;
+                if(partial.overflowed()){
+                    LOG_WARN("Oversized message dropped from FD="+to_string(clint_fd));
+                    string head=partial.head();
+                    partial.release(loop->block_pool);
+                    reject_oversized(loop,clint_fd,head);
+                    if(fd_owner[clint_fd].load()!=loop->id){
+                        return;  // 应答时连接被关闭（发送队列超过高水位）
+                    }
+                    continue;
+                }
+                partial.take(loop->block_pool,message);
             }
             else{
-                // 缓冲区太小，清空它
-                client_buf.pos = 0;
-                break;
+                message.assign(body,body_len);
+                buf.consume(loop->block_pool,consumed);
             }
-        }
-        else if(consumed == 0){
-            // 缓冲区为空
-            break;
-        }
-        else{
             // 成功提取一个完整消息
             LOG_DEBUG("Extracted message from FD="+to_string(clint_fd)+": "+message.substr(0,50));
             
+            bool v2=isFrameV2(message.data(),message.size());
+            if(v2?(uint8_t)message[1]==OP_HEARTBEAT:(message=="heartbeat"||message.compare(0,10,"heartbeat|")==0)){
+                // 心跳直接在事件循环中应答，不进入线程池、不访问数据库
+                uint32_t request_id=0;
+                if(v2){
+                    FrameV2 frame;
+                    if(decodeFrameV2(message.data(),message.size(),frame))request_id=frame.request_id;
+                }
+                handle_heartbeat(loop,clint_fd,v2,request_id);
+                if(fd_owner[clint_fd].load()!=loop->id){
+                    return;  // 应答时连接被关闭（发送队列超过高水位）
+                }
+                continue;
+            }
+            
             // 创建任务并加入任务队列
             Task task;
             task.fd = clint_fd;
-            task.message = message;
+            task.message = std::move(message);
+            if(recv_us){
+                task.trace=tracer->begin(clint_fd,recv_us);
+            }
             pool.addTask(task);
-            
-            // 从缓冲区中移除已处理的数据
-            memmove(client_buf.buffer, client_buf.buffer + consumed, client_buf.pos - consumed);
-            client_buf.pos -= consumed;
         }
     }
 }
-void signal_event_fd(){
+void signal_event_fd(EventLoop*loop){
+    // 循环已被唤醒但还没开始取数据时，不必再写eventfd
+    if(loop->wake_pending.exchange(true))return;
     uint64_t one=1;
-    write(event_fd,&one,sizeof(one));
+    write(loop->event_fd,&one,sizeof(one));
 }
-void en_resp(char msg[],int clint_fd){
+void post_response(EventLoop*loop,Response&&resp){
+    // 队列满说明循环处理不过来，让出CPU等它取走一部分
+    while(!loop->mailbox->push(std::move(resp))){
+        signal_event_fd(loop);
+        sched_yield();
+    }
+}
+void en_resp(char msg[],int clint_fd,const SentCallback&on_sent){
+    // 投递到连接所属循环的mailbox，由该循环线程负责发送
+    if(clint_fd<0||clint_fd>=MAX_CONN_FD)return;
+    int owner=fd_owner[clint_fd].load();
+    long long gen=ReplyScope::genFor(clint_fd);
+    if(owner<0||(gen!=-1&&fd_gen[clint_fd].load()!=gen)){
+        LOG_DEBUG("Drop response for closed FD="+to_string(clint_fd));
+        return;
+    }
+    EventLoop*loop=&loops[owner];
+    auto frame=make_shared<string>();
+    size_t len=strlen(msg);
+    // 协商了v2的连接转换成二进制帧，回复带上当前请求的id
+    if(fd_proto[clint_fd].load()!=PROTOCOL_V2||
+       !textToFrameV2(*frame,msg,len,ReplyScope::requestFor(clint_fd),true)){
+        encodeMessageTo(*frame,msg,len);
+    }
     Response resp;
     resp.fd=clint_fd;
-    resp.out=string(msg);
+    resp.frame=std::move(frame);
     resp.close_after=false;
+    resp.on_sent=on_sent;
+    resp.gen=gen;
+    // 被追踪请求的回复带上追踪，由事件循环记录出队和写出时间
+    const shared_ptr<Trace>&trace=Tracer::current();
+    if(trace&&trace->fd==clint_fd){
+        trace->stampFirst(TRACE_RESPOND);
+        resp.trace=trace;
+    }
     if(strcmp(msg,"bye\n")==0)resp.close_after=true;
-    pthread_mutex_lock(&resp_mutex);
-    resp_queue.push(resp);
-    pthread_mutex_unlock(&resp_mutex);
-    signal_event_fd();
+    post_response(loop,std::move(resp));
+    signal_event_fd(loop);
 }
-void process_clint_data(Task&task){
-    // 使用连接守卫确保连接一定被正确归还
-    DbConnectionGuard guard(&pool);
-    
-    if(!guard.is_valid()){
-        cerr << "Error: Failed to get database connection for task fd=" << task.fd << endl;
-        char msg[] = "Error: Database connection failed";
-        en_resp(msg, task.fd);
-        return;  // 守卫析构时自动清理（虽然conn是nullptr）
+void en_resp_multi(const string&msg,const vector<int>&fds){
+    if(fds.empty())return;
+    // 整条消息每种协议版本只编码一次，所有接收者共享同一帧
+    auto encoded=make_shared<string>();
+    encoded->reserve(PROTOCOL_HEADER_SIZE+msg.size());
+    encodeMessageTo(*encoded,msg.data(),msg.size());
+    SharedFrame frame=std::move(encoded);
+    SharedFrame frame_v2;  // 有v2接收者时才编码（推送帧的请求id为0）
+    // 按所属循环分组，每个循环只唤醒一次
+    vector<vector<int>> by_loop(loop_num);
+    for(int fd:fds){
+        if(fd<0||fd>=MAX_CONN_FD)continue;
+        int owner=fd_owner[fd].load();
+        if(owner>=0)by_loop[owner].push_back(fd);
     }
-    
-    MyDb* conn = guard.get();
-    char buf[BUF_SIZE];
-    size_t len = min(task.message.size(), (size_t)BUF_SIZE - 1);
-    memcpy(buf, task.message.data(), len);
-    buf[len] = '\0';
-    int clint_fd=task.fd;
-    char*saveptr=NULL;
-    char*cmd=strtok_r(buf,"|",&saveptr);
-    if(!cmd){
-        return;  // ✓ 守卫析构时自动调用 en_conn()
-    }
-    if(strcmp(cmd,"sign_up")==0){
-        char*username=strtok_r(NULL,"|",&saveptr);
-        char*password=strtok_r(NULL,"|",&saveptr);
-        if (!username || !password) {
-            char msg[] = "sign_up|0|请重试";
-            en_resp(msg,clint_fd);
-            return;
-        }           
-        string sql="select user_id from user where user_name='"+string(username)+"'";
-        string ret="";
-        bool res=conn->select_one_SQL(sql,ret);
-        // puts("1");
-        if(!res){//无相同的name
-            string p = generate_str();
-            string salt="$1$"+p+"$";
-            string new_password = crypt(password, salt.c_str());
-            string sql = "insert into user (user_name, password, salt) values ('" + string(username) + "', '" + new_password + "', '" + p + "')";
-            res=conn->exeSQL(sql);
-            if(res){
-                //查询该用户的user_id
-                int user_id=conn->get_id(username);
-                // printf("user_id:%d\n",user_id);
-                LOG_OPERATION(user_id,"sign_up","username: "+string(username));
-                if(user_id==-1){
-                    char msg[]="sign_up|0|请重试";
-                    en_resp(msg,clint_fd);
-                    return;
-                }
-                sql="insert into user_status (user_id) values ("+to_string(user_id)+")";//新用户信息插入user_status
-                if(!conn->exeSQL(sql)){
-                    char msg[]="sign_up|0|请重试";
-                    en_resp(msg,clint_fd);
-                    return;
+    for(int i=0;i<loop_num;i++){
+        if(by_loop[i].empty())continue;
+        EventLoop*loop=&loops[i];
+        for(int fd:by_loop[i]){
+            if(fd_proto[fd].load()==PROTOCOL_V2){
+                if(!frame_v2){
+                    auto f=make_shared<string>();
+                    if(!textToFrameV2(*f,msg.data(),msg.size(),0,true))encodeMessageTo(*f,msg.data(),msg.size());
+                    frame_v2=std::move(f);
                 }
-                char msg[]="sign_up|1|请登录";
-                en_resp(msg,clint_fd);
+                Response resp;
+                resp.fd=fd;
+                resp.frame=frame_v2;
+                post_response(loop,std::move(resp));
             }
             else{
-                char msg[]="sign_up|0|请重试";
-                en_resp(msg,clint_fd);
+                Response resp;
+                resp.fd=fd;
+                resp.frame=frame;
+                post_response(loop,std::move(resp));
             }
         }
-        else{//name重复
-            char msg[]="sign_up|0|用户名重复";
-            en_resp(msg,clint_fd);
+        signal_event_fd(loop);
+    }
+}
+void handle_heartbeat(EventLoop*loop,int clint_fd,bool v2,uint32_t request_id){
+    // 应答帧是固定内容，只编码一次，所有连接共享
+    static const SharedFrame ok_frame=[]{
+        auto f=make_shared<string>();
+        encodeMessageTo(*f,"heartbeat|1|ok",strlen("heartbeat|1|ok"));
+        return SharedFrame(f);
+    }();
+    static const SharedFrame not_login_frame=[]{
+        auto f=make_shared<string>();
+        const char msg[]="heartbeat|0|未登录";
+        encodeMessageTo(*f,msg,strlen(msg));
+        return SharedFrame(f);
+    }();
+    int user_id=-1;
+    pthread_mutex_lock(&client_map_mutex);
+    auto it_id=clint_fdtoid.find(clint_fd);
+    if(it_id!=clint_fdtoid.end())user_id=it_id->second;
+    pthread_mutex_unlock(&client_map_mutex);
+    if(user_id!=-1){
+        chat_log_writer.touch(user_id);  // last_active 由写线程批量刷新
+    }
+    if(v2){
+        // v2 应答要带回请求id，按需编码
+        static const char code_ok[]="1",code_fail[]="0",text_ok[]="ok",text_fail[]="未登录";
+        FieldRef fields[2]={
+            user_id!=-1?FieldRef{code_ok,1}:FieldRef{code_fail,1},
+            user_id!=-1?FieldRef{text_ok,strlen(text_ok)}:FieldRef{text_fail,strlen(text_fail)}
+        };
+        auto f=make_shared<string>();
+        encodeFrameV2To(*f,OP_HEARTBEAT,request_id,fields,2);
+        queue_output(loop,clint_fd,SharedFrame(f),false);
+        return;
+    }
+    queue_output(loop,clint_fd,user_id!=-1?ok_frame:not_login_frame,false);
+}
+// 按帧大小把列表（每项一行）打包成若干 "cmd|2|..." 帧，至少返回一帧
+vector<string> pack_lines(const string&cmd,const vector<string>&lines){
+    const string head=cmd+"|2|";
+    vector<string> frames;
+    string frame=head;
+    for(const string&line:lines){
+        // 放不下时另起一帧；单行超过 STREAM_FRAME_LIMIT 的独占一帧，编码时拆成续帧发送，不截断
+        if(frame.size()>head.size()&&frame.size()-head.size()+1+line.size()>STREAM_FRAME_LIMIT){
+            frames.push_back(std::move(frame));
+            frame=head;
         }
+        if(frame.size()>head.size())frame+='\n';
+        frame+=line;
     }
-    else if(strcmp(cmd,"sign_in")==0){
-        char*username=strtok_r(NULL,"|",&saveptr);
-        char*password=strtok_r(NULL,"|",&saveptr);
-        if (!username || !password) {
-            char msg[] = "sign_in|0|请重试";//eg:sign_in|1|ok
-            en_resp(msg,clint_fd);
+    frames.push_back(std::move(frame));
+    return frames;
+}
+// 分帧返回列表：中间帧状态码2，最后一帧状态码1（还有下一页时为3）
+void send_streamed(int clint_fd,const string&cmd,const vector<string>&lines,bool more){
+    vector<string> frames=pack_lines(cmd,lines);
+    frames.back()[cmd.size()+1]=more?'3':'1';
+    for(string&frame:frames){
+        en_resp(&frame[0],clint_fd);
+    }
+}
+/**
+ * 推送一批（最多 UNREAD_BATCH_ROWS 条、UNREAD_BATCH_BYTES 字节）id 大于 after_id 的离线消息。
+ * 查询提交给异步数据库阶段，在完成回调中发送；这一批的最后一帧写入套接字后，
+ * 才按 id 范围把它们标记为已读，标记完成后继续推送下一批；连接在此之前断开
+ * 的话，这些消息下次登录时会重新推送。
+ * gen 为登录时连接的代数：查询完成前连接已关闭（fd 可能已被其他用户的新连接复用）时，
+ * 回复和已读标记都被丢弃。
+ * 帧状态码：2 表示后面还有，1 表示全部推送完毕。
+ */
+void deliver_unread(int clint_fd,unsigned int gen,int user_id,long long after_id,bool first){
+    async_db.submit(
+        "select c.id, su.user_name, c.send_time, c.content from chat_log c "
+        "join user su on c.sender_id = su.user_id "
+        "where c.receiver_id = ? and c.is_delivered = 0 and c.id > ? "
+        "order by c.id limit ?",{user_id,after_id,UNREAD_BATCH_ROWS},[=](DbResult&res){
+        if(!res.ok||fd_gen[clint_fd].load()!=gen){
+            return;  // 未标记为已读，下次登录重新推送
+        }
+        ReplyScope scope(clint_fd,0,gen);  // 推送帧，连接已换代时丢弃
+        vector<DbRow>&rows=res.rows;
+        if(rows.empty()){
+            if(!first){
+                char msg[]="chat_unread|1|";
+                en_resp(msg,clint_fd);
+            }
             return;
-        }           
-        string sql="select user_name,password,salt from user where user_name='"+string(username)+"'";
-        string ret="";
-        bool res=conn->select_one_SQL(sql,ret);
-        if(!res){
-            char msg[]="sign_in|0|无此用户";
-            en_resp(msg,clint_fd);
         }
-        else{
-            //对查询结果进行解析
-            char *str=new char[ret.size()+1];
-            strcpy(str,ret.c_str());
-            char*db_name=strtok(str,"|");
-            char*db_password=strtok(NULL,"|");
-            char*db_salt=strtok(NULL,"|");
-            string salt="$1$"+string(db_salt)+"$";
-            if(strcmp(db_password,crypt(password,salt.c_str()))==0){
-                //更新status表
-                int id=conn->get_id(db_name);
-                // printf("userid:%d\n",id);
-                sql="update user_status set is_online=1 , last_active = NOW() where user_id = "+to_string(id)+" and is_online=0";
-                if(!conn->exeSQL(sql)){
-                    char msg[] = "sign_in|0|请重试";
-                    en_resp(msg,clint_fd);
+        vector<string> lines;
+        lines.reserve(rows.size());
+        size_t bytes=0;
+        for(const DbRow&row:rows){
+            string line=row[1].text()+" "+row[2].text()+" "+row[3].text();
+            // 整批一次入队，超过高水位会断开连接，这批消息又不会被标记已读，每次登录都重复断开
+            if(!lines.empty()&&bytes+line.size()>UNREAD_BATCH_BYTES){
+                break;
+            }
+            bytes+=line.size();
+            lines.push_back(std::move(line));
+        }
+        long long first_id=rows.front()[0].num;
+        long long last_id=rows[lines.size()-1][0].num;
+        bool more=rows.size()==UNREAD_BATCH_ROWS||lines.size()<rows.size();
+        vector<string> frames=pack_lines("chat_unread",lines);
+        frames.back()[strlen("chat_unread|")]=more?'2':'1';
+        for(size_t i=0;i+1<frames.size();i++){
+            en_resp(&frames[i][0],clint_fd);
+        }
+        // 整批写出后（事件循环线程回调）再标记已读、取下一批
+        en_resp(&frames.back()[0],clint_fd,[=]{
+            if(fd_gen[clint_fd].load()!=gen){
+                return;
+            }
+            async_db.submit("update chat_log set is_delivered = 1 "
+                            "where receiver_id = ? and is_delivered = 0 and id between ? and ?",
+                            {user_id,first_id,last_id},[=](DbResult&upd){
+                if(!upd.ok){
+                    return;
                 }
-                else{
-                    pthread_mutex_lock(&client_map_mutex);
-                    clint_fdtoname[clint_fd]=string(username);
-                    clint_nametofd[string(username)]=clint_fd;
-                    pthread_mutex_unlock(&client_map_mutex);
-                    int uid=conn->get_id(username);
-                    LOG_OPERATION(uid,"login","username: "+string(username));
-                    char msg[]="sign_in|1|ok";
-                    en_resp(msg,clint_fd);
-                    //查询是否有未读信息
-                    string ret="";
-                    string sql="select su.user_name,c.send_time,c.content from chat_log c join user ru on c.receiver_id=ru.user_id join user su on c.sender_id=su.user_id where ru.user_name='"+string(username)+"' and c.is_delivered=0 order by c.send_time";
-                    conn->select_many_SQL(sql,ret);
-                    if(ret.empty()){
-                        return ;
-                    }
-                    char resp[BUF_SIZE];
-                    snprintf(resp,BUF_SIZE-1,"chat_unread|1|%s",ret.c_str());
-                    resp[strlen(resp)]=0;
-                    en_resp(resp,clint_fd);
-                    int receiver_id=conn->get_id(username);
-                    sql="update chat_log set is_delivered=1 where is_delivered=0 and receiver_id="+to_string(receiver_id);
-                    // puts(sql.c_str());
-                    conn->exeSQL(sql);
-                    // printf("查询未读信息:%s\n",resp);
-                    // puts(resp);
+                sessions.advance(user_id,last_id);  // 恢复会话时从这里继续
+                if(!more){
+                    return;
+                }
+                // fd 可能已关闭并被其他用户的新连接复用，确认仍是同一个连接再继续
+                if(fd_gen[clint_fd].load()==gen){
+                    deliver_unread(clint_fd,gen,user_id,last_id,false);
                 }
+            });
+        });
+    });
+}
+// 取出已登录连接的用户名和user_id；未登录时回复错误，聊天记录不能没有发送者
+bool chat_sender(int clint_fd,const char*cmd,string&name,int&user_id){
+    pthread_mutex_lock(&client_map_mutex);
+    auto it_name=clint_fdtoname.find(clint_fd);
+    auto it_id=clint_fdtoid.find(clint_fd);
+    bool logged_in=it_name!=clint_fdtoname.end()&&it_id!=clint_fdtoid.end();
+    if(logged_in){
+        name=it_name->second;
+        user_id=it_id->second;
+    }
+    pthread_mutex_unlock(&client_map_mutex);
+    if(!logged_in){
+        char msg[BUF_SIZE];
+        snprintf(msg,BUF_SIZE-1,"%s|0|请先登录",cmd);
+        en_resp(msg,clint_fd);
+    }
+    return logged_in;
+}
+// 正文超过 CHAT_TEXT_MAX 时回复错误（长消息可以通过续帧到达，但数据库和v2字段放不下）
+bool chat_text_ok(int clint_fd,const char*cmd,const string&text){
+    if(text.size()<=CHAT_TEXT_MAX){
+        return true;
+    }
+    LOG_WARN(string(cmd)+" text too long ("+to_string(text.size())+" bytes), FD="+to_string(clint_fd));
+    char msg[BUF_SIZE];
+    snprintf(msg,BUF_SIZE-1,"%s|0|消息过长",cmd);
+    en_resp(msg,clint_fd);
+    return false;
+}
+// 借用数据库连接，连接池繁忙时直接回复客户端
+MyDb* need_db(DbConnectionGuard&guard,const char*cmd,int clint_fd){
+    MyDb*conn=guard.get();
+    if(conn==nullptr){
+        LOG_WARN("No database connection available for "+string(cmd)+", FD="+to_string(clint_fd));
+        char msg[BUF_SIZE];
+        snprintf(msg,BUF_SIZE-1,"%s|0|服务器繁忙，请稍后重试",cmd);
+        en_resp(msg,clint_fd);
+    }
+    return conn;
+}
+/**
+ * 把连接绑定到已通过认证的用户（登录、恢复会话共用），在线状态由写线程批量写回status表
+ * gen 为提交任务时连接的代数：不一致说明连接已关闭（fd 可能已被新连接复用），放弃绑定
+ */
+bool bind_session(int clint_fd,unsigned int gen,int user_id,const string&username){
+    pthread_mutex_lock(&client_map_mutex);
+    if(fd_gen[clint_fd].load()!=gen){
+        pthread_mutex_unlock(&client_map_mutex);
+        return false;
+    }
+    clint_fdtoname[clint_fd]=username;
+    clint_nametofd[username]=clint_fd;
+    clint_fdtoid[clint_fd]=user_id;
+    presence.add(username);
+    pthread_mutex_unlock(&client_map_mutex);
+    chat_log_writer.setOnline(user_id,true);
+    return true;
+}
+// 下发会话令牌：session|1|<token>，断线重连后用 resume|<token> 恢复
+void send_session_token(int clint_fd,const string&token){
+    if(token.empty()){
+        return;  // 无法生成令牌时客户端只能重新登录
+    }
+    ReplyScope scope(-1,0);  // 推送帧，不属于任何请求
+    string msg="session|1|"+token;
+    en_resp(&msg[0],clint_fd);
+}
+// 注册（在认证执行器中执行）
+void do_sign_up(int clint_fd,const string&username,const string&password){
+    DbConnectionGuard guard(&db_pool);
+    MyDb*conn=need_db(guard,"sign_up",clint_fd);
+    if(!conn)return;
+    bool res=user_cache.get_id(conn,username)!=-1;
+    // puts("1");
+    if(!res){//无相同的name
+        string p = generate_str();
+        string salt="$1$"+p+"$";
+        string new_password = AuthExecutor::hash(password, salt);
+        res=conn->stmt_execute("insert into user (user_name, password, salt) values (?, ?, ?)",{username,new_password,p});
+        if(res){
+            //查询该用户的user_id
+            int user_id=conn->get_id(username.c_str());
+            user_cache.put(user_id,username);  // 新用户写入缓存，保持一致
+            // printf("user_id:%d\n",user_id);
+            LOG_OPERATION(user_id,"sign_up","username: "+string(username));
+            if(user_id==-1){
+                char msg[]="sign_up|0|请重试";
+                en_resp(msg,clint_fd);
+                return;
             }
-            else{//密码错误
-                LOG_ERROR("Login failed: incorrect password for user "+string(db_name),ERR_PASSWORD_INCORRECT);
-                char msg[]="sign_in|0|密码错误";
+            //新用户信息插入user_status
+            if(!conn->stmt_execute("insert into user_status (user_id) values (?)",{user_id})){
+                char msg[]="sign_up|0|请重试";
                 en_resp(msg,clint_fd);
+                return;
             }
-            delete[]str;
-        }
-    }
-    else if(strcmp(cmd,"show_online_user")==0){
-        string sql="select user_name from user join user_status on user.user_id = user_status.user_id where is_online = 1";
-        string ret="";
-        if(conn->select_many_SQL(sql,ret)){
-            char msg[BUF_SIZE];
-            snprintf(msg,BUF_SIZE-1,"show_online_user|1|%s",ret.c_str());
-            msg[strlen(msg)]=0;
-            en_resp((char*)msg,clint_fd);
+            char msg[]="sign_up|1|请登录";
+            en_resp(msg,clint_fd);
         }
         else{
-            char msg[]="show_online_user|0|请重试";
+            char msg[]="sign_up|0|请重试";
             en_resp(msg,clint_fd);
         }
     }
-    else if(strcmp(cmd,"single_chat")==0){
-        // 访问映射加锁
-        pthread_mutex_lock(&client_map_mutex);
-        auto it_name = clint_fdtoname.find(clint_fd);
-        string from_name = (it_name != clint_fdtoname.end()) ? it_name->second : "";
-        pthread_mutex_unlock(&client_map_mutex);
-        const char*from=from_name.c_str();
-        const char*to=strtok_r(NULL,"|",&saveptr);
-        const char*text=strtok_r(NULL,"|",&saveptr);
-        string receiver_id=to_string(conn->get_id(to));
-        if(receiver_id=="-1"){//发送给的用户不存在
-            char msg[BUF_SIZE];
-            snprintf(msg,BUF_SIZE-1,"single_chat|0|%s","用户不存在");
-            msg[strlen(msg)]=0;
+    else{//name重复
+        char msg[]="sign_up|0|用户名重复";
+        en_resp(msg,clint_fd);
+    }
+}
+// 登录（在认证执行器中执行），gen 为提交时连接的代数，用于识别已关闭的连接
+void do_sign_in(int clint_fd,unsigned int gen,const string&username,const string&password){
+    DbConnectionGuard guard(&db_pool);
+    MyDb*conn=need_db(guard,"sign_in",clint_fd);
+    if(!conn)return;
+    vector<DbRow> rows;
+    bool res=conn->stmt_query("select user_id,user_name,password,salt from user where user_name=?",{username},rows);
+    if(!res||rows.empty()){
+        char msg[]="sign_in|0|无此用户";
+        en_resp(msg,clint_fd);
+    }
+    else{
+        //对查询结果进行解析
+        int id=(int)rows[0][0].num;
+        const string&db_name=rows[0][1].str;
+        const string&db_password=rows[0][2].str;
+        string salt="$1$"+rows[0][3].str+"$";
+        user_cache.put(id,db_name);
+        if(db_password==AuthExecutor::hash(password,salt)){
+            if(!bind_session(clint_fd,gen,id,username)){
+                return;
+            }
+            LOG_OPERATION(id,"login","username: "+string(username));
+            char msg[]="sign_in|1|ok";
             en_resp(msg,clint_fd);
-            return ;
+            send_session_token(clint_fd,sessions.issue(id,username));
+            //分批推送未读信息
+            deliver_unread(clint_fd,gen,id,0,true);
         }
-        string sender_id=to_string(conn->get_id(from));
-        string is_delivered="1";
-        string group_type="single";
-        pthread_mutex_lock(&client_map_mutex);
-        bool online = clint_nametofd.count(to);
-        int to_fd = online ? clint_nametofd[to] : -1;
-        pthread_mutex_unlock(&client_map_mutex);
-        if(!online){//接收用户不在线，不发送
-            is_delivered="0";
+        else{//密码错误
+            LOG_ERROR("Login failed: incorrect password for user "+db_name,ERR_PASSWORD_INCORRECT);
+            char msg[]="sign_in|0|密码错误";
+            en_resp(msg,clint_fd);
+        }
+    }
+}
+// 登录/注册交给认证执行器，排队已满或排队超时时回复繁忙，不占用聊天消息的工作线程
+// 认证完成前挂起该连接的任务通道：流水线中紧跟在 sign_in 后的命令要在登录结果之后按序执行
+void submit_auth(const char*cmd,int clint_fd,const string&username,const string&password){
+    string name(cmd);
+    unsigned int gen=fd_gen[clint_fd].load();
+    uint32_t request_id=ReplyScope::requestFor(clint_fd);
+    auto busy=[name,clint_fd,gen,request_id]{
+        ReplyScope scope(clint_fd,request_id,gen);
+        char msg[BUF_SIZE];
+        snprintf(msg,BUF_SIZE-1,"%s|0|服务器繁忙，请稍后重试",name.c_str());
+        en_resp(msg,clint_fd);
+        pool.releaseLane(clint_fd);
+    };
+    pool.holdLane(clint_fd);
+    bool accepted=auth_executor.submit([=]{
+        ReplyScope scope(clint_fd,request_id,gen);
+        if(name=="sign_up"){
+            do_sign_up(clint_fd,username,password);
         }
         else{
-            char msg[BUF_SIZE];
-            snprintf(msg,BUF_SIZE-1,"single_chat|1|%s;%s",from,text);
-            msg[strlen(msg)]=0;
-            en_resp(msg,to_fd);
-        }
-        char msg_resp[BUF_SIZE];
-        snprintf(msg_resp,BUF_SIZE-1,"single_chat|2|发送成功");
-        msg_resp[strlen(msg_resp)]=0;
-        en_resp(msg_resp, clint_fd);
-        string sql="insert into chat_log (sender_id,receiver_id,is_delivered,group_type,content) values("+sender_id+","+receiver_id+","+is_delivered+",'"+group_type+"','"+text+"')";
-        conn->exeSQL(sql);
-        //更新status
-        sql="update user_status set last_active = NOW() where user_id = "+sender_id;
-        conn->exeSQL(sql);        
-    }
-    else if(strcmp(cmd,"multi_chat")==0){
-        char*usernames=strtok_r(NULL,"|",&saveptr);
-        const char*text=strtok_r(NULL,"|",&saveptr);
-        // 访问映射加锁
-        pthread_mutex_lock(&client_map_mutex);
-        auto it_name = clint_fdtoname.find(clint_fd);
-        string from_name = (it_name != clint_fdtoname.end()) ? it_name->second : "";
-        pthread_mutex_unlock(&client_map_mutex);
-        const char*from=from_name.c_str();
-        // printf("usernames:%s,text:%s\n",usernames,text);
-        if(!text||!usernames){
-            char msg[BUF_SIZE];
-            snprintf(msg,BUF_SIZE-1,"mulit_chat|0|error");
-            return ;
-        }
-        string sender_id=to_string(conn->get_id(from));
-        // 这里不能复用 saveptr，否则会破坏上面 cmd 的分割状态
-        char* names_saveptr = NULL;
-        char* to=strtok_r(usernames," ",&names_saveptr);
-        while(to){
-            string receiver_id=to_string(conn->get_id(to));
-            if(receiver_id=="-1"){//发送给的用户不存在
-                continue;
-            }
-            string is_delivered="1";
-            string group_type="multi";
-            pthread_mutex_lock(&client_map_mutex);
-            bool online = clint_nametofd.count(to);
-            int to_fd = online ? clint_nametofd[to] : -1;
-            pthread_mutex_unlock(&client_map_mutex);
-            if(!online){//接收用户不在线，不发送
-                is_delivered="0";
-            }
-            else{
-                // printf("to:%s\n",to);
-                char msg[BUF_SIZE];
-                snprintf(msg,BUF_SIZE-1,"multi_chat|2|%s;%s",from,text);
-                msg[strlen(msg)]=0;
-                en_resp(msg,to_fd);
-            }
-            string sql="insert into chat_log (sender_id,receiver_id,is_delivered,group_type,content) values("+sender_id+","+receiver_id+","+is_delivered+",'"+group_type+"','"+text+"')";
-            conn->exeSQL(sql);    
-            to=strtok_r(NULL," ",&names_saveptr);
-        }
-        //更新status
-        string sql="update user_status set last_active = NOW() where user_id = "+sender_id;
-        conn->exeSQL(sql); 
-        char msg_resp[BUF_SIZE];
-        snprintf(msg_resp,BUF_SIZE-1,"multi_chat|1|发送成功");
-        msg_resp[strlen(msg_resp)]=0;
-        en_resp(msg_resp,clint_fd);
-    }
-    else if(strcmp(cmd,"broadcast_chat")==0){
-        const char*text=strtok_r(NULL,"|",&saveptr);
-        // 访问映射加锁
-        pthread_mutex_lock(&client_map_mutex);
-        auto it_name = clint_fdtoname.find(clint_fd);
-        string from_name = (it_name != clint_fdtoname.end()) ? it_name->second : "";
-        // 为了安全遍历，复制一份当前在线用户列表
-        vector<pair<string,int>> clients_snapshot;
-        clients_snapshot.reserve(clint_nametofd.size());
-        for (auto &it : clint_nametofd) {
-            clients_snapshot.push_back(it);
+            do_sign_in(clint_fd,gen,username,password);
         }
-        pthread_mutex_unlock(&client_map_mutex);
-        const char*from=from_name.c_str();
-        if(!text){
-            char msg[BUF_SIZE];
-            snprintf(msg,BUF_SIZE-1,"mulit_chat|0|error");
-            return ;
-        }
-        string sender_id=to_string(conn->get_id(from));
-        for(auto&it:clients_snapshot){
-            string to=it.first;
-            int to_fd=it.second;
-            if(to==from)continue;
-            string receiver_id=to_string(conn->get_id(to.c_str()));
-            if(receiver_id=="-1"){//发送给的用户不存在
-                continue;
-            }
-            string is_delivered="1";
-            string group_type="broadcast";
-            // 这里的在线状态以快照为准
-            if(to_fd < 0){//接收用户不在线，不发送
-                is_delivered="0";
-            }
-            else{
-                // printf("to:%s\n",to);
-                char msg[BUF_SIZE];
-                snprintf(msg,BUF_SIZE-1,"broadcast_chat|2|%s;%s",from,text);
-                msg[strlen(msg)]=0;
-                en_resp(msg,to_fd);
-            }
-            string sql="insert into chat_log (sender_id,receiver_id,is_delivered,group_type,content) values("+sender_id+","+receiver_id+","+is_delivered+",'"+group_type+"','"+text+"')";
-            conn->exeSQL(sql);    
-        }
-        //更新status
-        string sql="update user_status set last_active = NOW() where user_id = "+sender_id;
-        conn->exeSQL(sql); 
-        char msg_resp[BUF_SIZE];
-        snprintf(msg_resp,BUF_SIZE-1,"broadcast_chat|1|发送成功");
-        msg_resp[strlen(msg_resp)]=0;
-        en_resp(msg_resp,clint_fd);
-    }
-    else if(strcmp(cmd,"show_history")==0){
-        pthread_mutex_lock(&client_map_mutex);
-        auto it_name = clint_fdtoname.find(clint_fd);
-        string username = (it_name != clint_fdtoname.end()) ? it_name->second : "";
-        pthread_mutex_unlock(&client_map_mutex);
-        if(username.empty()){
-            // pool.en_conn(conn);
-            return;
+        pool.releaseLane(clint_fd);
+    },busy);
+    if(!accepted){
+        LOG_WARN("Auth queue full, rejecting "+name+", FD="+to_string(clint_fd));
+        busy();
+    }
+}
+bool parse_request(Task&task,Request&req){
+    const char*body=task.message.data();
+    size_t len=task.message.size();
+    req.fd=task.fd;
+    if(isFrameV2(body,len)){
+        FrameV2 frame;
+        if(!decodeFrameV2(body,len,frame)){
+            return false;
         }
-        // 查询与当前用户相关的所有聊天记录（自己是发送方或接收方都要查出来）
-        string sql=
-            "select ru.user_name as sender, u.user_name as receiver, "
-            "send_time, group_type, content "
-            "from chat_log c "
-            "join user u on c.receiver_id = u.user_id "
-            "join user ru on ru.user_id = c.sender_id "
-            "where u.user_name = '" + username + "' "
-            "or ru.user_name = '" + username + "'";
-        string ret="";
-        conn->select_many_SQL(sql,ret);
+        req.request_id=frame.request_id;
+        req.opcode=frame.opcode;
+        req.argc=frame.field_count;
+        copy(frame.fields,frame.fields+frame.field_count,req.args);
+        return true;
+    }
+    // v1："cmd|arg1|arg2..."，按'|'切分（保留空参数），参数保持原样（可能带末尾换行）
+    FieldRef parts[PROTOCOL_V2_MAX_FIELDS+1];
+    int n=splitTextFields(body,len,parts,PROTOCOL_V2_MAX_FIELDS+1);
+    req.request_id=0;
+    req.opcode=opcodeFromName(parts[0].data,parts[0].len);
+    req.argc=n-1;
+    copy(parts+1,parts+n,req.args);
+    return true;
+}
+// hello|<version>：协商协议版本，回复 hello|1|<采用的版本>
+void cmd_hello(Request&req,DbConnectionGuard&/*guard*/){
+    int version=atoi(req.arg(0).c_str());
+    if(version>=PROTOCOL_V2){
+        version=PROTOCOL_V2;
+    }
+    else{
+        version=1;
+    }
+    // hello|2|deflate：同时请求压缩，回复 hello|1|2;deflate（只有请求了才附加，旧客户端不受影响）
+    bool deflate=req.argc>1&&req.line(1)=="deflate";
+    string msg="hello|1|"+to_string(version)+(deflate?";deflate":"");
+    en_resp(&msg[0],req.fd);
+    // 回复已按原来的版本投递，之后发往该连接的帧才使用新版本
+    fd_proto[req.fd].store(version);
+    fd_deflate[req.fd].store(deflate);
+}
+void cmd_sign_up_or_in(Request&req,DbConnectionGuard&/*guard*/){
+    const char*cmd=opcodeName(req.opcode);
+    if(req.argc<2||req.args[0].len==0||req.args[1].len==0){
         char msg[BUF_SIZE];
-        snprintf(msg,BUF_SIZE-1,"show_history|1|%s",ret.c_str());
+        snprintf(msg,BUF_SIZE-1,"%s|0|请重试",cmd);//eg:sign_in|1|ok
+        en_resp(msg,req.fd);
+        return;
+    }
+    submit_auth(cmd,req.fd,req.arg(0),req.arg(1));
+}
+void cmd_resume(Request&req,DbConnectionGuard&/*guard*/){
+    // resume|token[|last_id]：用登录时下发的令牌恢复会话，不做密码校验、不查数据库，
+    // 只推送 last_id（与服务器记录的送达位置取较大者）之后到达的离线消息
+    int clint_fd=req.fd;
+    Session session;
+    string token;
+    if(!sessions.resume(req.line(0),session,token)){
+        char msg[]="resume|0|会话已失效，请重新登录";
         en_resp(msg,clint_fd);
+        return;
     }
-    else if(strcmp(cmd,"q\n")==0||strcmp(cmd,"Q\n")==0){
-        //更新status
-        pthread_mutex_lock(&client_map_mutex);
-        auto it_name = clint_fdtoname.find(clint_fd);
-        string username = (it_name != clint_fdtoname.end()) ? it_name->second : "";
-        pthread_mutex_unlock(&client_map_mutex);
-        if(username.empty()){
-            // pool.en_conn(conn);
-            return;
-        }
-        int id=conn->get_id(username.c_str());
-        // printf("user_id:%d\n",id);
-        string sql="update user_status set is_online = 0 where user_id ="+to_string(id);
-        conn->exeSQL(sql);
-        char msg[]="bye\n";
+    unsigned int gen=fd_gen[clint_fd].load();
+    if(!bind_session(clint_fd,gen,session.user_id,session.user_name)){
+        return;
+    }
+    LOG_OPERATION(session.user_id,"resume","username: "+session.user_name);
+    char msg[]="resume|1|ok";
+    en_resp(msg,clint_fd);
+    send_session_token(clint_fd,token);
+    long long after_id=max(session.last_id,atoll(req.arg(1).c_str()));
+    deliver_unread(clint_fd,gen,session.user_id,after_id,true);
+}
+void cmd_show_online_user(Request&req,DbConnectionGuard&/*guard*/){
+    // show_online_user[|prefix[|after[|limit]]]，直接读内存中的在线索引
+    // 参数允许为空（如 show_online_user||bob|50）
+    int limit=atoi(req.arg(2).c_str());
+    vector<string> names;
+    bool more=presence.page(req.line(0),req.line(1),limit>0?limit:0,names);
+    send_streamed(req.fd,"show_online_user",names,more);
+}
+void cmd_single_chat(Request&req,DbConnectionGuard&guard){
+    int clint_fd=req.fd;
+    string from_name;
+    int sender_id;
+    if(!chat_sender(clint_fd,"single_chat",from_name,sender_id)){
+        return;
+    }
+    if(req.argc<2||req.args[0].len==0||req.args[1].len==0){
+        char msg[]="single_chat|0|请重试";
+        en_resp(msg,clint_fd);
+        return;
+    }
+    string to_name=req.arg(0);
+    string text=req.arg(1);
+    if(!chat_text_ok(clint_fd,"single_chat",text)){
+        return;
+    }
+    const char*to=to_name.c_str();
+    int receiver_id=user_cache.get_id(guard.source(),to);
+    if(receiver_id==-1){//发送给的用户不存在
+        char msg[BUF_SIZE];
+        snprintf(msg,BUF_SIZE-1,"single_chat|0|%s","用户不存在");
+        msg[strlen(msg)]=0;
         en_resp(msg,clint_fd);
+        return ;
     }
-    else if(strcmp(cmd,"heartbeat")==0){
+    bool is_delivered=true;
+    pthread_mutex_lock(&client_map_mutex);
+    auto it_fd = clint_nametofd.find(to);
+    int to_fd = (it_fd != clint_nametofd.end()) ? it_fd->second : -1;
+    pthread_mutex_unlock(&client_map_mutex);
+    if(to_fd==-1){//接收用户不在线，不发送
+        is_delivered=false;
+    }
+    else{
+        // 正文可能超过 BUF_SIZE（续帧拼接的长消息），不能用定长缓冲区
+        string forward="single_chat|1|"+from_name+";"+text;
+        en_resp(&forward[0],to_fd);
+    }
+    char msg_resp[BUF_SIZE];
+    snprintf(msg_resp,BUF_SIZE-1,"single_chat|2|发送成功");
+    msg_resp[strlen(msg_resp)]=0;
+    en_resp(msg_resp, clint_fd);
+    // 聊天记录和last_active交给后台写线程批量落库
+    chat_log_writer.append(ChatRecord{sender_id,receiver_id,is_delivered,"single",text});
+    chat_log_writer.touch(sender_id);
+}
+void cmd_multi_chat(Request&req,DbConnectionGuard&guard){
+    int clint_fd=req.fd;
+    string from_name;
+    int sender_id;
+    if(!chat_sender(clint_fd,"multi_chat",from_name,sender_id)){
+        return;
+    }
+    if(req.argc<2||req.args[0].len==0||req.args[1].len==0){
+        return ;
+    }
+    string usernames=req.arg(0);
+    string text=req.arg(1);
+    if(!chat_text_ok(clint_fd,"multi_chat",text)){
+        return;
+    }
+    vector<int> to_fds;  // 在线接收者，最后统一扇出
+    char* names_saveptr = NULL;
+    for(char* to=strtok_r(&usernames[0]," ",&names_saveptr);to;to=strtok_r(NULL," ",&names_saveptr)){
+        int receiver_id=user_cache.get_id(guard.source(),to);
+        if(receiver_id==-1){//发送给的用户不存在
+            continue;
+        }
+        bool is_delivered=true;
         pthread_mutex_lock(&client_map_mutex);
-        auto it_name = clint_fdtoname.find(clint_fd);
-        string username = (it_name != clint_fdtoname.end()) ? it_name->second : "";
+        auto it_fd = clint_nametofd.find(to);
+        int to_fd = (it_fd != clint_nametofd.end()) ? it_fd->second : -1;
         pthread_mutex_unlock(&client_map_mutex);
-        if(username.empty()){
-            char msg[]="heartbeat|0|未登录";
-            en_resp(msg,clint_fd);
-            // pool.en_conn(conn);
-            return;
+        if(to_fd==-1){//接收用户不在线，不发送
+            is_delivered=false;
         }
-        int user_id=conn->get_id(username.c_str());
-        string sql="update user_status set last_active = NOW() where user_id ="+to_string(user_id);
-        if(conn->exeSQL(sql)){
-            char msg[]="heartbeat|1|ok";
-            en_resp(msg,clint_fd);
+        else{
+            to_fds.push_back(to_fd);
+        }
+        chat_log_writer.append(ChatRecord{sender_id,receiver_id,is_delivered,"multi",text});
+    }
+    en_resp_multi("multi_chat|2|"+from_name+";"+text,to_fds);
+    //更新status
+    chat_log_writer.touch(sender_id);
+    char msg_resp[BUF_SIZE];
+    snprintf(msg_resp,BUF_SIZE-1,"multi_chat|1|发送成功");
+    msg_resp[strlen(msg_resp)]=0;
+    en_resp(msg_resp,clint_fd);
+}
+void cmd_broadcast_chat(Request&req,DbConnectionGuard&guard){
+    int clint_fd=req.fd;
+    string from_name;
+    int sender_id;
+    if(!chat_sender(clint_fd,"broadcast_chat",from_name,sender_id)){
+        return;
+    }
+    // 为了安全遍历，复制一份当前在线用户列表
+    pthread_mutex_lock(&client_map_mutex);
+    vector<pair<string,int>> clients_snapshot;
+    clients_snapshot.reserve(clint_nametofd.size());
+    for (auto &it : clint_nametofd) {
+        clients_snapshot.push_back(it);
+    }
+    pthread_mutex_unlock(&client_map_mutex);
+    const char*from=from_name.c_str();
+    if(req.argc<1||req.args[0].len==0){
+        return ;
+    }
+    string text=req.arg(0);
+    if(!chat_text_ok(clint_fd,"broadcast_chat",text)){
+        return;
+    }
+    vector<int> to_fds;  // 在线接收者，最后统一扇出
+    to_fds.reserve(clients_snapshot.size());
+    for(auto&it:clients_snapshot){
+        string to=it.first;
+        int to_fd=it.second;
+        if(to==from)continue;
+        int receiver_id=user_cache.get_id(guard.source(),to);
+        if(receiver_id==-1){//发送给的用户不存在
+            continue;
+        }
+        bool is_delivered=true;
+        // 这里的在线状态以快照为准
+        if(to_fd < 0){//接收用户不在线，不发送
+            is_delivered=false;
         }
         else{
-            char msg[]="heartbeat|0|更新失败";
+            to_fds.push_back(to_fd);
+        }
+        chat_log_writer.append(ChatRecord{sender_id,receiver_id,is_delivered,"broadcast",text});
+    }
+    en_resp_multi("broadcast_chat|2|"+from_name+";"+text,to_fds);
+    //更新status
+    chat_log_writer.touch(sender_id);
+    char msg_resp[BUF_SIZE];
+    snprintf(msg_resp,BUF_SIZE-1,"broadcast_chat|1|发送成功");
+    msg_resp[strlen(msg_resp)]=0;
+    en_resp(msg_resp,clint_fd);
+}
+void cmd_show_history(Request&req,DbConnectionGuard&/*guard*/){
+    // show_history[|before_id[|page_size]]：按消息id倒序分页，before_id为上一页最后一条的id
+    int clint_fd=req.fd;
+    int user_id=-1;
+    pthread_mutex_lock(&client_map_mutex);
+    auto it_id = clint_fdtoid.find(clint_fd);
+    if(it_id != clint_fdtoid.end()) user_id = it_id->second;
+    pthread_mutex_unlock(&client_map_mutex);
+    if(user_id==-1){
+        return;
+    }
+    long long before_id=atoll(req.arg(0).c_str());
+    if(before_id<=0)before_id=INT32_MAX;  // 不带游标时从最新的消息开始
+    int page_size=atoi(req.arg(1).c_str());
+    if(page_size<=0)page_size=HISTORY_PAGE_DEFAULT;
+    if(page_size>HISTORY_PAGE_MAX)page_size=HISTORY_PAGE_MAX;
+    uint32_t request_id=req.request_id;
+    unsigned int gen=fd_gen[clint_fd].load();  // 查询完成前连接关闭、fd被复用时，记录不能发给新连接
+    // 发送方、接收方各走一个(xxx_id,id)索引取出候选id，合并后再回表，避免 OR 导致全表扫描
+    // 查询在异步数据库阶段执行，工作线程不等待结果，完成回调中直接分帧回复
+    async_db.submit(
+        "select c.id, su.user_name, ru.user_name, c.send_time, c.group_type, c.content "
+        "from ((select id from chat_log where sender_id = ? and id < ? order by id desc limit ?) "
+        "union "
+        "(select id from chat_log where receiver_id = ? and id < ? order by id desc limit ?)) t "
+        "join chat_log c on c.id = t.id "
+        "join user su on su.user_id = c.sender_id "
+        "left join user ru on ru.user_id = c.receiver_id "
+        "order by c.id desc limit ?",
+        {user_id,before_id,page_size,user_id,before_id,page_size,page_size},[clint_fd,gen,page_size,request_id](DbResult&res){
+        if(fd_gen[clint_fd].load()!=gen){
+            return;
+        }
+        ReplyScope scope(clint_fd,request_id,gen);
+        if(!res.ok){
+            char msg[]="show_history|0|请重试";
             en_resp(msg,clint_fd);
+            return;
+        }
+        vector<string> lines;
+        lines.reserve(res.rows.size());
+        size_t bytes=0;
+        bool cut=false;  // 超过 HISTORY_PAGE_BYTES，本页提前结束
+        for(const DbRow&row:res.rows){
+            string line;
+            for(size_t i=0;i<row.size();i++){
+                if(i)line+=' ';
+                line+=row[i].text();
+            }
+            if(!lines.empty()&&bytes+line.size()>HISTORY_PAGE_BYTES){
+                cut=true;
+                break;
+            }
+            bytes+=line.size();
+            lines.push_back(std::move(line));
+        }
+        // 取满一页（或按字节截断）说明可能还有更早的记录，客户端用最后一条的id继续翻页
+        send_streamed(clint_fd,"show_history",lines,cut||(int)res.rows.size()==page_size);
+    });
+}
+void cmd_quit(Request&req,DbConnectionGuard&/*guard*/){
+    //status在连接关闭时由close_clint更新
+    pthread_mutex_lock(&client_map_mutex);
+    auto it_id = clint_fdtoid.find(req.fd);
+    int user_id = it_id != clint_fdtoid.end() ? it_id->second : -1;
+    pthread_mutex_unlock(&client_map_mutex);
+    if(user_id==-1){
+        return;
+    }
+    sessions.revoke(user_id);  // 主动退出后令牌不能再用于恢复会话
+    char msg[]="bye\n";
+    en_resp(msg,req.fd);
+}
+// 按 opcode 索引的命令表；心跳在事件循环中处理，chat_unread/session 只由服务器推送
+static const CommandHandler* command_table(){
+    static CommandHandler table[OP_COUNT]={nullptr};
+    static bool filled=[]{
+        table[OP_HELLO]=cmd_hello;
+        table[OP_SIGN_UP]=cmd_sign_up_or_in;
+        table[OP_SIGN_IN]=cmd_sign_up_or_in;
+        table[OP_RESUME]=cmd_resume;
+        table[OP_SHOW_ONLINE_USER]=cmd_show_online_user;
+        table[OP_SINGLE_CHAT]=cmd_single_chat;
+        table[OP_MULTI_CHAT]=cmd_multi_chat;
+        table[OP_BROADCAST_CHAT]=cmd_broadcast_chat;
+        table[OP_SHOW_HISTORY]=cmd_show_history;
+        table[OP_QUIT]=cmd_quit;
+        return true;
+    }();
+    (void)filled;
+    return table;
+}
+// 每个命令的请求数和处理耗时（工作线程中同步执行的部分，不含异步数据库/认证阶段）
+struct CommandMetrics{
+    Counter*total;
+    Histogram*latency;
+};
+static const CommandMetrics* command_metrics(){
+    static CommandMetrics table[OP_COUNT+1];  // 最后一项记录无法识别的请求
+    static bool filled=[]{
+        Metrics*m=Metrics::getInstance();
+        for(int op=0;op<=OP_COUNT;op++){
+            string cmd=op<OP_COUNT&&command_table()[op]?opcodeName(op):"unknown";
+            table[op].total=m->counter("chatroom_cmd_total",Metrics::label("cmd",cmd));
+            table[op].latency=m->histogram("chatroom_cmd_us",Metrics::label("cmd",cmd));
         }
+        return true;
+    }();
+    (void)filled;
+    return table;
+}
+void process_clint_data(Task&task){
+    Request req;
+    if(!parse_request(task,req)){
+        command_metrics()[OP_COUNT].total->inc();
+        LOG_WARN("Malformed v2 frame from FD="+to_string(task.fd));
+        return;
+    }
+    CommandHandler handler=req.opcode<OP_COUNT?command_table()[req.opcode]:nullptr;
+    const CommandMetrics&metrics=command_metrics()[handler?(int)req.opcode:(int)OP_COUNT];
+    metrics.total->inc();
+    if(Trace*trace=Tracer::current().get()){
+        trace->cmd.store(handler?opcodeName(req.opcode):"unknown");
+    }
+    if(handler==nullptr){
+        LOG_DEBUG("Unknown command from FD="+to_string(req.fd)+", opcode="+to_string(req.opcode));
+        return;
     }
-    // ✓ 不需要手动调用 en_conn()，守卫析构时自动调用
+    ScopedTimer timer(metrics.latency);
+    // 回复带上本请求的id；连接守卫只在命令真正访问数据库时借用连接，析构时自动归还
+    ReplyScope scope(req.fd,req.request_id);
+    DbConnectionGuard guard(&db_pool);
+    handler(req,guard);
 }
-void handle_response(){
+void register_metrics(){
+    Metrics*m=Metrics::getInstance();
+    m->gauge("chatroom_connections","",[]{return (long long)(conn_accepted->get()-conn_closed->get());});
+    m->gauge("chatroom_online_users","",[]{return (long long)presence.size();});
+    m->gauge("chatroom_sessions","",[]{return (long long)sessions.size();});
+    m->gauge("chatroom_pool_queued_tasks","",[]{return pool.queuedTasks();});
+    m->gauge("chatroom_pool_idle_workers","",[]{return (long long)pool.idleWorkers();});
+    for(int i=0;i<loop_num;i++){
+        EventLoop*loop=&loops[i];
+        m->gauge("chatroom_response_queue_depth",Metrics::label("loop",to_string(i)),
+                 [loop]{return (long long)loop->mailbox->size();});
+    }
+    m->gauge("chatroom_compress_in_bytes","",[]{return (long long)deflate_in_bytes.load();});
+    m->gauge("chatroom_compress_out_bytes","",[]{return (long long)deflate_out_bytes.load();});
+}
+void handle_response(EventLoop*loop){
     uint64_t tmp;
-    read(event_fd,&tmp,sizeof(tmp));
+    read(loop->event_fd,&tmp,sizeof(tmp));
+    // 先清除唤醒标志再取数据：之后投递的响应会重新写eventfd，不会被漏掉
+    loop->wake_pending.store(false);
+    Response resp;
+    while(loop->mailbox->pop(resp)){
+        // 连接可能已在本循环中关闭（fd甚至被其它循环或本循环的新连接复用），跳过
+        if(fd_owner[resp.fd].load()==loop->id&&(resp.gen==-1||fd_gen[resp.fd].load()==resp.gen)){
+            if(resp.trace){
+                resp.trace->stampFirst(TRACE_POPPED);
+                shared_ptr<Trace> trace=std::move(resp.trace);
+                SentCallback inner=std::move(resp.on_sent);
+                resp.on_sent=[trace,inner]{
+                    trace->stamp(TRACE_SENT);
+                    if(inner)inner();
+                };
+            }
+            queue_output(loop,resp.fd,resp.frame,resp.close_after,resp.on_sent);
+        }
+        resp.frame.reset();
+        resp.on_sent=nullptr;
+        resp.trace.reset();
+    }
+}
+SharedFrame compress_frame(Connection*conn,int clint_fd,const SharedFrame&frame){
+    // 取出帧中的整条消息（拼接续帧），用连接的压缩流压缩后重新分帧
+    string body;
+    const char*p=frame->data();
+    size_t left=frame->size();
+    bool more=true;
+    while(more){
+        const char*chunk;
+        size_t len;
+        int consumed=extractFrame(p,left,chunk,len,more);
+        if(consumed<0)return frame;
+        body.append(chunk,len);
+        p+=consumed;
+        left-=consumed;
+    }
+    if(left!=0)return frame;  // 不是单条消息，原样发送
+    if(!conn->deflater)conn->deflater.reset(new Deflater());
+    string packed;
+    if(!conn->deflater->compress(body.data(),body.size(),packed)){
+        // 压缩流出错时还没有发出任何压缩数据，停止压缩即可，客户端的解压流不受影响
+        LOG_WARN("Deflate failed, compression disabled for FD="+to_string(clint_fd));
+        fd_deflate[clint_fd].store(0);
+        return frame;
+    }
+    auto f=make_shared<string>();
+    encodeMessageTo(*f,packed.data(),packed.size(),PROTOCOL_COMPRESSED_FLAG);
+    deflate_in_bytes+=frame->size();
+    deflate_out_bytes+=f->size();
+    return SharedFrame(std::move(f));
+}
+void queue_output(EventLoop*loop,int clint_fd,const SharedFrame&frame,bool close_after,const SentCallback&on_sent){
+    Connection*conn=conn_table[clint_fd];
+    OutQueue&q=conn->out;
+    // 压缩在这里（连接所属循环、入队顺序）进行，保证压缩流的顺序与发送顺序一致
+    bool compress=fd_deflate[clint_fd].load()&&frame->size()>PROTOCOL_DEFLATE_THRESHOLD;
+    if(!q.append(compress?compress_frame(conn,clint_fd,frame):frame,on_sent)){
+        // 对端长时间不读，积压超过高水位，断开慢客户端
+        LOG_NET_ERROR(clint_fd,"Outbound queue over high-water mark ("+to_string(q.size())+" bytes), closing slow client",ERR_SOCKET_SEND_FAIL);
+        close_clint(loop,clint_fd);
+        return;
+    }
+    if(close_after){
+        q.close_when_drained=true;
+    }
+    if(q.watching_out){
+        return;  // 已有数据在等待EPOLLOUT，保持发送顺序
+    }
+    flush_output(loop,clint_fd);
+}
+void flush_output(EventLoop*loop,int clint_fd){
+    Connection*conn=conn_table[clint_fd];
+    if(conn==NULL||fd_owner[clint_fd].load()!=loop->id){
+        return;
+    }
+    OutQueue&q=conn->out;
+    struct epoll_event event;
+    event.data.fd=clint_fd;
+    switch(q.flush(clint_fd)){
+        case FLUSH_DONE:
+            if(q.close_when_drained){
+                close_clint(loop,clint_fd);
+                return;
+            }
+            if(q.watching_out){
+                event.events=EPOLLIN|EPOLLRDHUP;
+                epoll_ctl(loop->epoll_fd,EPOLL_CTL_MOD,clint_fd,&event);
+                q.watching_out=false;
+            }
+            break;
+        case FLUSH_AGAIN:
+            if(!q.watching_out){
+                event.events=EPOLLIN|EPOLLOUT|EPOLLRDHUP;
+                if(epoll_ctl(loop->epoll_fd,EPOLL_CTL_MOD,clint_fd,&event)==-1){
+                    LOG_ERROR("Epoll_ctl add EPOLLOUT failed",ERR_EPOLL_CTL_FAIL);
+                    close_clint(loop,clint_fd);
+                    return;
+                }
+                q.watching_out=true;
+            }
+            break;
+        case FLUSH_ERROR:
+            LOG_NET_ERROR(clint_fd,"Failed to send message",ERR_SOCKET_SEND_FAIL);
+            close_clint(loop,clint_fd);
+            break;
+    }
+}
+void handle_timer(EventLoop*loop){
+    uint64_t ticks=0;
+    if(read(loop->timer_fd,&ticks,sizeof(ticks))!=sizeof(ticks)){
+        return;
+    }
+    vector<int> expired;
+    for(uint64_t t=0;t<ticks;t++){
+        loop->wheel.tick(expired);
+    }
+    for(int fd:expired){
+        if(fd_owner[fd].load()!=loop->id)continue;
+        LOG_INFO("Connection idle timeout: FD="+to_string(fd));
+        close_clint(loop,fd);
+    }
+    if(loop->id==0&&loop->wheel.now()%60==0){
+        size_t expired_sessions=sessions.expire();
+        LOG_INFO("Sessions: active="+to_string(sessions.size())+", expired="+to_string(expired_sessions));
+        LOG_INFO("User cache stats: " + user_cache.stats());
+        LOG_INFO("Thread pool stats: " + pool.stats());
+        LOG_INFO("DB pool stats: " + db_pool.stats());
+        LOG_INFO("Async DB stats: " + async_db.stats());
+        LOG_INFO("Auth executor stats: " + auth_executor.stats());
+        LOG_INFO("Compression: in="+to_string(deflate_in_bytes.load())+", out="+to_string(deflate_out_bytes.load()));
+    }
+}
+void* loop_run(void*arg){
+    EventLoop*loop=(EventLoop*)arg;
+    struct epoll_event events[MAX_EVENTS];
+    int i;
+    LOG_INFO("Event loop "+to_string(loop->id)+" running");
     while(1){
-        pthread_mutex_lock(&resp_mutex);
-        if(resp_queue.empty()){
-            pthread_mutex_unlock(&resp_mutex);
+        int num_fd=epoll_wait(loop->epoll_fd,events,MAX_EVENTS,-1);
+        if(num_fd==-1){
+            if(errno==EINTR)continue;
+            LOG_ERROR("Epoll wait failed",ERR_EPOLL_WAIT_FAIL);
             break;
         }
-        Response resp=resp_queue.front();
-        resp_queue.pop();
-        pthread_mutex_unlock(&resp_mutex);
-        send(resp.fd,resp.out.c_str(),resp.out.size(),0);
-        if(resp.close_after){
-            close_clint(epoll_fd,resp.fd);
-        }
-    }
-}
-void* check_timeout_thread(void* arg) {
-    MyDb con;
-    con.initDB(HOST, USER, PWD, DB_NAME, 3306);
-    while (1) {
-        sleep(10);
-        string ret;
-        // 优化超时检查: 40秒无心跳则判定超时（留有缓冲时间）
-        // C++客户端心跳间隔: 15秒
-        // Python客户端心跳间隔: 18秒
-        // 40秒足够检测到真正掉线的客户端，并给正常客户端足够的缓冲时间
-        con.select_many_SQL(
-            "select user_id from user_status "
-            "where is_online=1 and last_active < NOW() - INTERVAL 40 SECOND",
-            ret
-        );
-        if (ret.empty()) continue;
-        char* buf = strdup(ret.c_str());
-        char* user_id = strtok(buf, "\n");
-        while (user_id) {
-            int uid = atoi(user_id);
-            string update ="update user_status set is_online=0 where user_id="+to_string(uid);
-            con.exeSQL(update);
-            string name = con.get_name(uid);
-            pthread_mutex_lock(&client_map_mutex);
-            auto it_fd = clint_nametofd.find(name);
-            int to_fd = (it_fd != clint_nametofd.end()) ? it_fd->second : -1;
-            pthread_mutex_unlock(&client_map_mutex);
-            if (to_fd != -1) {
-                char msg[]="bye\n";
-                en_resp(msg,to_fd);
+        for(i=0;i<num_fd;i++){
+            int fd=events[i].data.fd;
+            uint32_t ev=events[i].events;
+            if(fd==loop->listen_fd){//有新客户端连接
+                handle_new_connect(loop);
+            }
+            else if(fd==loop->event_fd){
+                handle_response(loop);
+            }
+            else if(fd==loop->timer_fd){
+                handle_timer(loop);
+            }
+            else{
+                if(ev&EPOLLOUT){//发送缓冲区可写，继续发送积压数据
+                    flush_output(loop,fd);
+                }
+                if((ev&EPOLLIN)&&fd_owner[fd].load()==loop->id){//客户端有消息发送
+                    handle_clint_data(loop,fd);
+                }
+                // handle_clint_data 中可能已经关闭了该连接
+                if((ev&(EPOLLERR|EPOLLHUP|EPOLLRDHUP))&&fd_owner[fd].load()==loop->id){//客户端断开连接
+                    close_clint(loop,fd);
+                }
             }
-            user_id = strtok(NULL, "\n");
         }
-        free(buf);
     }
-    return nullptr;
+    return NULL;
 }
 //fatal error warning info debug trace
 int main(int argc,char*argv[]){
     Logger*logger=Logger::getInstance();
-    if(!logger->initialize("logs","chatroom.log",LogLevel::DEBUG,true)){
+    // 异步模式：业务线程只把日志行放进环形队列，由后台线程写文件
+    if(!logger->initialize("logs","chatroom.log",LogLevel::DEBUG,true,true)){
         cerr<<"Failed to initialize logger"<<endl;
         return 1;
     }
     logger->setConsoleOutput(false);
     LOG_INFO("========Chatroom Server Statring========");
-    pthread_mutex_init(&resp_mutex,NULL);
     pthread_mutex_init(&client_map_mutex,NULL);
-    pthread_mutex_init(&buffer_map_mutex,NULL);  // 初始化缓冲区互斥锁
     srand(time(NULL));
-    
-    // 启动心跳检测线程
-    pthread_t timeout_tid;
-    if(pthread_create(&timeout_tid, NULL, check_timeout_thread, NULL) != 0){
-        perror("Failed to create timeout thread");
-        exit(0);
+    for(int i=0;i<MAX_CONN_FD;i++){
+        fd_owner[i].store(-1);
     }
-    
-    ser_fd=server_init();
-    if(set_unblocking(ser_fd)==0){
-        close(ser_fd);
+    if(!db_pool.start(HOST,USER,PWD,DB_NAME,3306)){
         exit(0);
     }
-    struct epoll_event event,events[MAX_EVENTS];
-    epoll_fd=epoll_create(1);
-    if(epoll_fd==-1){
-        LOG_FATAL("Epoll create failed",ERR_EPOLL_CREATE_FAIL);
+    if(!chat_log_writer.start(HOST,USER,PWD,DB_NAME,3306)){
         exit(0);
     }
-    event.events=EPOLLIN|EPOLLET|EPOLLRDHUP;
-    event.data.fd=ser_fd;
-    if(epoll_ctl(epoll_fd,EPOLL_CTL_ADD,ser_fd,&event)==-1){
-        LOG_FATAL("Epoll_ctl add server socket failed",ERR_EPOLL_CTL_FAIL);
-        close(epoll_fd);
-        close(ser_fd);
-        close(event_fd);
+    // 认证并发数：第二个命令行参数指定，默认 AUTH_THREADS
+    if(!auth_executor.start((argc>2)?atoi(argv[2]):AUTH_THREADS)){
         exit(0);
     }
-    event.events=EPOLLIN;
-    event.data.fd=event_fd;
-    if(epoll_ctl(epoll_fd,EPOLL_CTL_ADD,event_fd,&event)==-1){
-        LOG_FATAL("Epoll_ctl add event_fd failed",ERR_EPOLL_CTL_FAIL);
-        close(epoll_fd);
-        close(ser_fd);
-        close(event_fd);
+    // 异步查询阶段：第四、五个命令行参数指定I/O线程数和每个线程复用的连接数，在途查询上限为两者之积
+    if(!async_db.start(HOST,USER,PWD,DB_NAME,3306,(argc>4)?atoi(argv[4]):ASYNC_DB_THREADS,
+                       (argc>5)?atoi(argv[5]):ASYNC_DB_CONNS_PER_THREAD)){
         exit(0);
     }
-    LOG_INFO("Epoll server started successfully, waiting for connections...");
-    int i;
-    while(1){
-        int num_fd=epoll_wait(epoll_fd,events,MAX_EVENTS,-1);
-        if(num_fd==-1){
-            LOG_ERROR("Epoll wait failed",ERR_EPOLL_WAIT_FAIL);
-            break;
-        }
-        for(i=0;i<num_fd;i++){
-            int fd=events[i].data.fd;
-            uint32_t ev=events[i].events;
-            if(fd==ser_fd){//有新客户端连接
-                handle_new_connect();
-            }
-            else if(fd==event_fd){
-                handle_response();
+    
+    // 事件循环数量：命令行参数指定，默认每个CPU核心一个
+    loop_num=(argc>1)?atoi(argv[1]):(int)sysconf(_SC_NPROCESSORS_ONLN);
+    if(loop_num<1)loop_num=1;
+    if(loop_num>MAX_LOOPS)loop_num=MAX_LOOPS;
+    
+    for(int i=0;i<loop_num;i++){
+        int listen_fd=server_init(loop_num>1);
+        if(listen_fd==-1){
+            if(i==0){
+                // 内核不支持SO_REUSEPORT：只由0号循环accept，连接仍按accept的循环固定
+                listen_fd=server_init(false);
             }
             else{
-                if(ev&EPOLLIN){//客户端有消息发送
-                    handle_clint_data(epoll_fd,fd);
-                }
-                if(ev&(EPOLLERR|EPOLLHUP|EPOLLRDHUP)){//客户端断开连接
-                    close_clint(epoll_fd,fd);
-                }
+                LOG_WARN("Loop "+to_string(i)+" runs without listening socket");
             }
         }
+        if(!loop_init(&loops[i],i,listen_fd)){
+            exit(0);
+        }
+    }
+    register_metrics();
+    // 追踪采样率：第三个命令行参数指定（每N条消息追踪一条），默认关闭，运行中可经指标套接字调整
+    Tracer::getInstance()->setSampling((argc>3)?atoi(argv[3]):0);
+    Metrics::getInstance()->startAdmin(ADMIN_SOCKET_PATH);  // 失败只影响指标导出，不影响服务
+    LOG_INFO("Epoll server started successfully with "+to_string(loop_num)+" event loops, waiting for connections...");
+    // 0号循环运行在主线程上，其余循环各占一个线程
+    for(int i=1;i<loop_num;i++){
+        if(pthread_create(&loops[i].tid,NULL,loop_run,&loops[i])!=0){
+            LOG_FATAL("Failed to create event loop thread",ERR_THREAD_CREATE_FAIL);
+            exit(0);
+        }
+    }
+    loops[0].tid=pthread_self();
+    loop_run(&loops[0]);
+    for(int i=0;i<loop_num;i++){
+        if(loops[i].listen_fd!=-1)close(loops[i].listen_fd);
+        close(loops[i].epoll_fd);
+        close(loops[i].event_fd);
+        close(loops[i].timer_fd);
     }
-    close(ser_fd);
-    close(epoll_fd);
     Logger::destroy();
     return 0;
-}
\ No newline at end of file
+}
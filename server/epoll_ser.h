@@ -15,15 +15,52 @@
 #include<pthread.h>
 #include"MyDb.h"
 #include"Protocol.h"
+#include"OutQueue.h"
+#include"UserCache.h"
+#include"ChatLogWriter.h"
+#include"TimerWheel.h"
+#include"Ring.h"
+#include"Connection.h"
+#include"DbPool.h"
+#include"AsyncDb.h"
+#include"AuthExecutor.h"
+#include"SessionTable.h"
+#include"Presence.h"
+#include"Metrics.h"
+#include"Trace.h"
 #include<queue>
 #include<vector>
 #include<crypt.h>
 #include<sys/eventfd.h>
+#include<sys/timerfd.h>
+#include<sched.h>
 #include<map>
+#include<atomic>
 
 #define BUF_SIZE 4096      // 接收缓冲区大小（4KB，对齐协议最大消息）
 #define CLINT_SIZE 1000
 #define MAX_EVENTS 1024
+#define SERVER_PORT 8080
+#define MAX_LOOPS 64       // reactor（事件循环）数量上限
+#define MAX_CONN_FD 65536  // fd_owner 表大小，超过该值的fd直接拒绝
+#define USER_CACHE_CAPACITY 100000  // 用户目录缓存容量（LRU），0表示不淘汰
+// 连接空闲超时：40秒内没有收到任何帧则断开（留有缓冲时间）
+// C++客户端心跳间隔: 15秒，Python客户端心跳间隔: 18秒
+#define IDLE_TIMEOUT_TICKS 40
+#define STREAM_FRAME_LIMIT 4000  // 分帧返回列表时每帧合并的数据字节数（单行更长时独占一帧，以续帧发送）
+#define HISTORY_PAGE_DEFAULT 50  // show_history 默认每页条数
+#define HISTORY_PAGE_MAX 200     // show_history 每页条数上限
+// show_history 每页数据字节上限（至少一条）：整页一次入队，要远低于发送队列高水位 OUT_QUEUE_HIGH_WATER，
+// 否则长消息多的一页会让请求者自己被当成慢客户端断开
+#define HISTORY_PAGE_BYTES (256 * 1024)
+#define UNREAD_BATCH_ROWS 100    // 登录时离线消息每批条数
+#define UNREAD_BATCH_BYTES (256 * 1024)  // 离线消息每批数据字节上限（至少一条），同样要远低于发送队列高水位
+// 聊天正文上限：chat_log.content 为 TEXT（最多65535字节），转发时正文前还要加上发送者、时间，
+// 留出余量使整行仍能放进 v2 的一个字段（字段长度同样最多65535字节）
+#define CHAT_TEXT_MAX 65000
+#define RESPONSE_RING_SIZE 16384  // 每个事件循环响应队列的槽数（2的幂）
+#define TIMER_TICK_MS 1000  // 时间轮每格1秒
+#define TIMER_WHEEL_SLOTS 64
 #define PORT 3306
 #define HOST "192.168.147.130"
 #define USER "ftpuser"
@@ -33,131 +70,347 @@
 struct Task{
     int fd;//clinent_fd
     string message;
+    function<void()> job;  // 非空时执行job而不是解析message（服务器内部的后续任务）
+    shared_ptr<Trace> trace;  // 被采样追踪的消息非空
 };
-struct Response{
+// 一条已解析的请求（v1 文本或 v2 二进制），字段指向 Task::message 内部，不做拷贝
+struct Request{
     int fd;
-    string out;
-    bool close_after;
+    uint32_t request_id;  // v2 请求的id，回复时原样带回；v1 请求为0
+    uint8_t opcode;
+    int argc;
+    FieldRef args[PROTOCOL_V2_MAX_FIELDS];
+    // 第i个参数，缺少时为空串
+    string arg(int i)const{return i<argc?args[i].str():string();}
+    // 同 arg，去掉末尾换行（v1 客户端的命令常以换行结尾）
+    string line(int i)const{
+        string s=arg(i);
+        while(!s.empty()&&(s.back()=='\n'||s.back()=='\r'))s.pop_back();
+        return s;
+    }
+};
+struct Response{
+    int fd=-1;
+    SharedFrame frame;  // 已编码的帧，扇出时多个Response共享同一块内存
+    bool close_after=false;
+    SentCallback on_sent;  // 帧写入套接字后调用
+    shared_ptr<Trace> trace;  // 回复被追踪的请求时非空
+    long long gen=-1;  // 产生回复时连接的代数（fd_gen），与当前代数不一致时丢弃；-1表示不检查
 };
 
-// 客户端接收缓冲区（用于处理粘包/拆包）
-struct ClientBuffer {
-    char buffer[PROTOCOL_MAX_TOTAL_SIZE];
-    int pos;  // 当前缓冲区中的数据长度
-    
-    ClientBuffer() : pos(0) {
-        memset(buffer, 0, sizeof(buffer));
-    }
+/**
+ * @brief 事件循环（multi-reactor 中的一个 reactor）
+ *
+ * 每个事件循环独占一个线程、一个 epoll fd、一个监听套接字（SO_REUSEPORT，
+ * 由内核在各循环间分配新连接）和一个响应 eventfd。连接在 accept 时被固定
+ * 到接收它的循环上，之后该连接的读写、关闭都只在这个循环线程中进行。
+ * 工作线程通过无锁的 mailbox 把响应投递给连接所属的循环；只有 mailbox 由空
+ * 变为非空后的第一次投递才写 eventfd（wake_pending），循环被唤醒后一次取完。
+ * 连接对象（conn_slab）、接收缓冲块（block_pool）和超时时间轮（wheel）只由本循环
+ * 线程访问，因此不需要加锁。
+ */
+struct EventLoop{
+    int id;
+    int epoll_fd;
+    int listen_fd;              // -1 表示该循环不监听（不支持SO_REUSEPORT时）
+    int event_fd;               // mailbox 由空变为非空时唤醒本循环
+    int timer_fd;               // 周期性驱动时间轮
+    pthread_t tid;
+    unique_ptr<MpscRing<Response>> mailbox;  // 投递给本循环所属连接的响应
+    atomic<bool> wake_pending;  // 已写eventfd、循环尚未开始处理
+
+    Slab<Connection> conn_slab; // 本循环所属连接的状态（接收缓冲区、发送队列）
+    BlockPool block_pool;       // 接收缓冲块，只借给有未解析数据的连接
+    TimerWheel wheel;           // 连接空闲超时
+    EventLoop():wake_pending(false),wheel(TIMER_WHEEL_SLOTS){}
 };
 
 // 保护 clint_nametofd / clint_fdtoname 的互斥锁（多线程访问）
 extern pthread_mutex_t client_map_mutex;
 
-int server_init();//服务器初始化
+int server_init(bool reuseport);//服务器初始化（创建一个监听套接字）
 int set_unblocking(int fd);//为ET触发，设置非阻塞式i/o
-void handle_new_connect();//与客户端建立连接
-void handle_clint_data(int epoll_fd,int clint_fd);//接受并处理客户端数据
-void close_clint(int epoll_fd,int clint_fd);
-void process_clint_data(Task&task);
+bool loop_init(EventLoop*loop,int id,int listen_fd);//初始化一个事件循环
+void* loop_run(void*arg);//事件循环主体
+void handle_new_connect(EventLoop*loop);//与客户端建立连接
+void handle_clint_data(EventLoop*loop,int clint_fd);//接受并处理客户端数据
+void reject_oversized(EventLoop*loop,int clint_fd,const string&head);//超出重组预算的续帧消息回复错误
+void close_clint(EventLoop*loop,int clint_fd);
 bool send_message(int clint_fd,const char buf[],int len);
-void handle_response();
-void signal_event_fd();
-void en_resp(char*msg,int clint_fd);
+void handle_response(EventLoop*loop);
+void handle_timer(EventLoop*loop);//时间轮前进，关闭超时连接
+void handle_heartbeat(EventLoop*loop,int clint_fd,bool v2,uint32_t request_id);//在事件循环中直接应答心跳（按请求的协议版本回复）
+SharedFrame compress_frame(Connection*conn,int clint_fd,const SharedFrame&frame);//用连接的压缩流压缩一条消息
+void queue_output(EventLoop*loop,int clint_fd,const SharedFrame&frame,bool close_after,const SentCallback&on_sent=nullptr);//追加到发送队列并尝试发送
+void flush_output(EventLoop*loop,int clint_fd);//发送队列中的数据，按需注册/注销EPOLLOUT
+void post_response(EventLoop*loop,Response&&resp);//投递响应（队列满时等待）
+void signal_event_fd(EventLoop*loop);//需要时唤醒循环（合并唤醒）
+void en_resp(char*msg,int clint_fd,const SentCallback&on_sent=nullptr);//on_sent: 帧写出后在事件循环中回调
+void deliver_unread(int clint_fd,unsigned int gen,int user_id,long long after_id,bool first);//按批推送离线消息
+void en_resp_multi(const string&msg,const vector<int>&fds);//同一条消息发给多个连接，只编码一次
 void process_clint_data(Task &task);
+bool parse_request(Task&task,Request&req);//解析v1/v2请求，得到opcode和参数
+void register_metrics();//注册连接数、队列深度等采样值（事件循环初始化之后调用）
+
+#define POOL_LANES 1024        // 任务通道数，连接按fd散列到通道
+#define POOL_LANE_BATCH 16     // 工作线程每次从一个通道连续处理的最大任务数
 
+/**
+ * @class ThreadPool
+ * @brief 按连接分通道（lane）的线程池
+ *
+ * 同一个连接的任务总是进入同一个通道（fd % POOL_LANES），通道内的任务按到达
+ * 顺序执行，并且同一时刻最多只有一个工作线程在处理某个通道，因此同一用户的
+ * 消息不会乱序。不同通道之间完全并行。
+ *
+ * 通道有任务时被放入其"主"工作线程的就绪队列；主线程忙时，空闲的工作线程
+ * 会从其它线程的就绪队列尾部窃取整个通道来执行。每个通道带有积压任务数计数
+ * （depth），用于观察热点连接。
+ *
+ * 任务把工作交给其它执行器（如登录交给认证执行器）时可以挂起所在通道
+ * （holdLane），通道在当前任务结束后暂停，后续任务留在通道中，直到 releaseLane
+ * 后再按原顺序继续执行，不占用工作线程等待。
+ */
 class ThreadPool{
 private:
-    queue<Task>tasks;
-    pthread_mutex_t mutex;
+    struct Lane{
+        queue<Task>tasks;
+        pthread_mutex_t mutex;
+        bool scheduled;          // 已在某个就绪队列中或正被执行
+        bool held;               // 已挂起，当前任务结束后不再执行后续任务
+        bool parked;             // 因挂起而暂停（scheduled 保持为true），等待 releaseLane 重新调度
+        atomic<int>depth;        // 积压任务数
+        Lane():scheduled(false),held(false),parked(false),depth(0){pthread_mutex_init(&mutex,NULL);}
+        ~Lane(){pthread_mutex_destroy(&mutex);}
+    };
+    struct ReadyQueue{
+        deque<int>lanes;         // 就绪通道编号
+        pthread_mutex_t mutex;
+        ReadyQueue(){pthread_mutex_init(&mutex,NULL);}
+        ~ReadyQueue(){pthread_mutex_destroy(&mutex);}
+    };
+    struct WorkerArg{
+        ThreadPool*pool;
+        int id;
+    };
+    Lane lanes[POOL_LANES];
+    vector<ReadyQueue*>ready;    // 每个工作线程一个就绪队列
+    vector<WorkerArg>args;
+    atomic<int>ready_count;      // 所有就绪队列中的通道总数
+    atomic<int>idle_workers;     // 正在等待的工作线程数
+    pthread_mutex_t mutex;       // 仅用于空闲线程的睡眠/唤醒
     pthread_cond_t cond;
     vector<pthread_t>workers;
-    queue<MyDb*>db_pool;
     bool stop;
-    pthread_mutex_t db_mutex;
     static void* worker(void*arg);
+    void schedule(int lane_id,int worker_id);//把通道放入工作线程的就绪队列
+    bool takeLane(int worker_id,int&lane_id);//取自己的就绪通道，没有则窃取
+    void runLane(int worker_id,int lane_id);
 public:
     ThreadPool(int thread_num);
     ~ThreadPool();
     void addTask(Task task);
-    MyDb* get_conn();
-    void en_conn(MyDb* conn);
+    void holdLane(int fd);//挂起fd所在通道（只能在该通道正在执行的任务中调用）
+    void releaseLane(int fd);//解除挂起，通道中积压的任务继续按序执行
+    int laneDepth(int fd);//某个连接所在通道的积压任务数
+    long long queuedTasks();//所有通道的积压任务总数
+    int idleWorkers(){return idle_workers.load();}
+    string stats();
 };
 
-MyDb* ThreadPool::get_conn(){
-    pthread_mutex_lock(&db_mutex);
-    
-    if(db_pool.empty()){
-        pthread_mutex_unlock(&db_mutex);
-        cerr << "Error: No database connection available in pool!" << endl;
-        return nullptr;
-    }
-    
-    MyDb* conn = db_pool.front();
-    db_pool.pop();
-    pthread_mutex_unlock(&db_mutex);
-    
-    if(conn == nullptr){
-        cerr << "Error: Retrieved null connection from pool!" << endl;
-        return nullptr;
-    }
-    return conn;
-}
-void ThreadPool::en_conn(MyDb*conn){
-    pthread_mutex_lock(&db_mutex);
-    db_pool.push(conn);
-    pthread_mutex_unlock(&db_mutex);
-}
-
 ThreadPool::ThreadPool(int thread_num){
     stop=false;
+    ready_count=0;
+    idle_workers=0;
     pthread_mutex_init(&mutex,NULL);
     pthread_cond_init(&cond,NULL);
-    pthread_mutex_init(&db_mutex,NULL);
     
-    // 第一步：创建并初始化所有数据库连接
-    // 确保所有连接都准备就绪后再创建工作线程
+    // 数据库连接由 DbPool 管理，工作线程只在需要时借用
+    args.resize(thread_num);
     for(int i=0; i<thread_num; i++){
-        MyDb* conn = new MyDb();
-        bool init_success = conn->initDB(HOST, USER, PWD, DB_NAME, 3306);
-        if(!init_success){
-            cerr << "Failed to init database connection " << i << endl;
-            delete conn;
-            exit(1);
-        }
-        db_pool.push(conn);
+        ready.push_back(new ReadyQueue());
+        args[i].pool=this;
+        args[i].id=i;
     }
-    
-    // 第二步：所有数据库连接初始化完成后，创建工作线程
     pthread_t t_id;
     for(int i=0; i<thread_num; i++){
-        pthread_create(&t_id, NULL, worker, this);
+        pthread_create(&t_id, NULL, worker, &args[i]);
         workers.push_back(t_id);
     }
 }
+void ThreadPool::schedule(int lane_id,int worker_id){
+    ReadyQueue*rq=ready[worker_id];
+    pthread_mutex_lock(&rq->mutex);
+    rq->lanes.push_back(lane_id);
+    pthread_mutex_unlock(&rq->mutex);
+    ready_count++;
+    // 与worker中"idle_workers++后检查ready_count"配对，不会丢失唤醒
+    if(idle_workers.load()>0){
+        pthread_mutex_lock(&mutex);
+        pthread_cond_signal(&cond);
+        pthread_mutex_unlock(&mutex);
+    }
+}
+bool ThreadPool::takeLane(int worker_id,int&lane_id){
+    int n=ready.size();
+    for(int k=0;k<n;k++){
+        int victim=(worker_id+k)%n;
+        ReadyQueue*rq=ready[victim];
+        pthread_mutex_lock(&rq->mutex);
+        if(!rq->lanes.empty()){
+            // 自己的队列从头部取，窃取时从尾部取，减少与主线程的冲突
+            if(k==0){
+                lane_id=rq->lanes.front();
+                rq->lanes.pop_front();
+            }
+            else{
+                lane_id=rq->lanes.back();
+                rq->lanes.pop_back();
+            }
+            pthread_mutex_unlock(&rq->mutex);
+            ready_count--;
+            return true;
+        }
+        pthread_mutex_unlock(&rq->mutex);
+    }
+    return false;
+}
+void ThreadPool::runLane(int worker_id,int lane_id){
+    Lane&lane=lanes[lane_id];
+    Task task;
+    for(int i=0;i<POOL_LANE_BATCH;i++){
+        pthread_mutex_lock(&lane.mutex);
+        if(lane.held){
+            // 挂起中：scheduled 保持为true，新任务不会让它重新进入就绪队列，由 releaseLane 调度
+            lane.parked=true;
+            pthread_mutex_unlock(&lane.mutex);
+            return;
+        }
+        if(lane.tasks.empty()){
+            lane.scheduled=false;
+            pthread_mutex_unlock(&lane.mutex);
+            return;
+        }
+        task=std::move(lane.tasks.front());
+        lane.tasks.pop();
+        pthread_mutex_unlock(&lane.mutex);
+        if(task.trace){
+            task.trace->stamp(TRACE_DEQUEUE);
+        }
+        {
+            TraceScope scope(task.trace);
+            if(task.job){
+                task.job();
+            }
+            else{
+                process_clint_data(task);
+            }
+        }
+        if(task.trace){
+            task.trace->stamp(TRACE_DONE);
+            task.trace.reset();
+        }
+        lane.depth--;
+    }
+    // 通道里还有任务：放回自己队列的尾部，让其它通道也有机会执行
+    pthread_mutex_lock(&lane.mutex);
+    if(lane.held){
+        lane.parked=true;
+        pthread_mutex_unlock(&lane.mutex);
+        return;
+    }
+    bool more=!lane.tasks.empty();
+    if(!more){
+        lane.scheduled=false;
+    }
+    pthread_mutex_unlock(&lane.mutex);
+    if(more){
+        schedule(lane_id,worker_id);
+    }
+}
 void* ThreadPool::worker(void*arg){
-    ThreadPool*pool=(ThreadPool*)arg;
+    WorkerArg*wa=(WorkerArg*)arg;
+    ThreadPool*pool=wa->pool;
+    int lane_id;
     while(1){
-        Task task;
+        if(pool->takeLane(wa->id,lane_id)){
+            pool->runLane(wa->id,lane_id);
+            continue;
+        }
         pthread_mutex_lock(&pool->mutex);
-        while(!pool->stop&&pool->tasks.empty()){
+        pool->idle_workers++;
+        while(!pool->stop&&pool->ready_count.load()==0){
             pthread_cond_wait(&pool->cond,&pool->mutex);
         }
-        if(pool->stop&&pool->tasks.empty()){
-            pthread_mutex_unlock(&pool->mutex);
+        pool->idle_workers--;
+        bool exiting=pool->stop&&pool->ready_count.load()==0;
+        pthread_mutex_unlock(&pool->mutex);
+        if(exiting){
             break;
         }
-        task=pool->tasks.front();
-        pool->tasks.pop();
-        pthread_mutex_unlock(&pool->mutex);
-        process_clint_data(task);
     }
     return NULL;
 }
 void ThreadPool::addTask(Task task){
-    pthread_mutex_lock(&mutex);
-    tasks.push(task);
-    pthread_mutex_unlock(&mutex);
-    pthread_cond_signal(&cond);
+    int lane_id=(unsigned int)task.fd%POOL_LANES;
+    Lane&lane=lanes[lane_id];
+    if(task.trace){
+        task.trace->stamp(TRACE_ENQUEUE);
+    }
+    pthread_mutex_lock(&lane.mutex);
+    lane.tasks.push(std::move(task));
+    lane.depth++;
+    bool need_schedule=!lane.scheduled;
+    lane.scheduled=true;
+    pthread_mutex_unlock(&lane.mutex);
+    if(need_schedule){
+        schedule(lane_id,lane_id%ready.size());
+    }
+}
+void ThreadPool::holdLane(int fd){
+    Lane&lane=lanes[(unsigned int)fd%POOL_LANES];
+    pthread_mutex_lock(&lane.mutex);
+    lane.held=true;
+    pthread_mutex_unlock(&lane.mutex);
+}
+void ThreadPool::releaseLane(int fd){
+    int lane_id=(unsigned int)fd%POOL_LANES;
+    Lane&lane=lanes[lane_id];
+    pthread_mutex_lock(&lane.mutex);
+    lane.held=false;
+    // 挂起的任务还没结束时 runLane 会自己继续；已暂停的通道在这里重新调度
+    bool resume=lane.parked&&!lane.tasks.empty();
+    if(lane.parked&&lane.tasks.empty()){
+        lane.scheduled=false;
+    }
+    lane.parked=false;
+    pthread_mutex_unlock(&lane.mutex);
+    if(resume){
+        schedule(lane_id,lane_id%ready.size());
+    }
+}
+int ThreadPool::laneDepth(int fd){
+    return lanes[(unsigned int)fd%POOL_LANES].depth.load();
+}
+long long ThreadPool::queuedTasks(){
+    long long queued=0;
+    for(int i=0;i<POOL_LANES;i++){
+        queued+=lanes[i].depth.load();
+    }
+    return queued;
+}
+string ThreadPool::stats(){
+    int busy=0,max_depth=0;
+    long long queued=0;
+    for(int i=0;i<POOL_LANES;i++){
+        int d=lanes[i].depth.load();
+        if(d>0)busy++;
+        if(d>max_depth)max_depth=d;
+        queued+=d;
+    }
+    return "busy_lanes="+to_string(busy)+", queued_tasks="+to_string(queued)+
+           ", max_lane_depth="+to_string(max_depth)+", ready_lanes="+to_string(ready_count.load())+
+           ", idle_workers="+to_string(idle_workers.load());
 }
 
 ThreadPool::~ThreadPool(){
@@ -168,10 +421,8 @@ ThreadPool::~ThreadPool(){
     for(auto&t_id:workers){
         pthread_join(t_id,NULL);
     }
-    while(!db_pool.empty()){
-        MyDb*conn=db_pool.front();
-        db_pool.pop();
-        delete conn;
+    for(ReadyQueue*rq:ready){
+        delete rq;
     }
     pthread_mutex_destroy(&mutex);
     pthread_cond_destroy(&cond);
@@ -179,36 +430,76 @@ ThreadPool::~ThreadPool(){
 
 
 
-// 连接守卫类 - 自动管理连接的获取和释放（RAII模式）
+// 连接守卫类 - 按需借用连接，析构时自动归还（RAII模式）
 class DbConnectionGuard {
 private:
+    DbPool* pool;
     MyDb* conn;
-    ThreadPool* pool;
-    bool owned;
+    bool tried;  // 已尝试过借用，失败后本次任务不再重复等待
 public:
-    DbConnectionGuard(ThreadPool* p) : pool(p), owned(true) {
-        conn = pool->get_conn();
-        if(!conn){
-            cerr << "Failed to acquire database connection" << endl;
-            owned = false;
-        }
-    }
+    DbConnectionGuard(DbPool* p) : pool(p), conn(nullptr), tried(false) {}
     
     ~DbConnectionGuard() {
-        if(owned && conn != nullptr){
-            pool->en_conn(conn);
+        if(conn != nullptr){
+            pool->release(conn);
         }
     }
     
-    MyDb* get() const {
+    // 第一次调用时才从连接池借用（可能等待，超时返回nullptr）
+    MyDb* get() {
+        if(!tried){
+            tried = true;
+            conn = pool->acquire();
+        }
         return conn;
     }
     
     bool is_valid() const {
         return conn != nullptr;
     }
+    
+    // 供 UserCache 在缓存未命中时才借用连接
+    UserCache::DbSource source() {
+        return [this] { return get(); };
+    }
 };
 
+// 命令处理函数，按 opcode 放在跳转表中
+typedef void(*CommandHandler)(Request&req,DbConnectionGuard&guard);
 
-
-
+/**
+ * @brief 当前线程正在回复的请求（RAII）
+ *
+ * v2 回复需要带上请求id：en_resp 发往 fd 的帧使用作用域内的 request_id，
+ * 发给其它连接的推送帧使用0。异步回调（数据库、认证）在回调里重新建立作用域，
+ * 并带上提交时连接的代数（gen）：回调完成前连接已关闭、fd 被新连接复用时，
+ * 这些回复在投递和出队时都会被丢弃，不会发给新连接。
+ */
+class ReplyScope{
+private:
+    int prev_fd;
+    uint32_t prev_id;
+    long long prev_gen;
+public:
+    static thread_local int cur_fd;
+    static thread_local uint32_t cur_id;
+    static thread_local long long cur_gen;
+    ReplyScope(int fd,uint32_t request_id,long long gen=-1):prev_fd(cur_fd),prev_id(cur_id),prev_gen(cur_gen){
+        cur_fd=fd;
+        cur_id=request_id;
+        cur_gen=gen;
+    }
+    ~ReplyScope(){
+        cur_fd=prev_fd;
+        cur_id=prev_id;
+        cur_gen=prev_gen;
+    }
+    // 发往 fd 的回复应携带的请求id
+    static uint32_t requestFor(int fd){
+        return fd==cur_fd?cur_id:0;
+    }
+    // 发往 fd 的回复要求的连接代数，-1表示不检查
+    static long long genFor(int fd){
+        return fd==cur_fd?cur_gen:-1;
+    }
+};
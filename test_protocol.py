@@ -6,14 +6,35 @@
 
 import struct
 import sys
+import zlib
 
-def encode_message(message):
-    """使用长度前缀协议编码消息"""
+MAX_MESSAGE_SIZE = 4096         # 单帧数据上限
+CONTINUATION_FLAG = 0x80000000  # 长度字段最高位：后面还有同一条消息的分片
+COMPRESSED_FLAG = 0x40000000    # 长度字段次高位：消息经过 deflate 压缩
+LENGTH_MASK = 0x3fffffff
+MAX_ASSEMBLED_SIZE = 256 * 1024
+
+def encode_message(message, flags=0):
+    """使用长度前缀协议编码消息（超过单帧上限时拆成续帧）"""
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    frames = []
+    for pos in range(0, max(len(message), 1), MAX_MESSAGE_SIZE):
+        chunk = message[pos:pos + MAX_MESSAGE_SIZE]
+        more = CONTINUATION_FLAG if pos + MAX_MESSAGE_SIZE < len(message) else 0
+        frames.append(struct.pack('!I', len(chunk) | more | flags) + chunk)
+    return b''.join(frames)
+
+def new_deflater():
+    """与服务器相同参数的压缩流（raw deflate，窗口4KB）"""
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -12, 5)
+
+def encode_compressed(deflater, message):
+    """用连接的压缩流压缩一条消息并编码（Z_SYNC_FLUSH，不重置上下文）"""
     if isinstance(message, str):
         message = message.encode('utf-8')
-    length = len(message)
-    header = struct.pack('!I', length)
-    return header + message
+    packed = deflater.compress(message) + deflater.flush(zlib.Z_SYNC_FLUSH)
+    return encode_message(packed, COMPRESSED_FLAG)
 
 def decode_message(buffer):
     """从缓冲区解析消息"""
@@ -28,6 +49,74 @@ def decode_message(buffer):
     message = buffer[4:4+length].decode('utf-8', errors='ignore')
     return message, 4 + length
 
+# ========== 协议 v2 ==========
+PROTOCOL_V2 = 2
+V2_HEADER = struct.Struct('!BBHI')  # version, opcode, flags, request_id
+OPCODES = ["", "hello", "sign_up", "sign_in", "resume", "show_online_user", "single_chat",
+           "multi_chat", "broadcast_chat", "show_history", "heartbeat", "q", "chat_unread", "session"]
+
+def encode_v2(opcode, request_id, fields, flags=0):
+    """编码 v2 帧（含4字节长度前缀）"""
+    body = bytearray(V2_HEADER.pack(PROTOCOL_V2, opcode, flags, request_id))
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode('utf-8')
+        body += struct.pack('!H', len(field)) + field
+    return encode_message(bytes(body))
+
+def decode_v2(body):
+    """解析 v2 帧体，字段越界时抛出 ValueError"""
+    version, opcode, flags, request_id = V2_HEADER.unpack_from(body)
+    if version != PROTOCOL_V2:
+        raise ValueError(f"unexpected version {version}")
+    fields = []
+    pos = V2_HEADER.size
+    while pos < len(body):
+        if len(body) - pos < 2:
+            raise ValueError("truncated field length")
+        (length,) = struct.unpack_from('!H', body, pos)
+        pos += 2
+        if pos + length > len(body):
+            raise ValueError("field overruns frame")
+        fields.append(body[pos:pos + length])
+        pos += length
+    return opcode, flags, request_id, fields
+
+def decode_frame_body(buffer):
+    """取出一帧的帧体（bytes），不完整时返回 (None, -1)"""
+    if len(buffer) < 4:
+        return None, -1
+    length = struct.unpack('!I', buffer[:4])[0]
+    if len(buffer) < 4 + length:
+        return None, -1
+    return buffer[4:4+length], 4 + length
+
+def decode_assembled(buffer, inflater=None):
+    """从缓冲区解析一条完整的（可能由多个续帧组成的）消息，返回 (帧体, 消费字节数)"""
+    body = b''
+    pos = 0
+    compressed = False
+    while True:
+        if len(buffer) - pos < 4:
+            return None, -1
+        field = struct.unpack_from('!I', buffer, pos)[0]
+        length = field & LENGTH_MASK
+        compressed |= bool(field & COMPRESSED_FLAG)
+        if length == 0 or length > MAX_MESSAGE_SIZE:
+            raise ValueError(f"invalid frame length {length}")
+        if len(buffer) - pos < 4 + length:
+            return None, -1
+        body += buffer[pos + 4:pos + 4 + length]
+        pos += 4 + length
+        if len(body) > MAX_ASSEMBLED_SIZE:
+            raise ValueError("assembled message too large")
+        if not field & CONTINUATION_FLAG:
+            if compressed:
+                if inflater is None:
+                    raise ValueError("compressed frame without negotiated compression")
+                body = inflater.decompress(body)
+            return body, pos
+
 def test_basic_encoding():
     """测试基本的编码解码"""
     print("=" * 50)
@@ -164,6 +253,165 @@ def test_incomplete_messages():
     assert consumed == len(complete), "消费字节数不正确"
     print(f"✓ 完整数据成功解析: {msg_out}\n")
 
+def test_v2_header_layout():
+    """测试 v2 帧头布局（大端序）"""
+    print("=" * 50)
+    print("测试6: v2 帧头布局")
+    print("=" * 50)
+    
+    frame = encode_v2(OPCODES.index("sign_in"), 0x01020304, ["alice", "pw"])
+    body, consumed = decode_frame_body(frame)
+    assert consumed == len(frame)
+    assert body[0] == PROTOCOL_V2, "版本字节错误"
+    assert body[1] == OPCODES.index("sign_in"), "opcode 错误"
+    assert body[2:4] == b'\x00\x00', "flags 应为0"
+    assert body[4:8] == b'\x01\x02\x03\x04', "request_id 应为大端序"
+    assert body[8:10] == b'\x00\x05' and body[10:15] == b'alice', "字段长度前缀错误"
+    print("✓ v2 帧头布局测试通过\n")
+
+def test_v2_roundtrip():
+    """测试 v2 编解码往返，字段中的 '|' 和换行原样保留"""
+    print("=" * 50)
+    print("测试7: v2 编解码往返")
+    print("=" * 50)
+    
+    fields = ["bob", "a|b|c\n", "", "中文内容"]
+    frame = encode_v2(OPCODES.index("single_chat"), 42, fields)
+    body, _ = decode_frame_body(frame)
+    opcode, flags, request_id, out = decode_v2(body)
+    assert opcode == OPCODES.index("single_chat")
+    assert flags == 0 and request_id == 42
+    assert [f.decode('utf-8') for f in out] == fields, f"字段不匹配: {out}"
+    print(f"✓ 解析出 {len(out)} 个字段: {out}\n")
+
+def test_v2_pipelined_with_v1():
+    """测试 v1/v2 帧混在同一个缓冲区中（按首字节区分），多个请求连续发送"""
+    print("=" * 50)
+    print("测试8: v1/v2 混合与流水线")
+    print("=" * 50)
+    
+    buffer = (encode_message("hello|2") +
+              encode_v2(OPCODES.index("heartbeat"), 1, []) +
+              encode_v2(OPCODES.index("show_history"), 2, ["0", "20"]) +
+              encode_v2(OPCODES.index("show_online_user"), 3, ["", "", "50"]))
+    # 拆成小块逐步接收
+    received = []
+    pending = b''
+    for i in range(0, len(buffer), 7):
+        pending += buffer[i:i + 7]
+        while True:
+            body, consumed = decode_frame_body(pending)
+            if consumed == -1:
+                break
+            pending = pending[consumed:]
+            if body[0] == PROTOCOL_V2:
+                opcode, _, request_id, _ = decode_v2(body)
+                received.append((OPCODES[opcode], request_id))
+            else:
+                received.append((body.decode('utf-8'), 0))
+    assert received == [("hello|2", 0), ("heartbeat", 1), ("show_history", 2), ("show_online_user", 3)], received
+    print(f"✓ 按顺序解析出: {received}\n")
+
+def test_v2_malformed():
+    """测试 v2 字段长度越界时拒绝解析"""
+    print("=" * 50)
+    print("测试9: v2 非法帧")
+    print("=" * 50)
+    
+    body, _ = decode_frame_body(encode_v2(OPCODES.index("sign_in"), 7, ["alice", "pw"]))
+    for bad in (body[:-1], body + b'\x00', body[:8] + b'\xff\xff' + body[10:]):
+        try:
+            decode_v2(bad)
+        except ValueError as e:
+            print(f"✓ 拒绝非法帧: {e}")
+        else:
+            raise AssertionError("非法帧应该解析失败")
+    print("✓ 非法帧测试通过\n")
+
+def test_continuation_frames():
+    """测试超过单帧上限的消息拆成续帧"""
+    print("=" * 50)
+    print("测试10: 续帧编码")
+    print("=" * 50)
+    
+    small = encode_message("heartbeat")
+    assert struct.unpack('!I', small[:4])[0] == len("heartbeat"), "短消息编码不应改变"
+    
+    text = "single_chat|bob|" + "长" * 5000
+    encoded = encode_message(text)
+    payload = text.encode('utf-8')
+    frames = []
+    pos = 0
+    while pos < len(encoded):
+        field = struct.unpack_from('!I', encoded, pos)[0]
+        frames.append((field & ~CONTINUATION_FLAG, bool(field & CONTINUATION_FLAG)))
+        pos += 4 + (field & ~CONTINUATION_FLAG)
+    print(f"{len(payload)} 字节拆成 {len(frames)} 帧: {frames}")
+    assert all(length <= MAX_MESSAGE_SIZE for length, _ in frames), "分片超过单帧上限"
+    assert [more for _, more in frames] == [True] * (len(frames) - 1) + [False], "续帧标志错误"
+    assert sum(length for length, _ in frames) == len(payload)
+    
+    body, consumed = decode_assembled(encoded)
+    assert body == payload and consumed == len(encoded), "续帧拼接结果不匹配"
+    print("✓ 续帧编码测试通过\n")
+
+def test_continuation_fragmented():
+    """测试续帧分多次到达、后面紧跟普通消息"""
+    print("=" * 50)
+    print("测试11: 续帧拆包")
+    print("=" * 50)
+    
+    big = encode_v2(OPCODES.index("single_chat"), 9, ["bob", "x" * 10000])
+    stream = big + encode_message("heartbeat")
+    buffer = b''
+    received = []
+    for i in range(0, len(stream), 1000):
+        buffer += stream[i:i + 1000]
+        while True:
+            body, consumed = decode_assembled(buffer)
+            if consumed == -1:
+                break
+            buffer = buffer[consumed:]
+            received.append(body)
+    assert len(received) == 2 and buffer == b'', "应该解析出两条消息"
+    opcode, _, request_id, fields = decode_v2(received[0])
+    assert (OPCODES[opcode], request_id, fields[0], len(fields[1])) == ("single_chat", 9, b"bob", 10000)
+    assert received[1] == b"heartbeat"
+    print("✓ 续帧拆包测试通过\n")
+
+def test_compressed_frames():
+    """测试压缩帧：压缩流在消息之间保留上下文，与普通帧混合到达"""
+    print("=" * 50)
+    print("测试12: 压缩帧")
+    print("=" * 50)
+    
+    rows = "\n".join(f"{i}  alice  bob  2026-10-18 12:00:{i % 60:02d}  single  你好" for i in range(300))
+    history = f"show_history|2|{rows}"
+    deflater = new_deflater()
+    first = encode_compressed(deflater, history)
+    second = encode_compressed(deflater, history)
+    print(f"原始 {len(history.encode('utf-8'))} 字节，第一次压缩后 {len(first)} 字节，第二次 {len(second)} 字节")
+    assert len(first) < len(history.encode('utf-8')) // 4, "压缩率过低"
+    assert struct.unpack('!I', first[:4])[0] & COMPRESSED_FLAG, "缺少压缩标志"
+    
+    stream = first + encode_message("heartbeat|1|ok") + second
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    received = []
+    while stream:
+        body, consumed = decode_assembled(stream, inflater)
+        assert consumed > 0
+        received.append(body.decode('utf-8'))
+        stream = stream[consumed:]
+    assert received == [history, "heartbeat|1|ok", history], "压缩帧解码结果不匹配"
+    
+    try:
+        decode_assembled(first)
+    except ValueError as e:
+        print(f"✓ 未协商压缩时拒绝压缩帧: {e}")
+    else:
+        raise AssertionError("未协商压缩时应该拒绝压缩帧")
+    print("✓ 压缩帧测试通过\n")
+
 if __name__ == "__main__":
     try:
         test_basic_encoding()
@@ -171,6 +419,13 @@ if __name__ == "__main__":
         test_fragmented_packets()
         test_multiple_mixed()
         test_incomplete_messages()
+        test_v2_header_layout()
+        test_v2_roundtrip()
+        test_v2_pipelined_with_v1()
+        test_v2_malformed()
+        test_continuation_frames()
+        test_continuation_fragmented()
+        test_compressed_frames()
         
         print("=" * 50)
         print("所有测试通过！✓")
@@ -10,9 +10,16 @@ import threading
 import time
 import sys
 import struct
+import zlib
+from concurrent.futures import Future
 from datetime import datetime
 
 # ========== 协议编解码函数 ==========
+MAX_MESSAGE_SIZE = 4096         # 单帧数据上限
+CONTINUATION_FLAG = 0x80000000  # 长度字段最高位：后面还有同一条消息的分片
+COMPRESSED_FLAG = 0x40000000    # 长度字段次高位：消息经过 deflate 压缩（协商了压缩才会出现）
+LENGTH_MASK = 0x3fffffff
+
 def encode_message(message):
     """
     使用长度前缀协议编码消息
@@ -20,10 +27,14 @@ def encode_message(message):
     """
     if isinstance(message, str):
         message = message.encode('utf-8')
-    length = len(message)
-    # 使用big-endian格式（网络字节序）编码长度
-    header = struct.pack('!I', length)  # !I: big-endian unsigned int
-    return header + message
+    # 超过单帧上限的消息拆成续帧：除最后一帧外长度字段最高位置1
+    frames = []
+    for pos in range(0, max(len(message), 1), MAX_MESSAGE_SIZE):
+        chunk = message[pos:pos + MAX_MESSAGE_SIZE]
+        more = CONTINUATION_FLAG if pos + MAX_MESSAGE_SIZE < len(message) else 0
+        # 使用big-endian格式（网络字节序）编码长度
+        frames.append(struct.pack('!I', len(chunk) | more) + chunk)  # !I: big-endian unsigned int
+    return b''.join(frames)
 
 def decode_message(buffer):
     """
@@ -45,10 +56,91 @@ def decode_message(buffer):
     message = buffer[4:4+length].decode('utf-8', errors='ignore')
     return message, 4 + length
 
+def decode_frame(buffer, inflater=None):
+    """从缓冲区解析一条消息（拼接续帧），v2 帧转成与 v1 相同的 "cmd|code|data" 文本
+    inflater: 连接的解压流（zlib.decompressobj），压缩消息按到达顺序用它解压
+    返回: (消息, 消费的字节数, 请求id)，v1 文本和服务器主动推送的消息请求id为0
+    """
+    body = b''
+    pos = 0
+    compressed = False
+    while True:
+        if len(buffer) - pos < 4:
+            return None, -1, 0
+        field = struct.unpack_from('!I', buffer, pos)[0]
+        length = field & LENGTH_MASK
+        if len(buffer) - pos < 4 + length:
+            return None, -1, 0
+        body += buffer[pos + 4:pos + 4 + length]
+        compressed |= bool(field & COMPRESSED_FLAG)
+        pos += 4 + length
+        if not field & CONTINUATION_FLAG:
+            break
+    if compressed:
+        if inflater is None:
+            raise ValueError("compressed frame without negotiated compression")
+        body = inflater.decompress(body)
+    if body[:1] == bytes([PROTOCOL_V2]):
+        opcode, _, request_id, fields = decode_v2(body)
+        return v2_to_text(opcode, fields), pos, request_id
+    return body.decode('utf-8', errors='ignore'), pos, 0
+
+# ========== 协议 v2（二进制帧体） ==========
+# 帧体: [version(1)=2][opcode(1)][flags(2)][request_id(4)] + N × [字段长度(2)][字段]
+# 连接后发送 v1 文本 "hello|2"，收到 "hello|1|2" 后服务器改发 v2 帧
+PROTOCOL_V2 = 2
+V2_HEADER = struct.Struct('!BBHI')
+OPCODES = ["", "hello", "sign_up", "sign_in", "resume", "show_online_user", "single_chat",
+           "multi_chat", "broadcast_chat", "show_history", "heartbeat", "q", "chat_unread", "session"]
+OP_QUIT = OPCODES.index("q")
+# 这些命令的回复分多帧返回，code 2 表示后面还有帧（其它命令的 code 2 只是状态码）
+STREAMED_COMMANDS = ("show_online_user", "show_history")
+
+ADMIN_SOCKET_PATH = "/tmp/chatroom_admin.sock"  # 服务器指标导出的本地套接字（需与服务器同机）
+
+def encode_v2(opcode, request_id, fields, flags=0):
+    """编码一个 v2 帧（含4字节长度前缀）"""
+    body = bytearray(V2_HEADER.pack(PROTOCOL_V2, opcode, flags, request_id))
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode('utf-8')
+        body += struct.pack('!H', len(field)) + field
+    return encode_message(bytes(body))
+
+def decode_v2(body):
+    """解析 v2 帧体，返回 (opcode, flags, request_id, [字段bytes])"""
+    version, opcode, flags, request_id = V2_HEADER.unpack_from(body)
+    if version != PROTOCOL_V2:
+        raise ValueError(f"unexpected version {version}")
+    fields = []
+    pos = V2_HEADER.size
+    while pos < len(body):
+        (length,) = struct.unpack_from('!H', body, pos)
+        pos += 2
+        if pos + length > len(body):
+            raise ValueError("field overruns frame")
+        fields.append(body[pos:pos + length])
+        pos += length
+    return opcode, flags, request_id, fields
+
+def text_to_v2(message, request_id):
+    """把 v1 文本命令 "cmd|arg1|arg2..." 转成 v2 请求帧"""
+    parts = message.split('|')
+    name = parts[0].rstrip('\r\n')
+    opcode = OP_QUIT if name in ("q", "Q") else OPCODES.index(name)
+    return encode_v2(opcode, request_id, parts[1:])
+
+def v2_to_text(opcode, fields):
+    """把 v2 响应转回 "cmd|code|data" 文本，供 _handle_response 统一处理"""
+    if opcode == OP_QUIT:
+        return "bye\n"
+    name = OPCODES[opcode] if opcode < len(OPCODES) else ""
+    return "|".join([name] + [f.decode('utf-8', errors='ignore') for f in fields])
+
 class ChatroomClient:
     """模拟聊天室客户端"""
     
-    def __init__(self, username, server_host='127.0.0.1', server_port=8080):
+    def __init__(self, username, server_host='127.0.0.1', server_port=8080, protocol=PROTOCOL_V2, compress=False):
         self.username = username
         self.server_host = server_host
         self.server_port = server_port
@@ -57,6 +149,15 @@ class ChatroomClient:
         self.is_running = False
         self.received_messages = []
         self.heartbeat_thread_started = False
+        self.session_token = None  # 登录后服务器下发的会话令牌
+        self.wanted_protocol = protocol  # 希望使用的协议版本
+        self.protocol = 1  # 协商完成前使用 v1 文本
+        self.wanted_compress = compress  # 是否请求服务器压缩大的响应
+        self.compressed = False  # 服务器是否同意压缩
+        self.next_request_id = 1
+        self.send_lock = threading.Lock()
+        self.pending = {}  # 请求id -> (Future, 已收到的回复帧)
+        self.pending_lock = threading.Lock()
         
     def connect(self):
         """连接到服务器"""
@@ -69,6 +170,8 @@ class ChatroomClient:
             # 启动接收线程
             recv_thread = threading.Thread(target=self._recv_loop, daemon=True)
             recv_thread.start()
+            if self.wanted_protocol >= PROTOCOL_V2:
+                self._negotiate()
             # 启动心跳线程
             if not self.heartbeat_thread_started:
                 heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
@@ -79,6 +182,15 @@ class ChatroomClient:
             print(f"[{self.username}] ✗ 连接失败: {e}")
             return False
     
+    def _negotiate(self, timeout=1):
+        """协商 v2 协议（和压缩）；旧服务器不回复 hello，超时后继续使用 v1"""
+        self.protocol = 1
+        self.compressed = False
+        self.send_message(f"hello|{self.wanted_protocol}" + ("|deflate" if self.wanted_compress else ""))
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.protocol == 1 and self.is_connected:
+            time.sleep(0.01)
+    
     def disconnect(self):
         """断开连接"""
         try:
@@ -89,15 +201,71 @@ class ChatroomClient:
         except Exception as e:
             print(f"[{self.username}] ✗ 断开连接失败: {e}")
     
+    def request(self, message):
+        """流水线发送一条请求，返回 Future，结果为该请求的全部回复（"cmd|code|data" 列表）
+        
+        需要 v2：回复帧带回请求id，同一连接上可以同时有多个请求在途，
+        不必像 send_message + wait_for_response 那样一问一答。
+        """
+        future = Future()
+        request_id = None
+        if self.protocol < PROTOCOL_V2:
+            future.set_exception(RuntimeError("request() requires protocol v2"))
+            return future
+        try:
+            with self.send_lock:
+                request_id = self.next_request_id
+                self.next_request_id += 1
+                # 先登记再发送，回复可能在 sendall 返回前就到达
+                with self.pending_lock:
+                    self.pending[request_id] = (future, [])
+                self.socket.sendall(text_to_v2(message, request_id))
+        except Exception as e:
+            if request_id is not None:
+                with self.pending_lock:
+                    self.pending.pop(request_id, None)
+            self.is_connected = False
+            if not future.done():
+                future.set_exception(e)
+        return future
+    
+    def _complete(self, request_id, message):
+        """把回复交给对应的 Future；分帧返回的命令收到最后一帧（code 不为2）时才完成"""
+        if request_id == 0:
+            return  # v1 回复或服务器推送
+        with self.pending_lock:
+            entry = self.pending.get(request_id)
+            if entry is None:
+                return
+            future, frames = entry
+            frames.append(message)
+            parts = message.split('|', 2)
+            if parts[0] in STREAMED_COMMANDS and len(parts) > 1 and parts[1] == "2":
+                return
+            del self.pending[request_id]
+        future.set_result(frames)
+    
+    def _fail_pending(self, error):
+        """连接断开时让所有在途请求失败"""
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        for future, _ in pending.values():
+            future.set_exception(error)
+    
     def send_message(self, message):
         """发送消息到服务器（使用协议编码）"""
         try:
             if not self.is_connected:
                 print(f"[{self.username}] ✗ 未连接到服务器")
                 return False
-            # 使用协议编码消息
-            encoded = encode_message(message)
-            self.socket.sendall(encoded)
+            # 协商了 v2 时发送二进制帧，每个请求带一个递增的请求id
+            with self.send_lock:
+                if self.protocol >= PROTOCOL_V2:
+                    encoded = text_to_v2(message, self.next_request_id)
+                    self.next_request_id += 1
+                else:
+                    encoded = encode_message(message)
+                self.socket.sendall(encoded)
             return True
         except Exception as e:
             print(f"[{self.username}] ✗ 发送失败: {e}")
@@ -107,6 +275,7 @@ class ChatroomClient:
     def _recv_loop(self):
         """接收消息的循环（支持协议解码和缓冲）"""
         recv_buffer = b''  # 接收缓冲区用于处理粘包/拆包
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)  # 服务器压缩流在连接内保留上下文
         
         while self.is_connected:
             try:
@@ -121,7 +290,7 @@ class ChatroomClient:
                 
                 # 循环提取完整的消息
                 while len(recv_buffer) > 0:
-                    message, consumed = decode_message(recv_buffer)
+                    message, consumed, request_id = decode_frame(recv_buffer, inflater)
                     if consumed == -1:
                         # 消息不完整，等待更多数据
                         break
@@ -132,6 +301,7 @@ class ChatroomClient:
                         # 成功解析一个完整的消息
                         self.received_messages.append(message)
                         self._handle_response(message)
+                        self._complete(request_id, message)
                         # 从缓冲区中移除已处理的数据
                         recv_buffer = recv_buffer[consumed:]
                 
@@ -142,6 +312,7 @@ class ChatroomClient:
                     print(f"[{self.username}] ✗ 接收错误: {e}")
                 self.is_connected = False
                 break
+        self._fail_pending(ConnectionError(f"[{self.username}] 连接已断开"))
     
     def _heartbeat_loop(self):
         """定期发送心跳消息以保持连接活跃
@@ -172,7 +343,14 @@ class ChatroomClient:
         status = parts[1]
         data = parts[2] if len(parts) > 2 else ""
         
-        if cmd == "sign_up":
+        if cmd == "hello":
+            # hello|1|2 或 hello|1|2;deflate
+            version, _, extension = data.partition(";")
+            if status == "1" and version.isdigit():
+                self.compressed = extension == "deflate"
+                self.protocol = int(version)
+        
+        elif cmd == "sign_up":
             if status == "1":
                 print(f"[{self.username}] ✓ 注册成功 - {data}")
             else:
@@ -184,10 +362,24 @@ class ChatroomClient:
             else:
                 print(f"[{self.username}] ✗ 登录失败 - {data}")
         
-        elif cmd == "show_online_user":
+        elif cmd == "session":
+            # 会话令牌，每次登录/恢复后轮换
+            self.session_token = data or None
+        
+        elif cmd == "resume":
             if status == "1":
-                users = data.replace("|", ", ")
+                print(f"[{self.username}] ✓ 会话已恢复")
+            else:
+                self.session_token = None
+                print(f"[{self.username}] ✗ 会话恢复失败 - {data}")
+        
+        elif cmd == "show_online_user":
+            # 分帧返回: 2=还有后续帧, 1=最后一帧, 3=本页结束但还有更多（用最后一个用户名作为 after 继续）
+            if status in ("1", "2", "3"):
+                users = data.replace("\n", ", ")
                 print(f"[{self.username}] 在线用户: {users}")
+                if status == "3":
+                    print(f"[{self.username}] 还有更多在线用户")
             else:
                 print(f"[{self.username}] ✗ 获取在线用户失败 - {data}")
         
@@ -225,13 +417,16 @@ class ChatroomClient:
                 print(f"[{self.username}] ✗ 广播失败 - {data}")
         
         elif cmd == "show_history":
-            if status == "1":
-                # 历史消息格式: msg1|msg2|msg3...
-                messages = data.split("|") if data else []
+            # 分帧返回: 2=还有后续帧, 1=最后一帧, 3=本页结束但还有更早的记录
+            # 每行: id sender receiver send_time group_type content
+            if status in ("1", "2", "3"):
+                messages = data.split("\n") if data else []
                 print(f"[{self.username}] 聊天历史 ({len(messages)} 条消息):")
                 for msg in messages:
                     if msg:
                         print(f"  {msg}")
+                if status == "3":
+                    print(f"[{self.username}] 还有更早的聊天记录")
             else:
                 print(f"[{self.username}] ✗ 查看历史失败 - {data}")
         
@@ -240,7 +435,8 @@ class ChatroomClient:
             pass
         
         elif cmd == "chat_unread":
-            if status == "1":
+            # 分批推送: 2=后面还有, 1=推送完毕（最后一帧可能为空）
+            if status in ("1", "2") and data:
                 print(f"[{self.username}] 📬 未读消息: {data}")
         
         else:
@@ -258,9 +454,21 @@ class ChatroomClient:
         print(f"[{self.username}] 正在登录...")
         return self.send_message(message)
     
-    def show_online_user(self):
-        """查询在线用户"""
-        message = "show_online_user\n"
+    def resume(self, last_id=0):
+        """用登录时下发的令牌恢复会话（断线重连后使用，不需要密码）"""
+        if not self.session_token:
+            print(f"[{self.username}] ✗ 没有可用的会话令牌")
+            return False
+        message = f"resume|{self.session_token}|{last_id}"
+        print(f"[{self.username}] 正在恢复会话...")
+        return self.send_message(message)
+    
+    def show_online_user(self, prefix="", after="", limit=0):
+        """查询在线用户（可按用户名前缀过滤、分页）"""
+        if prefix or after or limit:
+            message = f"show_online_user|{prefix}|{after}|{limit}"
+        else:
+            message = "show_online_user\n"
         return self.send_message(message)
     
     def single_chat(self, target_user, content):
@@ -283,10 +491,10 @@ class ChatroomClient:
         print(f"[{self.username}] 发送广播消息: {content}")
         return self.send_message(message)
     
-    def show_history(self, target_user):
-        """查看与指定用户的聊天历史"""
-        message = f"show_history|{target_user}\n"
-        print(f"[{self.username}] 查看与 {target_user} 的聊天历史")
+    def show_history(self, before_id=0, page_size=0):
+        """分页查看聊天历史（before_id 为上一页最后一条消息的id，0 表示从最新开始）"""
+        message = f"show_history|{before_id}|{page_size}"
+        print(f"[{self.username}] 查看聊天历史 (before_id={before_id}, page_size={page_size})")
         return self.send_message(message)
     
     def wait_for_response(self, timeout=2):
@@ -391,6 +599,11 @@ def test_show_online_users():
         client1.show_online_user()
         client1.wait_for_response(3)
         
+        # 按前缀过滤并分页（每页1个）
+        print("\n按前缀查询在线用户:")
+        client1.show_online_user(prefix="b", limit=1)
+        client1.wait_for_response(3)
+        
         print("\n✓ 测试2完成")
         return True
         
@@ -696,9 +909,14 @@ def test_show_history():
         time.sleep(0.5)
         
         # 查看聊天历史
-        print("\nAlice查看与Bob的聊天历史...")
-        message = "show_history|bob\n"
-        client1.send_message(message)
+        print("\nAlice查看聊天历史...")
+        client1.show_history()
+        client1.wait_for_response(3)
+        time.sleep(0.5)
+        
+        # 每页1条分页查看
+        print("\nAlice分页查看聊天历史（每页1条）...")
+        client1.show_history(page_size=1)
         client1.wait_for_response(3)
         time.sleep(0.5)
         
@@ -749,23 +967,95 @@ def test_heartbeat():
         client1.disconnect()
 
 
-def test_high_concurrency(num_clients=10, duration_seconds=30, messages_per_client=100):
+def test_session_resume():
+    """测试8: 断线重连后用会话令牌恢复"""
+    print("\n" + "="*60)
+    print("测试8: 会话恢复")
+    print("="*60)
+    
+    alice = ChatroomClient("alice")
+    bob = ChatroomClient("bob")
+    
+    try:
+        if not alice.connect() or not bob.connect():
+            return False
+        
+        time.sleep(0.5)
+        
+        for client in (alice, bob):
+            client.sign_up("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+            client.sign_in("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+        
+        if not alice.session_token:
+            print("  ✗ 登录后没有收到会话令牌")
+            return False
+        old_token = alice.session_token
+        
+        # alice 断线期间 bob 发来的消息，恢复会话后应作为离线消息推送
+        alice.disconnect()
+        time.sleep(1)
+        bob.single_chat("alice", "message while alice was away")
+        bob.wait_for_response(2)
+        time.sleep(1)
+        
+        if not alice.connect():
+            return False
+        time.sleep(0.5)
+        alice.resume()
+        alice.wait_for_response(2)
+        time.sleep(1)
+        
+        if not any(m.startswith("resume|1") for m in alice.received_messages):
+            print("  ✗ 会话恢复失败")
+            return False
+        if not any(m.startswith("chat_unread|") and "message while alice was away" in m
+                   for m in alice.received_messages):
+            print("  ✗ 没有收到断线期间的消息")
+            return False
+        if alice.session_token == old_token:
+            print("  ✗ 恢复后令牌没有轮换")
+            return False
+        
+        # 旧令牌已失效
+        alice.session_token = old_token
+        alice.resume()
+        alice.wait_for_response(2)
+        time.sleep(0.5)
+        if alice.session_token is not None:
+            print("  ✗ 旧令牌仍然可用")
+            return False
+        
+        print("\n✓ 测试8完成")
+        return True
+        
+    finally:
+        alice.disconnect()
+        bob.disconnect()
+
+
+def test_high_concurrency(num_clients=10, duration_seconds=30, messages_per_client=100, pipeline_depth=32):
     """高并发性能测试
     
     参数:
         num_clients: 客户端数量（默认10个）
         duration_seconds: 测试持续时间（秒）
         messages_per_client: 每个客户端发送的消息数
+        pipeline_depth: 每个客户端同时在途的请求数（按请求id匹配回复，不再一问一答）
     """
     print("\n" + "="*60)
     print("高并发性能测试")
     print("="*60)
-    print(f"配置: {num_clients}个客户端, {duration_seconds}秒持续测试, 每个客户端发{messages_per_client}条消息")
+    print(f"配置: {num_clients}个客户端, {duration_seconds}秒持续测试, 每个客户端发{messages_per_client}条消息, "
+          f"流水线深度{pipeline_depth}")
     print()
     
     import random
     import string
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from concurrent.futures import ThreadPoolExecutor, as_completed, wait
     
     suffix = ''.join(random.choices(string.digits, k=4))
     clients = [ChatroomClient(f"stress_{i}_{suffix}") for i in range(num_clients)]
@@ -778,8 +1068,10 @@ def test_high_concurrency(num_clients=10, duration_seconds=30, messages_per_clie
         'disconnected_clients': 0,
         'start_time': None,
         'end_time': None,
-        'errors': []
+        'errors': [],
+        'latencies': []
     }
+    stats_lock = threading.Lock()
     
     try:
         # 步骤1: 连接和认证
@@ -820,9 +1112,16 @@ def test_high_concurrency(num_clients=10, duration_seconds=30, messages_per_clie
         send_start = time.time()
         
         def send_message_worker(client_id, client):
-            """工作线程：发送消息"""
-            local_success = 0
-            local_failed = 0
+            """工作线程：流水线发送消息，最多 pipeline_depth 个请求在途，按服务器确认统计成功"""
+            window = threading.Semaphore(pipeline_depth)
+            in_flight = []
+            
+            def on_reply(future, sent_at):
+                window.release()
+                latency = time.time() - sent_at
+                with stats_lock:
+                    stats['latencies'].append(latency)
+            
             try:
                 for msg_id in range(messages_per_client):
                     if not client.is_connected:
@@ -835,20 +1134,24 @@ def test_high_concurrency(num_clients=10, duration_seconds=30, messages_per_clie
                         continue
                     
                     target = random.choice(other_clients)
-                    msg = f"perf_test_{msg_id}"
-                    
-                    if client.single_chat(target.username, msg):
-                        local_success += 1
-                    else:
-                        local_failed += 1
-                    
-                    time.sleep(0.011)  # 极小延迟增加吞吐量
+                    if not window.acquire(timeout=10):
+                        break  # 服务器长时间没有回复
+                    sent_at = time.time()
+                    future = client.request(f"single_chat|{target.username}|perf_test_{msg_id}\n")
+                    future.add_done_callback(lambda f, t=sent_at: on_reply(f, t))
+                    in_flight.append(future)
                     
+                wait(in_flight, timeout=10)
             except Exception as e:
-                local_failed += messages_per_client
-                stats['errors'].append(str(e))
+                with stats_lock:
+                    stats['errors'].append(str(e))
             
-            return local_success, local_failed
+            local_success = 0
+            for future in in_flight:
+                if future.done() and future.exception() is None and \
+                        any(reply.split('|')[1:2] != ["0"] for reply in future.result()):
+                    local_success += 1
+            return local_success, messages_per_client - local_success
         
         # 使用线程池并发发送消息
         with ThreadPoolExecutor(max_workers=min(num_clients, 20)) as executor:
@@ -895,6 +1198,11 @@ def test_high_concurrency(num_clients=10, duration_seconds=30, messages_per_clie
         print(f"失败消息:        {stats['failed_messages']}")
         print(f"成功率:          {success_rate:.2f}%")
         print(f"吞吐量:          {throughput:.2f} msg/sec")
+        if stats['latencies']:
+            latencies = sorted(stats['latencies'])
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+            print(f"确认延迟:        p50 {p50:.1f}ms, p99 {p99:.1f}ms")
         print(f"测试耗时:        {actual_duration:.2f} 秒")
         print(f"客户端在线:      {connected_now}/{num_clients}")
         print(f"客户端断开:      {stats['disconnected_clients']}")
@@ -952,6 +1260,7 @@ def test_stress_single_client(duration_seconds=15, messages_per_second=10):
     
     import random
     import string
+    from concurrent.futures import wait
     
     suffix = ''.join(random.choices(string.digits, k=4))
     client1 = ChatroomClient(f"stress_sender_{suffix}")
@@ -992,14 +1301,17 @@ def test_stress_single_client(duration_seconds=15, messages_per_second=10):
         
         msg_count = 0
         start_msg_count = len(client2.received_messages)
+        acks = []  # 每条消息的 Future，按请求id匹配服务器确认，发送不必等待
         
         while time.time() - stats['start_time'] < duration_seconds:
             for _ in range(messages_per_second):
                 msg = f"msg_{msg_count}"
-                if client1.single_chat(client2.username, msg):
-                    stats['messages_sent'] += 1
-                else:
+                future = client1.request(f"single_chat|{client2.username}|{msg}\n")
+                if future.done() and future.exception() is not None:
                     stats['errors'] += 1
+                else:
+                    stats['messages_sent'] += 1
+                    acks.append(future)
                 msg_count += 1
                 time.sleep(1.0 / (messages_per_second * 10))  # 细粒度控制
             
@@ -1010,6 +1322,8 @@ def test_stress_single_client(duration_seconds=15, messages_per_second=10):
         
         stats['end_time'] = time.time()
         actual_duration = stats['end_time'] - stats['start_time']
+        wait(acks, timeout=5)
+        acked = sum(1 for f in acks if f.done() and f.exception() is None)
         stats['messages_received'] = len(client2.received_messages) - start_msg_count
         
         # 输出结果
@@ -1021,6 +1335,7 @@ def test_stress_single_client(duration_seconds=15, messages_per_second=10):
         print("单客户端压力测试结果")
         print("="*60)
         print(f"发送消息:        {stats['messages_sent']}")
+        print(f"服务器确认:      {acked}")
         print(f"接收消息:        {stats['messages_received']}")
         print(f"发送失败:        {stats['errors']}")
         print(f"吞吐量:          {throughput:.2f} msg/sec")
@@ -1120,6 +1435,319 @@ def test_connection_stability(num_clients=20, hold_time=60):
                 client.disconnect()
 
 
+def test_large_message():
+    """测试9: 超过单帧上限的长消息（续帧）"""
+    print("\n" + "="*60)
+    print("测试9: 长消息")
+    print("="*60)
+    
+    alice = ChatroomClient("alice")
+    bob = ChatroomClient("bob")
+    
+    try:
+        if not alice.connect() or not bob.connect():
+            return False
+        
+        time.sleep(0.5)
+        
+        for client in (alice, bob):
+            client.sign_up("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+            client.sign_in("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+        
+        text = "长消息" * 4000  # 约36KB，拆成多个续帧
+        alice.single_chat("bob", text)
+        alice.wait_for_response(2)
+        time.sleep(1)
+        
+        if not any(m.startswith("single_chat|1|") and m.endswith(text) for m in bob.received_messages):
+            print("  ✗ Bob没有收到完整的长消息")
+            return False
+        
+        # 超过拼接上限的消息被拒绝，但连接保持（v2 单个字段最长64KB，这里用 v1 文本）
+        carol = ChatroomClient("carol", protocol=1)
+        try:
+            if not carol.connect():
+                return False
+            carol.sign_up("password")
+            carol.wait_for_response(2)
+            carol.sign_in("password")
+            carol.wait_for_response(2)
+            time.sleep(0.3)
+            # 能拼接完整但超过 chat_log.content 容量的正文被拒绝
+            carol.send_message("single_chat|bob|" + "x" * (70 * 1024))
+            carol.wait_for_response(2)
+            time.sleep(1)
+            if not any(m.startswith("single_chat|0|消息过长") for m in carol.received_messages):
+                print("  ✗ 超过存储上限的消息没有被拒绝")
+                return False
+            carol.send_message("single_chat|bob|" + "x" * (300 * 1024))
+            carol.wait_for_response(2)
+            time.sleep(1)
+            if not any(m.startswith("single_chat|0|消息过大") for m in carol.received_messages):
+                print("  ✗ 超长消息没有被拒绝")
+                return False
+            carol.send_message("heartbeat")
+            carol.wait_for_response(2)
+            if not carol.is_connected:
+                print("  ✗ 发送超长消息后连接被断开")
+                return False
+        finally:
+            carol.disconnect()
+        
+        print("\n✓ 测试9完成")
+        return True
+        
+    finally:
+        alice.disconnect()
+        bob.disconnect()
+
+
+def test_compression():
+    """测试10: 协商压缩后大的响应（聊天历史）压缩传输"""
+    print("\n" + "="*60)
+    print("测试10: 压缩")
+    print("="*60)
+    
+    alice = ChatroomClient("alice", compress=True)
+    bob = ChatroomClient("bob")
+    
+    try:
+        if not alice.connect() or not bob.connect():
+            return False
+        
+        time.sleep(0.5)
+        
+        if not alice.compressed:
+            print("  ✗ 服务器没有同意压缩")
+            return False
+        
+        for client in (alice, bob):
+            client.sign_up("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+            client.sign_in("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+        
+        for i in range(20):
+            bob.single_chat("alice", f"压缩测试消息 {i}")
+            bob.wait_for_response(1)
+        time.sleep(1)
+        
+        # 两次查看历史：第二次压缩流中已有第一次的内容作为字典
+        for _ in range(2):
+            alice.show_history()
+            alice.wait_for_response(3)
+            time.sleep(0.5)
+        
+        history = [m for m in alice.received_messages if m.startswith("show_history|")]
+        if not any("压缩测试消息 19" in m for m in history):
+            print("  ✗ 没有收到解压后的聊天历史")
+            return False
+        
+        print("\n✓ 测试10完成")
+        return True
+        
+    finally:
+        alice.disconnect()
+        bob.disconnect()
+
+
+def test_pipelined_requests():
+    """测试11: 同一连接上流水线发送多个请求，按请求id匹配回复"""
+    print("\n" + "="*60)
+    print("测试11: 请求流水线")
+    print("="*60)
+    
+    alice = ChatroomClient("alice")
+    bob = ChatroomClient("bob")
+    
+    try:
+        if not alice.connect() or not bob.connect():
+            return False
+        
+        time.sleep(0.5)
+        
+        for client in (alice, bob):
+            client.sign_up("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+            client.sign_in("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+        
+        # 不等回复连续发出，聊天、心跳、历史查询交错在途
+        futures = []
+        for i in range(50):
+            futures.append(("single_chat", alice.request(f"single_chat|bob|pipelined {i}\n")))
+            if i % 10 == 0:
+                futures.append(("heartbeat", alice.request("heartbeat")))
+        futures.append(("show_history", alice.request("show_history|0|5")))
+        
+        for cmd, future in futures:
+            replies = future.result(timeout=5)
+            if not all(reply.startswith(cmd + "|") for reply in replies):
+                print(f"  ✗ {cmd} 的回复不匹配: {replies}")
+                return False
+        
+        history = futures[-1][1].result()
+        if history[-1].split('|')[1] == "2":
+            print("  ✗ 分帧回复没有等到最后一帧")
+            return False
+        
+        print(f"  ✓ {len(futures)} 个在途请求全部按请求id收到回复")
+        
+        # 登录后不等回复紧接着发聊天和历史查询：这些命令要在登录完成之后按序执行
+        carol = ChatroomClient("carol")
+        try:
+            if not carol.connect():
+                return False
+            carol.sign_up("password")
+            carol.wait_for_response(2)
+            time.sleep(0.3)
+            sign_in = carol.request("sign_in|carol|password")
+            chat = carol.request("single_chat|bob|right after sign_in\n")
+            history = carol.request("show_history|0|5")
+            if not sign_in.result(timeout=5)[0].startswith("sign_in|1|"):
+                print("  ✗ 流水线中的登录失败")
+                return False
+            chat_reply = chat.result(timeout=5)[0]
+            if not chat_reply.startswith("single_chat|2|"):
+                print(f"  ✗ 紧跟登录的聊天没有在登录之后执行: {chat_reply}")
+                return False
+            if not history.result(timeout=5)[-1].startswith(("show_history|1|", "show_history|3|")):
+                print("  ✗ 紧跟登录的历史查询没有在登录之后执行")
+                return False
+        finally:
+            carol.disconnect()
+        print("  ✓ 紧跟登录的请求在登录完成后按序执行")
+        
+        print("\n✓ 测试11完成")
+        return True
+        
+    finally:
+        alice.disconnect()
+        bob.disconnect()
+
+
+def admin_request(command="", path=ADMIN_SOCKET_PATH):
+    """向指标套接字发送一行命令（空串表示导出指标），返回服务器写回的全部文本"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    try:
+        sock.connect(path)
+        if command:
+            sock.sendall((command + "\n").encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)  # 告诉服务器命令已发送完
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    return b"".join(chunks).decode("utf-8")
+
+
+def read_admin_stats(path=ADMIN_SOCKET_PATH):
+    """读取服务器导出的全部指标，返回 {"name{labels}": value}"""
+    stats = {}
+    for line in admin_request("", path).splitlines():
+        key, _, value = line.rpartition(" ")
+        if key:
+            stats[key] = int(value)
+    return stats
+
+
+def test_admin_stats():
+    """测试12: 指标导出（连接数、命令计数和延迟）"""
+    print("\n" + "="*60)
+    print("测试12: 指标导出")
+    print("="*60)
+    
+    try:
+        before = read_admin_stats()
+    except OSError as e:
+        print(f"  ✗ 无法连接指标套接字 {ADMIN_SOCKET_PATH}: {e}")
+        return False
+    
+    alice = ChatroomClient("alice")
+    try:
+        if not alice.connect():
+            return False
+        alice.sign_up("password")
+        alice.wait_for_response(2)
+        time.sleep(0.3)
+        alice.sign_in("password")
+        alice.wait_for_response(2)
+        time.sleep(0.5)
+        
+        after = read_admin_stats()
+        key = 'chatroom_cmd_total{cmd="sign_in"}'
+        p99 = after.get('chatroom_cmd_us{cmd="sign_in",q="0.99"}')
+        print(f"  连接数: {after.get('chatroom_connections')}, sign_in: {before.get(key, 0)} -> {after.get(key)}")
+        print(f"  sign_in p99: {p99}us")
+        if after.get("chatroom_connections", 0) < 1 or after.get(key, 0) <= before.get(key, 0):
+            print("  ✗ 指标没有更新")
+            return False
+        
+        print("\n✓ 测试12完成")
+        return True
+        
+    finally:
+        alice.disconnect()
+
+
+def test_tracing():
+    """测试13: 开启采样追踪后导出单条消息各阶段的耗时"""
+    print("\n" + "="*60)
+    print("测试13: 消息追踪")
+    print("="*60)
+    
+    alice = ChatroomClient("alice")
+    bob = ChatroomClient("bob")
+    try:
+        print("  " + admin_request("trace 1").strip())
+        if not alice.connect() or not bob.connect():
+            return False
+        for client in (alice, bob):
+            client.sign_up("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+            client.sign_in("password")
+            client.wait_for_response(2)
+            time.sleep(0.3)
+        for i in range(5):
+            alice.single_chat("bob", f"追踪测试消息 {i}")
+            alice.wait_for_response(1)
+        time.sleep(0.5)
+        
+        dump = admin_request("traces 10")
+        print(dump)
+        if "cmd=single_chat" not in dump or "cmd=sign_in" not in dump:
+            print("  ✗ 没有记录到追踪")
+            return False
+        
+        print("\n✓ 测试13完成")
+        return True
+        
+    except OSError as e:
+        print(f"  ✗ 无法连接指标套接字 {ADMIN_SOCKET_PATH}: {e}")
+        return False
+    finally:
+        alice.disconnect()
+        bob.disconnect()
+        try:
+            admin_request("trace 0")
+        except OSError:
+            pass
+
+
 def run_all_tests():
     """运行所有测试"""
     print("\n" + "="*60)
@@ -1136,6 +1764,12 @@ def run_all_tests():
         ("查看聊天历史", test_show_history),
         ("心跳机制", test_heartbeat),
         ("多客户端交叉通信", test_cross_communication),
+        ("会话恢复", test_session_resume),
+        ("长消息", test_large_message),
+        ("压缩", test_compression),
+        ("请求流水线", test_pipelined_requests),
+        ("指标导出", test_admin_stats),
+        ("消息追踪", test_tracing),
     ]
     
     results = []